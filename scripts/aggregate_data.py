@@ -1,45 +1,263 @@
 #!/usr/bin/env python3
 """
 Energy Data Aggregator
-Simple utility to verify data collection is working across all sources
+Data-quality scan of every collected source: gaps, duplicates,
+out-of-order timestamps, out-of-range values and schema drift
 
-Runs daily at 6:00 AM to provide a quick inventory of collected data.
-Useful for monitoring that all data collection tasks are functioning properly.
+Runs daily at 6:00 AM. Each source is read in a single streaming pass
+from where the previous run stopped (byte offsets are checkpointed in
+data_quality.state.json), so the daily check only reads what was
+appended since. When log_archive.py has rotated a file in between, the
+rows after the checkpoint are read from its raw archived segments first.
+Findings are written to data_quality_report.json and summarized on
+stdout.
 """
+import csv
+import json
+import os
 import sys
+from collections import deque
+from datetime import datetime, timedelta
 from pathlib import Path
+from log_archive import list_segments, open_segment
+from collect_weather import WEATHER_FIELDS
+from readings import MONITORING_FIELDS
 
 # Data source paths
 LOG_DIR = Path("/volume1/docker/franklin/logs")
 FRANKLIN_LOG = LOG_DIR / "continuous_monitoring.csv"
-GROUND_SOLAR_LOG = LOG_DIR / "pvoutput_ground_mount.csv"
-HOUSE_SOLAR_LOG = LOG_DIR / "pvoutput_house.csv"
+GROUND_SOLAR_LOG = LOG_DIR / "pvoutput_ground_mount_daily.csv"
+HOUSE_SOLAR_LOG = LOG_DIR / "pvoutput_house_daily.csv"
 WEATHER_LOG = LOG_DIR / "weather_data.csv"
 
+STATE_FILE = LOG_DIR / "data_quality.state.json"
+REPORT_FILE = LOG_DIR / "data_quality_report.json"
+
+PVOUTPUT_FIELDS = ['date', 'energy_wh', 'efficiency', 'exported_wh', 'used_wh',
+                   'peak_power_w', 'peak_time', 'condition']
+
+# A step longer than GAP_FACTOR x the expected cadence is reported as a gap
+GAP_FACTOR = 2.5
+# Duplicate keys are remembered for this many recent rows per source
+DUPLICATE_WINDOW = 2000
+# At most this many examples of each finding are kept in the report
+MAX_EXAMPLES = 20
+
+# name: file, header (None: headerless file with these fields), timestamp and
+# duplicate-key columns, expected cadence, and (min, max) value ranges
+SOURCES = {
+    "Franklin Battery": {
+        'path': FRANKLIN_LOG, 'fields': list(MONITORING_FIELDS), 'has_header': True,
+        'time_field': 'timestamp', 'key_field': 'timestamp', 'cadence': timedelta(minutes=15),
+        'ranges': {'soc_percent': (0, 100), 'solar_kw': (0, None), 'home_load_kw': (0, None)},
+    },
+    "Ground Mount Solar": {
+        'path': GROUND_SOLAR_LOG, 'fields': PVOUTPUT_FIELDS, 'has_header': False,
+        'time_field': 'date', 'key_field': 'date', 'cadence': timedelta(days=1),
+        'ranges': {'energy_wh': (0, None), 'peak_power_w': (0, None)},
+    },
+    "House Solar": {
+        'path': HOUSE_SOLAR_LOG, 'fields': PVOUTPUT_FIELDS, 'has_header': False,
+        'time_field': 'date', 'key_field': 'date', 'cadence': timedelta(days=1),
+        'ranges': {'energy_wh': (0, None), 'peak_power_w': (0, None)},
+    },
+    "Weather": {
+        # The station repeats its last observation when it hasn't updated
+        'path': WEATHER_LOG, 'fields': WEATHER_FIELDS, 'has_header': True,
+        'time_field': 'timestamp', 'key_field': 'obs_time_local', 'cadence': timedelta(minutes=15),
+        'ranges': {'humidity': (0, 100), 'solar_radiation_wm2': (0, None), 'temp_f': (-60, 140)},
+    },
+}
+
+def parse_time(value):
+    """Timestamps as written by the collectors ('YYYY-MM-DD HH:MM:SS', ISO, or PVOutput 'YYYYMMDD')"""
+    if len(value) == 8 and value.isdigit():
+        return datetime.strptime(value, '%Y%m%d')
+    return datetime.fromisoformat(value)
+
+class SourceScan:
+    """Streaming checks for one source, resumable from its checkpoint"""
+
+    def __init__(self, name, config, checkpoint):
+        self.name = name
+        self.config = config
+        self.header = checkpoint.get('header') or (None if config['has_header'] else config['fields'])
+        self.last_time = datetime.fromisoformat(checkpoint['last_time']) if checkpoint.get('last_time') else None
+        self.recent_keys = deque(checkpoint.get('recent_keys', []), maxlen=DUPLICATE_WINDOW)
+        self.key_set = set(self.recent_keys)
+        self.total_rows = checkpoint.get('total_rows', 0)
+        self.rows = 0
+        self.findings = {'gaps': [], 'duplicates': [], 'out_of_order': [], 'out_of_range': [], 'schema_drift': []}
+        self.counts = {finding: 0 for finding in self.findings}
+
+    def note(self, finding, example):
+        self.counts[finding] += 1
+        if len(self.findings[finding]) < MAX_EXAMPLES:
+            self.findings[finding].append(example)
+
+    def check_header(self, fields):
+        """Compare a file's header with the expected schema"""
+        expected = self.config['fields']
+        if fields != expected:
+            missing = [f for f in expected if f not in fields]
+            added = [f for f in fields if f not in expected]
+            self.note('schema_drift', {'header': fields, 'missing': missing, 'added': added})
+        self.header = fields
+
+    def check_row(self, fields, skip_through=None):
+        """Run every check on one parsed row; rows at or before skip_through were already seen"""
+        if len(fields) != len(self.header):
+            self.note('schema_drift', {'row': ','.join(fields)[:200], 'fields': len(fields),
+                                       'expected': len(self.header)})
+            return
+        row = dict(zip(self.header, fields))
+        try:
+            timestamp = parse_time(row.get(self.config['time_field']) or '')
+        except ValueError:
+            self.note('schema_drift', {'row': ','.join(fields)[:200], 'error': 'bad timestamp'})
+            return
+        if skip_through is not None and timestamp <= skip_through:
+            return
+        self.rows += 1
+
+        key = row.get(self.config['key_field']) or str(timestamp)
+        if key in self.key_set:
+            self.note('duplicates', {'key': key, 'timestamp': str(timestamp)})
+        else:
+            if len(self.recent_keys) == self.recent_keys.maxlen:
+                self.key_set.discard(self.recent_keys[0])
+            self.recent_keys.append(key)
+            self.key_set.add(key)
+
+        if self.last_time is not None:
+            if timestamp < self.last_time:
+                self.note('out_of_order', {'timestamp': str(timestamp), 'after': str(self.last_time)})
+            elif timestamp - self.last_time > self.config['cadence'] * GAP_FACTOR:
+                self.note('gaps', {'from': str(self.last_time), 'to': str(timestamp),
+                                   'hours': round((timestamp - self.last_time).total_seconds() / 3600, 2)})
+        if self.last_time is None or timestamp > self.last_time:
+            self.last_time = timestamp
+
+        for field, (low, high) in self.config['ranges'].items():
+            try:
+                value = float(row.get(field) or 'nan')
+            except ValueError:
+                self.note('out_of_range', {'timestamp': str(timestamp), 'field': field, 'value': row.get(field)})
+                continue
+            if (low is not None and value < low) or (high is not None and value > high):
+                self.note('out_of_range', {'timestamp': str(timestamp), 'field': field, 'value': value})
+
+    def scan_lines(self, lines, skip_through=None, header_first=False):
+        """Check an iterable of complete CSV lines"""
+        for line in lines:
+            fields = next(csv.reader([line]), None)
+            if not fields:
+                continue
+            if header_first:
+                header_first = False
+                self.check_header(fields)
+                continue
+            if self.header is None:
+                self.check_header(fields)
+                continue
+            self.check_row(fields, skip_through)
+
+    def checkpoint(self, path_state):
+        self.total_rows += self.rows
+        return dict(path_state, header=self.header, total_rows=self.total_rows,
+                    last_time=self.last_time.isoformat(sep=' ') if self.last_time else None,
+                    recent_keys=list(self.recent_keys))
+
+def read_appended(path, offset):
+    """Complete lines appended to a file since a byte offset; returns (lines, new offset)"""
+    lines = []
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        for raw in f:
+            if not raw.endswith(b'\n'):
+                break  # Partially written line: read it next time
+            offset += len(raw)
+            lines.append(raw.decode('utf-8', errors='replace'))
+    return lines, offset
+
+def scan_archived(scan, config):
+    """Check raw archived segments for rows newer than the scan's last timestamp"""
+    since = scan.last_time.strftime('%Y-%m-%d') if scan.last_time else ''
+    for period, segment in list_segments(config['path']):
+        if period >= since:
+            with open_segment(segment) as f:
+                scan.scan_lines(f, skip_through=scan.last_time, header_first=config['has_header'])
+
+def scan_source(name, config, checkpoint):
+    """Scan what was added to one source since its checkpoint"""
+    scan = SourceScan(name, config, checkpoint)
+    path = config['path']
+    offset = checkpoint.get('offset', 0)
+    stat = os.stat(path) if path.exists() else None
+
+    # A new file (other inode, or shorter than what we read) means it was rotated
+    rotated = not checkpoint or (stat is None and checkpoint.get('inode') is not None) or (
+        stat is not None and (checkpoint.get('inode') not in (None, stat.st_ino) or stat.st_size < offset))
+    if rotated:
+        scan_archived(scan, config)
+        offset = 0
+    if stat is None:
+        return scan, {'offset': 0, 'inode': None}
+
+    lines, end = read_appended(path, offset)
+    scan.scan_lines(lines, header_first=config['has_header'] and offset == 0)
+    return scan, {'offset': end, 'inode': stat.st_ino}
+
+def load_checkpoints():
+    if not STATE_FILE.exists():
+        return {}
+    with open(STATE_FILE, 'r') as f:
+        return json.load(f)
+
+def write_json(path, data):
+    """Write JSON atomically"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f, indent=2)
+    os.replace(tmp_path, path)
+
 def aggregate_data():
-    """Simple aggregation - just report what we have"""
+    """Scan all sources, write the report and print a summary"""
     print("\n" + "="*60)
     print("ENERGY DATA SUMMARY")
     print("="*60 + "\n")
 
-    # Count records in each file
-    files = {
-        "Franklin Battery": FRANKLIN_LOG,
-        "Ground Mount Solar": GROUND_SOLAR_LOG,
-        "House Solar": HOUSE_SOLAR_LOG,
-        "Weather": WEATHER_LOG
-    }
-
-    for name, filepath in files.items():
-        if filepath.exists():
-            with open(filepath, 'r') as f:
-                lines = sum(1 for line in f) - 1  # Subtract header
-                print(f"✓ {name}: {lines} records")
-        else:
+    checkpoints = load_checkpoints()
+    report = {'generated': datetime.now().isoformat(sep=' ', timespec='seconds'), 'sources': {}}
+
+    for name, config in SOURCES.items():
+        scan, path_state = scan_source(name, config, checkpoints.get(name, {}))
+        checkpoints[name] = scan.checkpoint(path_state)
+        archived = len(list_segments(config['path']))
+        report['sources'][name] = {
+            'file': str(config['path']),
+            'exists': config['path'].exists(),
+            'archived_days': archived,
+            'rows_scanned': scan.rows,
+            'total_rows': scan.total_rows,
+            'last_timestamp': checkpoints[name]['last_time'],
+            'counts': scan.counts,
+            'findings': scan.findings,
+        }
+
+        issues = ', '.join(f"{count} {finding.replace('_', ' ')}" for finding, count in scan.counts.items() if count)
+        if not config['path'].exists() and not archived:
             print(f"⚠ {name}: File not found")
+        elif issues:
+            print(f"⚠ {name}: {scan.rows} new records ({scan.total_rows} total) - {issues}")
+        else:
+            print(f"✓ {name}: {scan.rows} new records ({scan.total_rows} total), no issues")
+
+    write_json(REPORT_FILE, report)
+    write_json(STATE_FILE, checkpoints)
 
     print("\n" + "="*60 + "\n")
-    print("✓ Data summary complete")
+    print(f"✓ Data summary complete (report: {REPORT_FILE})")
     return True
 
 if __name__ == "__main__":
@@ -0,0 +1,186 @@
+#!/volume1/docker/franklin/venv311/bin/python3
+"""
+Anomaly Detector - Streaming Checks on Every Reading
+Watches each cycle's reading for trouble that otherwise only shows up
+when someone reads solar_intelligence.log
+
+Constant-memory online statistics, updated in O(1) per reading and kept
+as one small JSON state value in the history store (history is never
+re-read):
+- Welford mean/variance of home load and solar per hour of day
+- an EWMA of fetch attempts per cycle
+- run-length counters for stuck SOC and unexplained charging
+
+Alerts are typed (see ALERT_TYPES), raised once when a condition starts
+and cleared when it ends; smart_decision.py logs them and can email
+them through notifier.py.
+"""
+import json
+import math
+import sys
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+from charge_planner import BATTERY_CAPACITY_KWH
+
+Alert = namedtuple('Alert', ('kind', 'message'))
+
+ALERT_TYPES = {
+    'soc_stuck': "SOC not changing while the battery reports power flow",
+    'charging_in_tou': "SOC rising faster than solar surplus allows while in TOU mode",
+    'solar_dead': "No solar production in strong sunshine",
+    'api_retries': "Cloud fetches keep needing retries",
+    'home_load_outlier': "Home load far outside the usual range for this hour",
+    'solar_outlier': "Solar far outside the usual range for this hour",
+}
+
+# Run-length thresholds (consecutive readings)
+SOC_STUCK_READINGS = 8            # 2 hours at the normal cadence
+SOC_STUCK_BATTERY_KW = 0.3        # ...while at least this much battery power is reported
+CHARGING_IN_TOU_READINGS = 2
+SOC_RATE_SLACK_PER_HOUR = 5.0     # SOC %/h of rise left unexplained before it counts
+MAX_STEP_HOURS = 1.0              # Longer gaps reset the run-length counters
+
+# Solar in sunshine (weather log radiation), checked around noon only
+SUNNY_HOURS = (10, 14)
+SUNNY_RADIATION_WM2 = 500.0
+SOLAR_DEAD_KW = 0.1
+
+# Retries: EWMA of attempts per cycle
+RETRY_EWMA_ALPHA = 0.3
+RETRY_EWMA_LIMIT = 2.0
+
+# Outliers: |z| above this once the hour has enough samples
+OUTLIER_Z = 4.0
+OUTLIER_MIN_SAMPLES = 20
+OUTLIER_METRICS = ('home_load_kw', 'solar_kw')
+
+STATE_KEY = 'anomaly_state'
+
+def needs_radiation(now, solar_kw):
+    """True when the solar_dead check needs a weather observation for this reading"""
+    return SUNNY_HOURS[0] <= now.hour < SUNNY_HOURS[1] and (solar_kw or 0.0) < SOLAR_DEAD_KW
+
+def welford_update(stats, value):
+    """Add a value to [count, mean, M2]"""
+    count, mean, m2 = stats
+    count += 1
+    delta = value - mean
+    mean += delta / count
+    m2 += delta * (value - mean)
+    stats[:] = [count, mean, m2]
+
+def welford_z(stats, value):
+    """z-score of a value against [count, mean, M2], or None with too few samples"""
+    count, mean, m2 = stats
+    if count < OUTLIER_MIN_SAMPLES:
+        return None
+    std = math.sqrt(m2 / (count - 1))
+    return (value - mean) / max(std, 0.05)
+
+class AnomalyDetector:
+    """Online checks over successive readings of one site"""
+
+    def __init__(self, state=None):
+        state = state or {}
+        self.last = state.get('last')              # [timestamp, soc]
+        self.runs = state.get('runs', {'soc_stuck': 0, 'charging_in_tou': 0})
+        self.retry_ewma = state.get('retry_ewma', 1.0)
+        self.hourly = state.get('hourly', {m: [[0, 0.0, 0.0] for _ in range(24)] for m in OUTLIER_METRICS})
+        self.active = set(state.get('active', []))
+
+    def to_json(self):
+        return json.dumps({'last': self.last, 'runs': self.runs, 'retry_ewma': round(self.retry_ewma, 4),
+                           'hourly': self.hourly, 'active': sorted(self.active)}, separators=(',', ':'))
+
+    @classmethod
+    def from_json(cls, text):
+        return cls(json.loads(text) if text else None)
+
+    def _conditions(self, reading, now, mode, attempts, radiation):
+        """Which alert conditions hold for this reading: {kind: message}"""
+        found = {}
+        soc = reading.soc_percent
+        step_hours = None
+        if self.last:
+            step_hours = (now - datetime.strptime(self.last[0], '%Y-%m-%d %H:%M:%S')).total_seconds() / 3600
+        if step_hours is None or not 0 < step_hours <= MAX_STEP_HOURS:
+            self.runs = {kind: 0 for kind in self.runs}
+        else:
+            delta = soc - self.last[1]
+            battery_kw = abs(reading.battery_kw or 0.0)
+            self.runs['soc_stuck'] = (self.runs['soc_stuck'] + 1
+                                      if abs(delta) < 0.01 and battery_kw >= SOC_STUCK_BATTERY_KW else 0)
+            surplus = max((reading.solar_kw or 0.0) - (reading.home_load_kw or 0.0), 0.0)
+            explained = surplus * 100 / BATTERY_CAPACITY_KWH + SOC_RATE_SLACK_PER_HOUR
+            rate = delta / step_hours
+            self.runs['charging_in_tou'] = (self.runs['charging_in_tou'] + 1
+                                            if mode == "TOU" and rate > explained else 0)
+            if self.runs['soc_stuck'] >= SOC_STUCK_READINGS:
+                found['soc_stuck'] = (f"SOC stuck at {soc:.1f}% for {self.runs['soc_stuck']} readings "
+                                      f"with {battery_kw:.2f}kW battery power")
+            if self.runs['charging_in_tou'] >= CHARGING_IN_TOU_READINGS:
+                found['charging_in_tou'] = (f"SOC rising {rate:.1f}%/h in TOU mode, solar surplus "
+                                            f"explains {explained - SOC_RATE_SLACK_PER_HOUR:.1f}%/h")
+
+        if (radiation is not None and radiation >= SUNNY_RADIATION_WM2
+                and needs_radiation(now, reading.solar_kw)):
+            found['solar_dead'] = f"Solar {reading.solar_kw or 0.0:.2f}kW with {radiation:.0f} W/m2 radiation"
+
+        if attempts is not None:
+            self.retry_ewma += RETRY_EWMA_ALPHA * (attempts - self.retry_ewma)
+            if self.retry_ewma > RETRY_EWMA_LIMIT:
+                found['api_retries'] = f"Averaging {self.retry_ewma:.1f} attempts per fetch (last: {attempts})"
+
+        for metric in OUTLIER_METRICS:
+            value = getattr(reading, metric)
+            if value is None:
+                continue
+            stats = self.hourly[metric][now.hour]
+            z = welford_z(stats, value)
+            if z is not None and abs(z) > OUTLIER_Z:
+                found[f"{metric.replace('_kw', '')}_outlier"] = (
+                    f"{metric} {value:.2f} at {now.hour:02d}h, usually {stats[1]:.2f} (z={z:+.1f})")
+            welford_update(stats, value)
+        return found
+
+    def observe(self, reading, now, mode=None, attempts=None, radiation=None):
+        """
+        Update with one reading.
+        Returns: (alerts raised, kinds cleared)
+        """
+        found = self._conditions(reading, now, mode, attempts, radiation)
+        raised = [Alert(kind, message) for kind, message in found.items() if kind not in self.active]
+        cleared = sorted(self.active - set(found))
+        self.active = set(found)
+        self.last = [now.strftime('%Y-%m-%d %H:%M:%S'), reading.soc_percent]
+        return raised, cleared
+
+if __name__ == "__main__":
+    import random
+    import time
+    from readings import Reading
+
+    # Self-check on a synthetic month: a stuck SOC must be caught, normal readings not
+    detector = AnomalyDetector()
+    start = datetime(2026, 1, 1)
+    seen = []
+    rng = random.Random(1)
+    started = time.perf_counter()
+    for i in range(4 * 24 * 30):
+        now = start + timedelta(minutes=15 * i)
+        stuck = i >= 4 * 24 * 29
+        soc = 70.0 if stuck else 50 + 20 * math.sin(i / 20)
+        reading = Reading(now.strftime('%Y-%m-%d %H:%M:%S'), soc, max(0.0, rng.gauss(2, 0.3)),
+                          0.0, 1.0, rng.gauss(1.5, 0.2), 'NORMAL', 0, 0, 0, 0, 3.0, 'TOU')
+        raised, _ = detector.observe(reading, now, "BACKUP", attempts=1)
+        seen.extend(alert.kind for alert in raised)
+    per_reading = (time.perf_counter() - started) / (4 * 24 * 30)
+    restored = AnomalyDetector.from_json(detector.to_json())
+
+    if seen != ['soc_stuck'] or restored.active != {'soc_stuck'}:
+        print(f"✗ Anomaly detector self-check failed: {seen}")
+        sys.exit(1)
+    print(f"✓ Anomaly detector self-check passed ({per_reading * 1e6:.0f} µs per reading, "
+          f"state {len(detector.to_json())} bytes)")
+    sys.exit(0)
@@ -0,0 +1,246 @@
+#!/volume1/docker/franklin/venv311/bin/python3
+"""
+Weather Underground Historical Backfill
+Fills weather_data.csv history for a date range from the PWS history
+endpoint (all observations of one day per request)
+
+Several days are fetched at once over one keep-alive session, behind a
+token bucket that keeps to the API key's per-minute limit. Observations
+are thinned to the collector's 15-minute cadence and deduplicated by
+obs_time_local against what the archive already holds (hours and days
+that only survive as hourly/daily aggregates count as covered). Each day
+is merged into its archived day segment in timestamp order, then the
+archive's retention rules are applied, so old days end up in the
+hourly/daily tiers like everything else.
+
+Finished days are kept in a checkpoint file: an interrupted or
+quota-limited run resumes where it stopped. Today is left to
+collect_weather.py.
+
+Usage: backfill_weather.py START_DATE [END_DATE]   (YYYY-MM-DD, END defaults to yesterday)
+"""
+import asyncio
+import csv
+import json
+import os
+import sys
+import time
+from datetime import date, datetime, timedelta
+
+import requests
+
+import log_archive
+from collect_weather import API_KEY, PWS_ID, WEATHER_FIELDS, WEATHER_LOG
+
+HISTORY_URL = "https://api.weather.com/v2/pws/history/all"
+
+CONCURRENT_DAYS = 4
+RATE_PER_MINUTE = 30           # API key limit; collect_weather.py's calls fit in the burst headroom
+BURST = 3
+MAX_REQUESTS_PER_RUN = 1000    # Daily quota is 1500; leave the collector its share
+MAX_RETRIES = 3
+REQUEST_TIMEOUT_SECONDS = 30
+CADENCE_MINUTES = 15           # Keep one observation per collector interval
+
+CHECKPOINT_FILE = WEATHER_LOG.parent / "weather_backfill.state.json"
+
+class TokenBucket:
+    """Allows `rate` requests per second on average, `burst` at once"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class QuotaExhausted(Exception):
+    """Stop for this run; the checkpoint lets the next one continue"""
+
+def observation_row(obs):
+    """A weather_data.csv row from one history observation"""
+    imperial = obs.get('imperial', {})
+    local = obs.get('obsTimeLocal', '')
+    return {
+        'timestamp': local.replace(' ', 'T'),
+        'obs_time_local': local,
+        'station_id': obs.get('stationID', PWS_ID),
+        'neighborhood': obs.get('neighborhood', ''),
+        'temp_f': imperial.get('tempAvg'),
+        'heat_index_f': imperial.get('heatindexAvg'),
+        'dewpoint_f': imperial.get('dewptAvg'),
+        'wind_chill_f': imperial.get('windchillAvg'),
+        'humidity': obs.get('humidityAvg'),
+        'pressure_inhg': imperial.get('pressureMax'),
+        'wind_speed_mph': imperial.get('windspeedAvg'),
+        'wind_gust_mph': imperial.get('windgustHigh'),
+        'wind_dir_degrees': obs.get('winddirAvg'),
+        'precip_rate_in_hr': imperial.get('precipRate'),
+        'precip_total_in': imperial.get('precipTotal'),
+        'solar_radiation_wm2': obs.get('solarRadiationHigh'),
+        'uv_index': obs.get('uvHigh'),
+    }
+
+def slot_key(local_time):
+    """'YYYY-MM-DD HH:MM' rounded down to the collector cadence"""
+    minute = int(local_time[14:16])
+    return f"{local_time[:14]}{minute - minute % CADENCE_MINUTES:02d}"
+
+_aggregate_cache = {}
+
+def _segment_keys(path, day_str, length):
+    """Timestamp prefixes of an aggregated segment (files are cached: backfill only adds raw days)"""
+    if path not in _aggregate_cache:
+        keys = set()
+        if path.exists():
+            with log_archive.open_segment(path) as f:
+                keys = {(row.get('timestamp') or '').replace('T', ' ')[:length] for row in csv.DictReader(f)}
+        _aggregate_cache[path] = keys
+    return {key for key in _aggregate_cache[path] if key.startswith(day_str)}
+
+def covered_keys(day):
+    """Cadence slots, hours and days of `day` the archive already has"""
+    day_str = day.isoformat()
+    keys = _segment_keys(log_archive.segment_path(WEATHER_LOG, day_str[:4], 'daily'), day_str, 10)
+    keys |= _segment_keys(log_archive.segment_path(WEATHER_LOG, day_str[:7], 'hourly'), day_str, 13)
+    for path in (log_archive.segment_path(WEATHER_LOG, day_str), WEATHER_LOG):
+        if path.exists():
+            with log_archive.open_segment(path) as f:
+                keys |= {slot_key(row['obs_time_local']) for row in csv.DictReader(f)
+                         if (row.get('obs_time_local') or '').startswith(day_str)}
+    return keys
+
+def new_rows(day, observations):
+    """One row per uncovered cadence slot, earliest observation first"""
+    covered = covered_keys(day)
+    rows = {}
+    for obs in sorted(observations, key=lambda o: o.get('obsTimeLocal', '')):
+        local = obs.get('obsTimeLocal') or ''
+        if len(local) < 16:
+            continue
+        slot = slot_key(local)
+        if slot in rows or slot in covered or local[:13] in covered or local[:10] in covered:
+            continue
+        rows[slot] = observation_row(obs)
+    return list(rows.values())
+
+class Backfill:
+    """Fetches days concurrently over one session under the rate limit"""
+
+    def __init__(self, session=None):
+        if session is None:
+            session = requests.Session()
+            # One pooled keep-alive connection per concurrent day
+            session.mount('https://', requests.adapters.HTTPAdapter(pool_connections=1,
+                                                                    pool_maxsize=CONCURRENT_DAYS))
+        self.session = session
+        self.bucket = TokenBucket(RATE_PER_MINUTE / 60, BURST)
+        self.requests_made = 0
+
+    def _get(self, day):
+        return self.session.get(HISTORY_URL, params={
+            'stationId': PWS_ID, 'format': 'json', 'units': 'e', 'apiKey': API_KEY,
+            'date': day.strftime('%Y%m%d')}, timeout=REQUEST_TIMEOUT_SECONDS)
+
+    async def fetch_day(self, day):
+        """All observations of one day ([] when the station has none)"""
+        for attempt in range(MAX_RETRIES):
+            if self.requests_made >= MAX_REQUESTS_PER_RUN:
+                raise QuotaExhausted(f"{MAX_REQUESTS_PER_RUN} requests made this run")
+            await self.bucket.acquire()
+            self.requests_made += 1
+            response = await asyncio.to_thread(self._get, day)
+            if response.status_code == 204:
+                return []
+            if response.status_code == 429:
+                await asyncio.sleep(float(response.headers.get('Retry-After', 60)))
+                continue
+            if response.status_code >= 500 and attempt < MAX_RETRIES - 1:
+                await asyncio.sleep(2 ** attempt)
+                continue
+            response.raise_for_status()
+            return response.json().get('observations') or []
+        raise QuotaExhausted("rate limited by the API")
+
+def load_checkpoint(path=CHECKPOINT_FILE):
+    if not os.path.exists(path):
+        return set()
+    with open(path, 'r') as f:
+        return set(json.load(f).get('done', []))
+
+def save_checkpoint(done, path=CHECKPOINT_FILE):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump({'done': sorted(done)}, f)
+    os.replace(tmp_path, path)
+
+async def backfill(start, end, session=None, checkpoint=CHECKPOINT_FILE):
+    """
+    Backfill [start, end] (dates).
+    Returns: (days filled, rows added, days failed, stop reason or None)
+    """
+    done = load_checkpoint(checkpoint)
+    end = min(end, date.today() - timedelta(days=1))
+    days = [start + timedelta(days=i) for i in range((end - start).days + 1)]
+    queue = [day for day in days if day.isoformat() not in done]
+
+    client = Backfill(session)
+    semaphore = asyncio.Semaphore(CONCURRENT_DAYS)
+    totals = {'days': 0, 'rows': 0, 'failed': 0, 'stop': None}
+
+    async def run_day(day):
+        async with semaphore:
+            if totals['stop']:
+                return
+            try:
+                observations = await client.fetch_day(day)
+            except QuotaExhausted as e:
+                totals['stop'] = str(e)
+                return
+            except Exception as e:
+                print(f"  ✗ {day}: {e}")
+                totals['failed'] += 1
+                return
+            rows = new_rows(day, observations)
+            if rows:
+                log_archive.merge_segment_rows(WEATHER_LOG, day.isoformat(), WEATHER_FIELDS, rows)
+            done.add(day.isoformat())
+            save_checkpoint(done, checkpoint)
+            totals['days'] += 1
+            totals['rows'] += len(rows)
+
+    await asyncio.gather(*(run_day(day) for day in queue))
+    # Old days were written as raw segments; roll them into their tiers now
+    log_archive.apply_csv_retention(WEATHER_LOG, datetime.now())
+    return totals['days'], totals['rows'], totals['failed'], totals['stop']
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print(__doc__.strip().splitlines()[-1])
+        sys.exit(1)
+    try:
+        start = date.fromisoformat(sys.argv[1])
+        end = date.fromisoformat(sys.argv[2]) if len(sys.argv) > 2 else date.today() - timedelta(days=1)
+    except ValueError as e:
+        print(f"✗ Bad date: {e}")
+        sys.exit(1)
+
+    started = time.monotonic()
+    days, rows, failed, stop = asyncio.run(backfill(start, end))
+    print(f"✓ Backfilled {days} days, {rows} observations ({time.monotonic() - started:.0f}s)")
+    if failed:
+        print(f"  ✗ {failed} days failed (rerun to retry them)")
+    if stop:
+        print(f"  Paused: {stop} (rerun later to continue)")
+    sys.exit(1 if failed and not days else 0)
@@ -0,0 +1,188 @@
+#!/volume1/docker/franklin/venv311/bin/python3
+"""
+Buffered Log Writer
+Keeps one append handle per log file and collects lines in memory, so a
+log_intelligence() call is a list append instead of open/write/close
+
+Lines are written in one go, off the event loop (asyncio.to_thread) when
+one is running: when FLUSH_BYTES are buffered, FLUSH_SECONDS after the
+first buffered line, at the end of each decision cycle (flush_all) and on
+shutdown (close_all, also registered with atexit). The handle is reopened
+when log_archive.py has moved the live file aside; a file grown past
+ROLLOVER_BYTES is rotated into the archive's daily segments right away.
+"""
+import asyncio
+import atexit
+import os
+import sys
+import threading
+import time
+
+from log_archive import rotate_log
+
+FLUSH_BYTES = 16384
+FLUSH_SECONDS = 5.0
+ROLLOVER_BYTES = 20 * 1024 * 1024   # A retry storm can't grow one live log past this
+
+class BufferedLog:
+    """In-memory line buffer in front of one open append handle"""
+
+    def __init__(self, path):
+        self.path = str(path)
+        self.lines = []
+        self.size = 0
+        self.first_at = None
+        self.handle = None
+        self.lock = threading.Lock()       # The buffer swap vs. a flush in a worker thread
+        self.io_lock = threading.Lock()    # One flush at a time
+        self.flusher = None
+        self.timer = None                  # Loop TimerHandle: only touched on its loop's thread
+        self.timer_loop = None
+        self.flushes = 0
+
+    def write(self, line):
+        """Buffer one line (newline included)"""
+        with self.lock:
+            self.lines.append(line)
+            self.size += len(line)
+            if self.first_at is None:
+                self.first_at = time.monotonic()
+                self._start_timer()
+            due = self.size >= FLUSH_BYTES or time.monotonic() - self.first_at >= FLUSH_SECONDS
+        if due:
+            self.flush_soon()
+
+    def _start_timer(self):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        self.timer = loop.call_later(FLUSH_SECONDS, self.flush_soon)
+        self.timer_loop = loop
+
+    def _cancel_timer(self):
+        """Cancel the pending flush timer from any thread (on its loop's thread)"""
+        with self.lock:
+            timer, loop = self.timer, self.timer_loop
+            self.timer = self.timer_loop = None
+        if timer is None:
+            return
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is loop:
+            timer.cancel()
+            return
+        try:
+            loop.call_soon_threadsafe(timer.cancel)
+        except RuntimeError:
+            pass  # Loop already closed: the timer can't fire anymore
+
+    def flush_soon(self):
+        """Flush in a worker thread if an event loop is running, else right here"""
+        self._cancel_timer()
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            self.flush()
+            return
+        if self.flusher is None or self.flusher.done():
+            self.flusher = asyncio.ensure_future(asyncio.to_thread(self.flush))
+
+    async def aflush(self):
+        """Flush without blocking the event loop"""
+        self._cancel_timer()
+        if self.flusher is not None and not self.flusher.done():
+            await self.flusher
+        if self.lines:
+            await asyncio.to_thread(self.flush)
+
+    def _open(self):
+        """The append handle, reopened if the live file was moved aside"""
+        if self.handle is not None:
+            try:
+                if os.stat(self.path).st_ino == os.fstat(self.handle.fileno()).st_ino:
+                    return self.handle
+            except FileNotFoundError:
+                pass
+            self.handle.close()
+        self.handle = open(self.path, 'a')
+        return self.handle
+
+    def flush(self):
+        """Write everything buffered in one write (safe in a worker thread; leaves the timer alone)"""
+        with self.lock:
+            lines, self.lines = self.lines, []
+            self.size = 0
+            self.first_at = None
+        if not lines:
+            return
+        with self.io_lock:
+            handle = self._open()
+            handle.write(''.join(lines))
+            handle.flush()
+            self.flushes += 1
+            if handle.tell() >= ROLLOVER_BYTES:
+                handle.close()
+                self.handle = None
+                rotate_log(self.path)
+
+    def close(self):
+        self._cancel_timer()
+        self.flush()
+        if self.handle is not None:
+            self.handle.close()
+            self.handle = None
+
+_logs = {}
+
+def get_log(path):
+    """Process-wide buffered log for a path"""
+    if str(path) not in _logs:
+        _logs[str(path)] = BufferedLog(path)
+    return _logs[str(path)]
+
+async def flush_all():
+    """Flush every buffered log off the event loop"""
+    for log in list(_logs.values()):
+        await log.aflush()
+
+@atexit.register
+def close_all():
+    """Flush and close every buffered log"""
+    for log in list(_logs.values()):
+        try:
+            log.close()
+        except Exception as e:
+            print(f"✗ Could not flush {log.path}: {e}", file=sys.stderr)
+
+if __name__ == "__main__":
+    import tempfile
+
+    # Self-check: a retry storm is one write, the file survives rotation, nothing is lost on exit
+    async def storm(log):
+        for i in range(50):
+            log.write(f"2026-01-01 12:00:00 - Attempt {i + 1} failed\n")
+        await flush_all()
+        os.replace(log.path, log.path + '.moved')
+        log.write("2026-01-01 12:00:01 - after rotation\n")
+        await flush_all()
+
+    with tempfile.TemporaryDirectory() as directory:
+        log = get_log(os.path.join(directory, 'solar_intelligence.log'))
+        started = time.perf_counter()
+        asyncio.run(storm(log))
+        elapsed = time.perf_counter() - started
+        log.write("2026-01-01 12:00:02 - buffered at shutdown\n")
+        close_all()
+        with open(log.path + '.moved') as f:
+            moved = len(f.readlines())
+        with open(log.path) as f:
+            live = len(f.readlines())
+
+    if moved != 50 or live != 2 or log.flushes != 3:
+        print(f"✗ Buffered log self-check failed (moved {moved}, live {live}, flushes {log.flushes})")
+        sys.exit(1)
+    print(f"✓ Buffered log self-check passed (51 lines in 2 writes, {elapsed * 1000:.1f} ms)")
+    sys.exit(0)
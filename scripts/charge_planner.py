@@ -0,0 +1,276 @@
+#!/volume1/docker/franklin/venv311/bin/python3
+"""
+Charge Planner - Minimum-Cost Schedule Up to the Next Peak
+Plans every 15-minute slot until peak at once instead of re-deciding
+greedily from a single snapshot each cycle
+
+Dynamic programming over time slots x SOC: each slot is either TOU
+(solar-first, the battery covers home load solar doesn't) or BACKUP (grid
+charge, the grid covers it). Cost is the grid energy bought at
+the tariff calendar's price for that slot, the peak price for every %
+still missing from the target when peak starts, and a small penalty per
+mode switch, which is what stops the flip-flopping on cloudy days. The plan is cached in the
+history store; later cycles only look up their slot, and the remaining
+horizon is replanned when SOC or solar drift too far from the plan.
+"""
+import json
+import math
+import sys
+from datetime import datetime, timedelta
+
+import numpy as np
+
+import history_store
+
+# ⚠️ SET TO YOUR SYSTEM (prices come from the tariff calendar)
+BATTERY_CAPACITY_KWH = 30.0
+
+SLOT_MINUTES = 15
+SOC_GRID = np.linspace(0.0, 100.0, 201)   # 0.5% steps
+SWITCH_PENALTY = 0.05     # $ per mode switch: a few cents of savings isn't worth a flip
+
+# Replan the remaining slots when observations leave these tolerances
+SOC_TOLERANCE = 5.0              # % away from the SOC the plan expected
+SOLAR_TOLERANCE_KW = 1.0         # kW away from the forecast for this slot...
+SOLAR_TOLERANCE_FRACTION = 0.5   # ...or this share of the forecast, whichever is larger
+SOLAR_SMOOTHING_MINUTES = 30     # Solar is compared as the mean over this many minutes
+
+# Solar and home load forecasts: mean per slot of day over recent days
+FORECAST_DAYS = 14
+MAX_FORECAST_SCALE = 1.5
+
+MODES = ("TOU", "BACKUP")
+
+def slot_of_day(timestamp):
+    """Index of the 15-minute slot of the day a time falls in"""
+    return (timestamp.hour * 60 + timestamp.minute) // SLOT_MINUTES
+
+def slot_profiles(conn, now, days=FORECAST_DAYS):
+    """Mean (solar kW, home load kW) for each slot of the day over the last `days` days (0 where unknown)"""
+    readings = history_store.readings_between(conn, now - timedelta(days=days), now)
+    slots_per_day = 24 * 60 // SLOT_MINUTES
+    profiles = []
+    for field in ('solar_kw', 'home_load_kw'):
+        totals = np.zeros(slots_per_day)
+        counts = np.zeros(slots_per_day)
+        for reading in readings:
+            value = getattr(reading, field)
+            if value is None:
+                continue
+            slot = slot_of_day(datetime.strptime(reading.timestamp, '%Y-%m-%d %H:%M:%S'))
+            totals[slot] += value
+            counts[slot] += 1
+        profiles.append(np.divide(totals, counts, out=np.zeros(slots_per_day), where=counts > 0))
+    return profiles
+
+def recent_solar(conn, now, solar_kw, minutes=SOLAR_SMOOTHING_MINUTES):
+    """Mean of the stored solar readings of the last `minutes` and the current one"""
+    readings = history_store.readings_between(conn, now - timedelta(minutes=minutes), now)
+    values = [reading.solar_kw for reading in readings if reading.solar_kw is not None]
+    return (sum(values) + solar_kw) / (len(values) + 1)
+
+def forecast_solar(profile, slot_starts, observed_kw):
+    """
+    Solar forecast for each slot: the recent profile, scaled by how today's
+    current production compares with the profile for the current slot.
+    """
+    expected_now = profile[slot_of_day(slot_starts[0])]
+    scale = 1.0
+    if expected_now > 0.1:
+        scale = min(max(observed_kw / expected_now, 0.0), MAX_FORECAST_SCALE)
+    forecast = np.array([profile[slot_of_day(start)] for start in slot_starts]) * scale
+    # Whatever the profile says, the current slot produces what we observe
+    forecast[0] = observed_kw
+    return forecast
+
+def grid_soc_after(site, charge_model=None, temp_f=None):
+    """
+    SOC after one slot of grid charging from each SOC_GRID point: the
+    learned curve of charge_model (charge_rate.py) or the constant rate.
+    """
+    hours = SLOT_MINUTES / 60
+    if charge_model is None:
+        return np.minimum(SOC_GRID + site.charge_rate_per_hour * hours, 100.0)
+    return np.array([charge_model.soc_after(soc, hours, site.charge_rate_per_hour, temp_f) for soc in SOC_GRID])
+
+def plan_schedule(soc, solar_kw, prices, peak_price, site, solar_soc_per_kw_hour, current_mode=None,
+                  grid_soc=None, load_kw=None):
+    """
+    Minimum-cost mode per slot.
+    solar_kw, prices and load_kw (home load, default none) are per-slot
+    arrays; the plan must reach the target by the end of the last slot,
+    any shortfall costs peak_price. Solar covers the load first; in TOU
+    the battery supplies the rest, in BACKUP the grid does.
+    grid_soc is grid_soc_after()'s curve (default: the constant rate).
+    Returns: (modes, expected SOC at the start of each slot, expected cost)
+    """
+    slot_hours = SLOT_MINUTES / 60
+    slots = len(solar_kw)
+    net_kw = np.asarray(solar_kw, dtype=float).clip(min=0)
+    if load_kw is not None:
+        net_kw = net_kw - np.asarray(load_kw, dtype=float).clip(min=0)
+    solar_gain = net_kw.clip(min=0) * solar_soc_per_kw_hour * slot_hours
+    load_kwh = (-net_kw).clip(min=0) * slot_hours
+    load_drain = load_kwh / BATTERY_CAPACITY_KWH * 100
+    if grid_soc is None:
+        grid_soc = grid_soc_after(site)
+
+    # Value of each (SOC, mode of the previous slot) at the end of the horizon
+    shortfall = np.clip(site.target_soc - SOC_GRID, 0, None)
+    value = np.repeat((shortfall / 100 * BATTERY_CAPACITY_KWH * peak_price)[:, None], 2, axis=1)
+    values = [value]
+
+    def step(t, soc_values, next_value):
+        """Cost of TOU and of BACKUP for this slot from each SOC, switch penalty excluded"""
+        tou_soc = np.clip(soc_values + solar_gain[t] - load_drain[t], 0.0, 100.0)
+        backup_soc = np.minimum(np.maximum(np.interp(soc_values, SOC_GRID, grid_soc), soc_values + solar_gain[t]),
+                                100.0)
+        grid_kwh = (np.clip(backup_soc - soc_values - solar_gain[t], 0, None) / 100 * BATTERY_CAPACITY_KWH
+                    + load_kwh[t])
+        tou = np.interp(tou_soc, SOC_GRID, next_value[:, 0])
+        backup = grid_kwh * prices[t] + np.interp(backup_soc, SOC_GRID, next_value[:, 1])
+        return tou, backup, tou_soc, backup_soc
+
+    # Backward pass
+    for t in range(slots - 1, -1, -1):
+        tou, backup, _, _ = step(t, SOC_GRID, values[0])
+        value = np.empty((len(SOC_GRID), 2))
+        value[:, 0] = np.minimum(tou, backup + SWITCH_PENALTY)   # previous slot was TOU
+        value[:, 1] = np.minimum(tou + SWITCH_PENALTY, backup)   # previous slot was BACKUP
+        values.insert(0, value)
+
+    # Forward pass from the actual SOC
+    modes, expected = [], []
+    previous = MODES.index(current_mode) if current_mode in MODES else 0
+    soc = float(soc)
+    cost = 0.0
+    for t in range(slots):
+        tou, backup, tou_soc, backup_soc = step(t, np.array([soc]), values[t + 1])
+        tou_total = tou[0] + (SWITCH_PENALTY if previous == 1 else 0)
+        backup_total = backup[0] + (SWITCH_PENALTY if previous == 0 else 0)
+        choice = 1 if backup_total < tou_total else 0
+        if t == 0:
+            cost = min(tou_total, backup_total)
+        modes.append(MODES[choice])
+        expected.append(round(soc, 2))
+        soc = float(backup_soc[0] if choice else tou_soc[0])
+        previous = choice
+    return modes, expected, cost
+
+def build_plan(conn, now, soc, solar_kw, hours_to_peak, site, calendar, solar_soc_per_kw_hour,
+               current_mode=None, grid_soc=None):
+    """Plan the slots from now until the target must be reached; None if no time is left"""
+    # Aim to be done SAFETY_MARGIN_HOURS before peak, like the scalar rule
+    horizon_hours = hours_to_peak - site.safety_margin_hours
+    slots = int(horizon_hours * 60 // SLOT_MINUTES)
+    if slots < 1:
+        return None
+
+    first = now.replace(minute=now.minute - now.minute % SLOT_MINUTES, second=0, microsecond=0)
+    slot_starts = [first + timedelta(minutes=SLOT_MINUTES * i) for i in range(slots)]
+    solar_by_slot, load_by_slot = slot_profiles(conn, now)
+    solar = forecast_solar(solar_by_slot, slot_starts, solar_kw)
+    load = np.array([load_by_slot[slot_of_day(start)] for start in slot_starts])
+    prices = calendar.prices_for(slot_starts)
+    peak_start = now + timedelta(hours=hours_to_peak)
+
+    modes, expected, cost = plan_schedule(soc, solar, prices, calendar.price_at(peak_start), site,
+                                          solar_soc_per_kw_hour, current_mode, grid_soc, load)
+    return {
+        'created': now.strftime('%Y-%m-%d %H:%M:%S'),
+        'peak': peak_start.strftime('%Y-%m-%d %H:%M'),
+        'cost': round(cost, 2),
+        'slots': [[start.strftime('%Y-%m-%d %H:%M'), mode, soc_start, round(float(kw), 3), round(float(load_kw), 3)]
+                  for start, mode, soc_start, kw, load_kw in zip(slot_starts, modes, expected, solar, load)],
+    }
+
+def find_slot(plan, now):
+    """The plan's slot covering now, or None"""
+    key = now.strftime('%Y-%m-%d %H:%M')
+    current = None
+    for slot in plan['slots']:
+        if slot[0] > key:
+            break
+        current = slot
+    if current is None:
+        return None
+    end = datetime.strptime(current[0], '%Y-%m-%d %H:%M') + timedelta(minutes=SLOT_MINUTES)
+    return current if now < end else None
+
+def replan_reason(plan, slot, now, soc, solar_kw, hours_to_peak):
+    """
+    Why the cached plan can't be used for this cycle, or None if it can.
+    solar_kw should be smoothed (recent_solar()): one cloud isn't a new day.
+    """
+    if plan is None:
+        return "no plan"
+    if plan['peak'] != (now + timedelta(hours=hours_to_peak)).strftime('%Y-%m-%d %H:%M'):
+        return "new peak period"
+    if slot is None:
+        return "outside plan"
+    if abs(soc - slot[2]) > SOC_TOLERANCE:
+        return f"SOC {soc:.1f}% vs planned {slot[2]:.1f}%"
+    if abs(solar_kw - slot[3]) > max(SOLAR_TOLERANCE_KW, SOLAR_TOLERANCE_FRACTION * slot[3]):
+        return f"solar {solar_kw:.2f}kW vs forecast {slot[3]:.2f}kW"
+    return None
+
+def plan_decision(conn, soc, solar_kw, hours_to_peak, site, calendar, solar_soc_per_kw_hour,
+                  current_mode=None, grid_soc=None):
+    """
+    Grid charge or not for the current slot, from the cached plan
+    (replanning the remaining horizon first if needed).
+    grid_soc: grid-charge curve for replanning (grid_soc_after()).
+    Returns: (should_charge, reason), or None when there is nothing left to plan
+    """
+    if math.isinf(hours_to_peak):
+        return None  # No peak period ahead in the tariff calendar
+    now = datetime.now()
+    stored = history_store.get_state(conn, 'charge_plan')
+    plan = json.loads(stored) if stored else None
+    slot = find_slot(plan, now) if plan else None
+
+    why = replan_reason(plan, slot, now, soc, recent_solar(conn, now, solar_kw), hours_to_peak)
+    if why:
+        plan = build_plan(conn, now, soc, solar_kw, hours_to_peak, site, calendar,
+                          solar_soc_per_kw_hour, current_mode, grid_soc)
+        if plan is None:
+            return None
+        with conn:
+            history_store.set_state(conn, 'charge_plan', json.dumps(plan))
+        slot = plan['slots'][0]
+
+    charge_slots = [s for s in plan['slots'] if s[1] == "BACKUP" and s[0] >= slot[0]]
+    summary = f"{len(charge_slots)} grid-charge slots left, plan cost ${plan['cost']:.2f}"
+    if why:
+        summary += f", replanned: {why}"
+    if slot[1] == "BACKUP":
+        return True, f"Plan: grid charge this slot ({summary})"
+    return False, f"Plan: solar-first this slot ({summary})"
+
+if __name__ == "__main__":
+    import charge_rate
+    from smart_decision import (DEFAULT_SITE, HISTORY_DB, LEARN_CHARGE_RATE, SOLAR_EFFICIENCY,
+                                SOLAR_SOC_PER_KW_HOUR, calculate_time_to_peak, site_calendar)
+
+    conn = history_store.connect(HISTORY_DB)
+    latest = history_store.latest_reading(conn)
+    if latest is None:
+        print("✗ No readings in the history store")
+        sys.exit(1)
+
+    now = datetime.now()
+    model = None
+    if LEARN_CHARGE_RATE:
+        model = charge_rate.ChargeRateModel.from_json(history_store.get_state(conn, charge_rate.STATE_KEY))
+    plan = build_plan(conn, now, latest.soc_percent, latest.solar_kw or 0.0,
+                      calculate_time_to_peak(), DEFAULT_SITE, site_calendar(),
+                      SOLAR_EFFICIENCY * SOLAR_SOC_PER_KW_HOUR,
+                      grid_soc=grid_soc_after(DEFAULT_SITE, model, charge_rate.latest_temperature(now)))
+    conn.close()
+    if plan is None:
+        print("✓ Too close to peak to plan")
+        sys.exit(0)
+    print(f"Plan to peak at {plan['peak']} from {latest.soc_percent:.1f}% SOC (cost ${plan['cost']:.2f}):")
+    for start, mode, soc, solar, load in plan['slots']:
+        print(f"  {start}  {mode:6}  SOC {soc:5.1f}%  solar {solar:.2f}kW  load {load:.2f}kW")
+    sys.exit(0)
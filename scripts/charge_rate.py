@@ -0,0 +1,205 @@
+#!/volume1/docker/franklin/venv311/bin/python3
+"""
+Charge Rate Estimator - Grid-Charge Speed Learned From Telemetry
+Replaces the single CHARGE_RATE_PER_HOUR with a piecewise SOC-rate curve,
+so hours_needed_grid accounts for the taper above ~90% SOC
+
+Every pair of consecutive readings taken in BACKUP mode (no more than
+MAX_STEP_MINUTES apart, little solar) is one rate sample for the SOC band
+it spans, and optionally for the outdoor temperature band from
+weather_data.csv. Each band keeps a count and a running average (a plain
+mean at first, an EWMA once it has MIN_ALPHA worth of samples, so it
+follows the battery as it ages); an update is O(1) and the whole model is
+one small JSON state value in the history store. Time to target adds up
+band widths over band rates: at most len(SOC_BAND_EDGES) steps, no refit.
+
+smart_decision.py updates the model every cycle and hands it to
+charge_planner.py, whose grid-charge slots follow the same curve. Run with --seed once to
+learn from the existing monitoring history; run without arguments to
+print the learned curve.
+"""
+import bisect
+import json
+import sys
+from datetime import datetime, timedelta
+
+from log_archive import WEATHER_LOG, read_rows
+
+# SOC bands (%): finer near the top, where charging tapers
+SOC_BAND_EDGES = (0, 50, 70, 80, 85, 90, 93, 96, 98, 100)
+# Outdoor temperature bands (°F); () ignores temperature
+TEMPERATURE_BANDS_F = (40, 60, 80, 95)
+
+MAX_STEP_MINUTES = 30       # Longer gaps between readings aren't rate samples
+MAX_SOLAR_KW = 0.5          # Solar above this would be counted as grid charge rate
+MIN_SAMPLES = 4             # A band needs this many samples before it's used
+MIN_ALPHA = 0.05            # Running average turns into an EWMA after 1/MIN_ALPHA samples
+MIN_RATE_PER_HOUR = 1.0     # Floor for lookups, so a stalled band can't mean "never"
+
+STATE_KEY = 'charge_rate_model'
+
+def soc_band(soc):
+    """Index of the SOC band containing soc"""
+    return min(max(bisect.bisect_right(SOC_BAND_EDGES, soc) - 1, 0), len(SOC_BAND_EDGES) - 2)
+
+def temperature_band(temp_f):
+    """Index of the temperature band, or None when unknown or not used"""
+    if temp_f is None or not TEMPERATURE_BANDS_F:
+        return None
+    return bisect.bisect_right(TEMPERATURE_BANDS_F, temp_f)
+
+def latest_temperature(now):
+    """Most recent outdoor temperature within the last hour, or None"""
+    latest = None
+    for row in read_rows(WEATHER_LOG, since=now - timedelta(hours=1)):
+        try:
+            latest = float(row['temp_f'])
+        except (KeyError, TypeError, ValueError):
+            continue
+    return latest
+
+class ChargeRateModel:
+    """Per-band grid-charge rates (SOC % per hour)"""
+
+    def __init__(self, state=None):
+        state = state or {}
+        bands = len(SOC_BAND_EDGES) - 1
+        self.last = state.get('last')              # [timestamp, soc, mode]
+        # 'all' ignores temperature; '0'.. are temperature bands
+        self.bands = state.get('bands', {'all': [[0, 0.0] for _ in range(bands)]})
+
+    def to_json(self):
+        return json.dumps({'last': self.last, 'bands': self.bands}, separators=(',', ':'))
+
+    @classmethod
+    def from_json(cls, text):
+        return cls(json.loads(text) if text else None)
+
+    def _row(self, key):
+        if key not in self.bands:
+            self.bands[key] = [[0, 0.0] for _ in range(len(SOC_BAND_EDGES) - 1)]
+        return self.bands[key]
+
+    def learn(self, soc, rate, temp_f=None):
+        """Add one rate sample at the given SOC"""
+        band = soc_band(soc)
+        keys = ['all']
+        if temperature_band(temp_f) is not None:
+            keys.append(str(temperature_band(temp_f)))
+        for key in keys:
+            stats = self._row(key)[band]
+            stats[0] += 1
+            stats[1] += max(1.0 / stats[0], MIN_ALPHA) * (rate - stats[1])
+
+    def observe(self, now, soc, mode, solar_kw=None, temp_f=None, interval_mode=None):
+        """
+        Update with one reading; mode is what the gateway is in now.
+        interval_mode, when known, is the mode it was in since the last
+        reading (replaces requiring BACKUP at both ends).
+        Returns: the rate sample learned, or None
+        """
+        rate = None
+        if interval_mode is None:
+            charging = self.last and self.last[2] == "BACKUP" and mode == "BACKUP"
+        else:
+            charging = interval_mode == "BACKUP"
+        if self.last and charging and (solar_kw or 0.0) <= MAX_SOLAR_KW:
+            minutes = (now - datetime.strptime(self.last[0], '%Y-%m-%d %H:%M:%S')).total_seconds() / 60
+            start = self.last[1]
+            if 0 < minutes <= MAX_STEP_MINUTES and soc >= start and start < SOC_BAND_EDGES[-1]:
+                rate = (soc - start) / (minutes / 60)
+                self.learn((start + soc) / 2, rate, temp_f)
+        self.last = [now.strftime('%Y-%m-%d %H:%M:%S'), soc, mode]
+        return rate
+
+    def rate(self, soc, temp_f=None, default_rate=None):
+        """Learned rate at this SOC (temperature band first), or default_rate"""
+        band = soc_band(soc)
+        keys = ['all']
+        if temperature_band(temp_f) is not None:
+            keys.insert(0, str(temperature_band(temp_f)))
+        for key in keys:
+            count, value = self.bands.get(key, [[0, 0.0]] * (len(SOC_BAND_EDGES) - 1))[band]
+            if count >= MIN_SAMPLES:
+                return max(value, MIN_RATE_PER_HOUR)
+        return default_rate
+
+    def hours_to_target(self, soc, target, default_rate, temp_f=None):
+        """Grid-charge hours from soc to target, band by band"""
+        hours = 0.0
+        low = soc
+        while low < target:
+            band = soc_band(low)
+            high = min(target, SOC_BAND_EDGES[band + 1])
+            if high <= low:
+                break
+            hours += (high - low) / self.rate(low, temp_f, default_rate)
+            low = high
+        return hours
+
+    def soc_after(self, soc, hours, default_rate, temp_f=None):
+        """SOC reached after grid charging for `hours` from soc, band by band"""
+        while hours > 0 and soc < SOC_BAND_EDGES[-1]:
+            rate = self.rate(soc, temp_f, default_rate)
+            high = SOC_BAND_EDGES[soc_band(soc) + 1]
+            if (high - soc) / rate >= hours:
+                return soc + rate * hours
+            hours -= (high - soc) / rate
+            soc = high
+        return min(soc, SOC_BAND_EDGES[-1])
+
+def seed_from_history(model, live_path, since=None):
+    """
+    Learn from every reading in the monitoring history, oldest first.
+    A row's mode column is the decision taken after that reading, so each
+    interval is labelled with the previous row's mode.
+    """
+    from readings import iter_column_chunks, iter_readings
+
+    temperatures = []
+    for row in read_rows(WEATHER_LOG, since=since):
+        try:
+            temperatures.append((row['timestamp'].replace('T', ' ')[:19], float(row['temp_f'])))
+        except (KeyError, TypeError, ValueError):
+            continue
+    temperatures.sort()
+    stamps = [stamp for stamp, _ in temperatures]
+
+    learned = 0
+    previous_mode = ''
+    for columns in iter_column_chunks(live_path, since):
+        for reading in iter_readings(columns):
+            if reading.soc_percent is None:
+                continue
+            i = bisect.bisect_right(stamps, reading.timestamp) - 1
+            temp_f = temperatures[i][1] if i >= 0 else None
+            now = datetime.strptime(reading.timestamp, '%Y-%m-%d %H:%M:%S')
+            if model.observe(now, reading.soc_percent, reading.mode, reading.solar_kw, temp_f,
+                             interval_mode=previous_mode) is not None:
+                learned += 1
+            previous_mode = reading.mode or ''
+    return learned
+
+if __name__ == "__main__":
+    import history_store
+    from smart_decision import CHARGE_RATE_PER_HOUR, HISTORY_DB, LOG_FILE, TARGET_SOC
+
+    conn = history_store.connect(HISTORY_DB)
+    model = ChargeRateModel.from_json(history_store.get_state(conn, STATE_KEY))
+    if '--seed' in sys.argv:
+        model = ChargeRateModel()
+        learned = seed_from_history(model, LOG_FILE)
+        with conn:
+            history_store.set_state(conn, STATE_KEY, model.to_json())
+        print(f"✓ Learned {learned} rate samples from the monitoring history")
+    conn.close()
+
+    print(f"{'SOC band':>10}  {'samples':>7}  {'%/hour':>7}")
+    for band, (count, value) in enumerate(model.bands['all']):
+        label = f"{SOC_BAND_EDGES[band]}-{SOC_BAND_EDGES[band + 1]}%"
+        print(f"{label:>10}  {count:>7}  {value if count >= MIN_SAMPLES else CHARGE_RATE_PER_HOUR:>7.1f}")
+    for start in (20, 50, 80, 90):
+        hours = model.hours_to_target(start, TARGET_SOC, CHARGE_RATE_PER_HOUR)
+        print(f"  {start}% → {TARGET_SOC:.0f}%: {hours:.2f}h (constant rate: "
+              f"{(TARGET_SOC - start) / CHARGE_RATE_PER_HOUR:.2f}h)")
+    sys.exit(0)
@@ -16,6 +16,15 @@ API_KEY = "YOUR_WEATHER_UNDERGROUND_API_KEY"
 LOG_DIR = Path("/volume1/docker/franklin/logs")
 WEATHER_LOG = LOG_DIR / "weather_data.csv"
 
+WEATHER_FIELDS = [
+    'timestamp', 'obs_time_local', 'station_id', 'neighborhood',
+    'temp_f', 'heat_index_f', 'dewpoint_f', 'wind_chill_f',
+    'humidity', 'pressure_inhg',
+    'wind_speed_mph', 'wind_gust_mph', 'wind_dir_degrees',
+    'precip_rate_in_hr', 'precip_total_in',
+    'solar_radiation_wm2', 'uv_index'
+]
+
 def get_current_conditions():
     """Get current weather conditions from Weather Underground"""
     url = "https://api.weather.com/v2/pws/observations/current"
@@ -77,18 +86,9 @@ def save_to_csv(weather_data):
     WEATHER_LOG.parent.mkdir(parents=True, exist_ok=True)
     file_exists = WEATHER_LOG.exists()
 
-    fieldnames = [
-        'timestamp', 'obs_time_local', 'station_id', 'neighborhood',
-        'temp_f', 'heat_index_f', 'dewpoint_f', 'wind_chill_f',
-        'humidity', 'pressure_inhg',
-        'wind_speed_mph', 'wind_gust_mph', 'wind_dir_degrees',
-        'precip_rate_in_hr', 'precip_total_in',
-        'solar_radiation_wm2', 'uv_index'
-    ]
-
     try:
         with open(WEATHER_LOG, 'a', newline='') as f:
-            writer = csv.DictWriter(f, fieldnames=fieldnames)
+            writer = csv.DictWriter(f, fieldnames=WEATHER_FIELDS)
             if not file_exists:
                 writer.writeheader()
             writer.writerow(weather_data)
@@ -4,8 +4,15 @@ Daily Battery Status Report
 Sends summary of the day's solar intelligence decisions and current status
 Runs at 10:15 PM after peak period ends
 """
+import asyncio
 import subprocess
 from datetime import datetime, timedelta
+import history_store
+from notifier import Notice, Notifier
+from smart_decision import site_calendar
+
+# Also email the report (once per day; SMTP settings are in notifier.py)
+EMAIL_REPORT = False
 
 def get_battery_status():
     """Get current battery status"""
@@ -22,36 +29,25 @@ def get_battery_status():
 
 def get_todays_energy_summary():
     """Get today's energy flow summary from continuous monitoring"""
-    today = datetime.now().strftime("%Y-%m-%d")
+    today_start = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
     try:
-        result = subprocess.run(
-            ['grep', today, '/volume1/docker/franklin/logs/continuous_monitoring.csv'],
-            capture_output=True,
-            text=True
-        )
-
-        lines = result.stdout.strip().split('\n')
-        if not lines or lines[0] == '':
-            return "No monitoring data available for today."
-
         # Parse data to get summary
         soc_values = []
         solar_values = []
         grid_values = []
         battery_values = []
 
-        for line in lines:
-            if not line or 'timestamp' in line:
+        conn = history_store.connect()
+        readings = history_store.readings_between(conn, since=today_start)
+        conn.close()
+
+        for reading in readings:
+            if None in (reading.soc_percent, reading.solar_kw, reading.grid_kw, reading.battery_kw):
                 continue
-            parts = line.split(',')
-            if len(parts) >= 5:
-                try:
-                    soc_values.append(float(parts[1]))
-                    solar_values.append(float(parts[2]))
-                    grid_values.append(float(parts[3]))
-                    battery_values.append(float(parts[4]))
-                except:
-                    continue
+            soc_values.append(reading.soc_percent)
+            solar_values.append(reading.solar_kw)
+            grid_values.append(reading.grid_kw)
+            battery_values.append(reading.battery_kw)
 
         if soc_values:
             summary = f"""
@@ -81,8 +77,8 @@ Today's Energy Summary (based on {len(soc_values)} readings):
 def get_five_day_performance():
     """Get rolling 5-day performance table"""
     try:
-        with open('/volume1/docker/franklin/logs/solar_intelligence.log', 'r') as f:
-            lines = f.readlines()
+        conn = history_store.connect()
+        calendar = site_calendar()
         
         # Get last 5 days including today
         days = []
@@ -96,53 +92,50 @@ def get_five_day_performance():
             day_data = {
                 'date': date,
                 'grid_charge_times': [],
-                'soc_445pm': 'N/A',
+                'soc_pre_peak': 'N/A',
                 'mode_switches': 0,
                 'peak_protection': 'OK'
             }
             
             # Get mode switches (grid charge start times and count)
-            for line in lines:
-                if date in line:
-                    if 'Mode changed: TOU → BACKUP' in line:
-                        time = line.split()[1]  # Extract HH:MM:SS
-                        day_data['grid_charge_times'].append(time[:5])  # HH:MM only
-                    if 'Mode changed' in line:
-                        day_data['mode_switches'] += 1
+            changes = history_store.mode_changes_between(conn, f"{date} 00:00:00", f"{date} 23:59:59")
+            for change in changes:
+                if change.from_mode == 'TOU' and change.to_mode == 'BACKUP':
+                    day_data['grid_charge_times'].append(change.timestamp[11:16])  # HH:MM only
+            day_data['mode_switches'] = len(changes)
             
-            # Get SOC at 4:45 PM
-            target_time = f"{date} 16:45"
-            for line in lines:
-                if target_time in line and 'SOC:' in line:
-                    # Extract SOC value from line like "SOC: 97.4%, Solar: ..."
-                    try:
-                        soc_part = line.split('SOC:')[1].split('%')[0].strip()
-                        day_data['soc_445pm'] = f"{soc_part}%"
-                    except:
-                        pass
+            # Get SOC 15 minutes before the day's first peak period
+            day_start = datetime.strptime(date, "%Y-%m-%d")
+            peaks = calendar.peak_windows(day_start, day_start + timedelta(days=1))
+            if peaks:
+                pre_peak = peaks[0][0] - timedelta(minutes=15)
+                readings = history_store.readings_between(conn, pre_peak, pre_peak + timedelta(seconds=59))
+                if readings and readings[-1].soc_percent is not None:
+                    day_data['soc_pre_peak'] = f"{readings[-1].soc_percent:.1f}%"
             
-            # Check for peak violations (mode changes during 5-8 PM)
-            peak_violations = [l for l in lines if date in l and 
-                             any(f"{date} {h}:" in l for h in ['17:', '18:', '19:']) and
-                             'SWITCHING' in l]
+            # Check for peak violations (mode changes during a peak period)
+            peak_violations = [c for c in changes
+                               if calendar.is_peak(datetime.strptime(c.timestamp, "%Y-%m-%d %H:%M:%S"))]
             if peak_violations:
                 day_data['peak_protection'] = 'FAIL'
             
             performance.append(day_data)
         
+        conn.close()
+        
         # Build table (newest first)
         performance.reverse()
         
         table = """
 ROLLING 5-DAY PERFORMANCE:
 --------------------------------------------------------------------------------
-Date       | Grid Charge Start | SOC@4:45PM | Switches | Peak | Notes
+Date       | Grid Charge Start | PrePeakSOC | Switches | Peak | Notes
 -----------|-------------------|------------|----------|------|------------------"""
         
         for day in performance:
             date_str = day['date']
             charges = ', '.join(day['grid_charge_times']) if day['grid_charge_times'] else 'None'
-            soc = day['soc_445pm']
+            soc = day['soc_pre_peak']
             switches = str(day['mode_switches'])
             peak = day['peak_protection']
             
@@ -170,16 +163,14 @@ Date       | Grid Charge Start | SOC@4:45PM | Switches | Peak | Notes
 
 def get_todays_mode_switches():
     """Get today's mode switches only (not full decision log)"""
-    today = datetime.now().strftime("%Y-%m-%d")
+    today_start = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
     try:
-        with open('/volume1/docker/franklin/logs/solar_intelligence.log', 'r') as f:
-            lines = f.readlines()
+        conn = history_store.connect()
+        changes = history_store.mode_changes_between(conn, since=today_start)
+        conn.close()
 
-        # Filter for today's mode switch events
-        switch_lines = []
-        for line in lines:
-            if line.startswith(today) and ('SWITCHING' in line or 'Mode changed' in line):
-                switch_lines.append(line.strip())
+        # Format today's mode switch events like the intelligence log
+        switch_lines = [f"{c.timestamp} - Mode changed: {c.from_mode} → {c.to_mode}" for c in changes]
 
         if switch_lines:
             return '\n'.join(switch_lines)
@@ -191,20 +182,20 @@ def get_todays_mode_switches():
 
 def get_peak_summary():
     """Get peak period summary for today"""
-    today = datetime.now().strftime("%Y-%m-%d")
+    today_start = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
     try:
-        with open('/volume1/docker/franklin/logs/solar_intelligence.log', 'r') as f:
-            lines = f.readlines()
+        conn = history_store.connect()
+        transitions = history_store.peak_transitions_between(conn, since=today_start)
+        conn.close()
         
         peak_start = None
         peak_end = None
         
-        for line in lines:
-            if today in line:
-                if 'Peak period started' in line:
-                    peak_start = line.split()[1]  # Get time
-                if 'Peak period ended' in line:
-                    peak_end = line.split()[1]  # Get time
+        for transition in transitions:
+            if transition.state.startswith('Peak-'):
+                peak_start = transition.timestamp[11:]  # Get time
+            elif peak_start:
+                peak_end = transition.timestamp[11:]  # Get time
         
         if peak_start and peak_end:
             return f"Peak period: {peak_start} - {peak_end} (completed)"
@@ -216,44 +207,58 @@ def get_peak_summary():
     except Exception as e:
         return f"ERROR reading peak summary: {e}"
 
-def main():
-    print("="*80)
-    print("FRANKLIN BATTERY - DAILY STATUS REPORT")
-    print(f"Generated: {datetime.now().strftime('%Y-%m-%d %I:%M %p')}")
-    print("="*80)
-    print()
-
-    # Current battery status
-    print("CURRENT BATTERY STATUS:")
-    print("-"*80)
-    print(get_battery_status())
-    print()
-
-    # Today's energy summary
-    print("TODAY'S ENERGY SUMMARY:")
-    print("-"*80)
-    print(get_todays_energy_summary())
-    print()
-
-    # 5-day performance table
-    print(get_five_day_performance())
-    print()
+def build_report():
+    """Assemble the full report text"""
+    sections = [
+        "="*80,
+        "FRANKLIN BATTERY - DAILY STATUS REPORT",
+        f"Generated: {datetime.now().strftime('%Y-%m-%d %I:%M %p')}",
+        "="*80,
+        "",
+        # Current battery status
+        "CURRENT BATTERY STATUS:",
+        "-"*80,
+        get_battery_status(),
+        "",
+        # Today's energy summary
+        "TODAY'S ENERGY SUMMARY:",
+        "-"*80,
+        get_todays_energy_summary(),
+        "",
+        # 5-day performance table
+        get_five_day_performance(),
+        "",
+        # Peak period summary
+        "TODAY'S PEAK PERIOD:",
+        "-"*80,
+        get_peak_summary(),
+        "",
+        # Today's mode switches (not full log)
+        "TODAY'S MODE SWITCHES:",
+        "-"*80,
+        get_todays_mode_switches(),
+        "",
+        "="*80,
+        "End of Report",
+        "="*80,
+    ]
+    return '\n'.join(sections)
 
-    # Peak period summary
-    print("TODAY'S PEAK PERIOD:")
-    print("-"*80)
-    print(get_peak_summary())
-    print()
-
-    # Today's mode switches (not full log)
-    print("TODAY'S MODE SWITCHES:")
-    print("-"*80)
-    print(get_todays_mode_switches())
-    print()
+def main():
+    report = build_report()
+    print(report)
 
-    print("="*80)
-    print("End of Report")
-    print("="*80)
+    if EMAIL_REPORT:
+        today = datetime.now().strftime('%Y-%m-%d')
+        notifier = Notifier()
+        notifier.queue(Notice('daily_report', today, f"Franklin Battery Daily Report - {today}", report))
+        try:
+            if asyncio.run(notifier.flush()):
+                print("✓ Daily report emailed")
+            else:
+                print("Daily report already emailed today")
+        except Exception as e:
+            print(f"✗ Failed to email daily report: {e}")
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,350 @@
+#!/volume1/docker/franklin/venv311/bin/python3
+"""
+Live Dashboard - Local Web View of the History Store
+Serves a page with SOC, solar and home-load charts, pre-aggregated JSON
+for any time range, and new readings pushed as server-sent events
+
+/api/range?since=...&until=... answers from the history store, averaged
+per 15 minutes (up to 2 days), hour (up to 31 days) or day, and caches
+the answer; ranges that end before the newest reading never change, open
+ranges are recomputed only after a new reading arrives. /api/events
+streams each new reading and decision once the decision loop has written
+it, so an open page only receives the delta.
+
+Runs continuously (like telemetry_sampler.py): python3 dashboard.py,
+then open http://<nas>:8080/. Only standard-library networking is used.
+"""
+import asyncio
+import json
+import sys
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from urllib.parse import parse_qs, urlsplit
+
+import history_store
+from history_store import BUCKET_FIELDS, Reading
+
+HISTORY_DB = history_store.DB_FILE
+
+DASHBOARD_HOST = "0.0.0.0"
+DASHBOARD_PORT = 8080
+
+POLL_SECONDS = 5             # How often the store is checked for new rows
+HEARTBEAT_SECONDS = 15       # Keeps idle event streams open through proxies
+RANGE_CACHE_SIZE = 64
+CLIENT_QUEUE_SIZE = 100      # A browser this far behind is disconnected
+
+RAW_RANGE = timedelta(days=2)
+HOURLY_RANGE = timedelta(days=31)
+
+def bucket_level(since, until):
+    """Aggregation level for a range"""
+    span = until - since
+    if span <= RAW_RANGE:
+        return '15min'
+    if span <= HOURLY_RANGE:
+        return 'hour'
+    return 'day'
+
+BUCKET_LENGTH = {'15min': timedelta(minutes=15), 'hour': timedelta(hours=1), 'day': timedelta(days=1)}
+
+def bucket_start(t, level):
+    if level == '15min':
+        return t.replace(minute=t.minute - t.minute % 15, second=0, microsecond=0)
+    if level == 'hour':
+        return t.replace(minute=0, second=0, microsecond=0)
+    return t.replace(hour=0, minute=0, second=0, microsecond=0)
+
+def snap(since, until, level):
+    """Widen a range to whole buckets, so repeated 'last N days' requests share a cache entry"""
+    end = bucket_start(until, level) + BUCKET_LENGTH[level] - timedelta(seconds=1)
+    return bucket_start(since, level), end
+
+def parse_time(value, default):
+    if not value:
+        return default
+    return datetime.fromisoformat(value.replace('Z', ''))
+
+class Dashboard:
+    """Range queries with a cache, and fan-out of new rows to event streams"""
+
+    def __init__(self, db_path=HISTORY_DB):
+        self.db_path = db_path
+        self.cache = OrderedDict()   # (since, until, level) -> (newest reading when computed, body)
+        self.clients = set()
+        self.newest_reading = None
+        self.newest_decision = None
+
+    def _query(self, function, *args):
+        conn = history_store.connect(self.db_path)
+        try:
+            return function(conn, *args)
+        finally:
+            conn.close()
+
+    async def range_json(self, since, until):
+        """JSON body for a range (cached)"""
+        level = bucket_level(since, until)
+        since, until = snap(since, until, level)
+        key = (since, until, level)
+        cached = self.cache.get(key)
+        if cached and (cached[0] == self.newest_reading or
+                       (self.newest_reading and until.strftime('%Y-%m-%d %H:%M:%S') < cached[0])):
+            self.cache.move_to_end(key)
+            return cached[1]
+
+        rows = await asyncio.to_thread(self._query, history_store.reading_buckets, level, since, until)
+        columns = {field: [] for field in BUCKET_FIELDS}
+        for row in rows:
+            for field, value in zip(BUCKET_FIELDS, row):
+                columns[field].append(round(value, 3) if isinstance(value, float) else value)
+        body = json.dumps({'since': str(since), 'until': str(until), 'level': level,
+                           'columns': columns}, separators=(',', ':')).encode()
+        self.cache[key] = (self.newest_reading, body)
+        if len(self.cache) > RANGE_CACHE_SIZE:
+            self.cache.popitem(last=False)
+        return body
+
+    def _new_rows(self, conn, reading_after, decision_after):
+        readings = [r for r in history_store.readings_between(conn, reading_after)
+                    if r.timestamp != reading_after]
+        decisions = [d for d in history_store.decisions_between(conn, decision_after)
+                     if d.timestamp != decision_after]
+        return readings, decisions
+
+    async def tail(self):
+        """Watch the store and push new readings and decisions to every event stream"""
+        latest = await asyncio.to_thread(self._query, history_store.latest_reading)
+        self.newest_reading = latest.timestamp if latest else ''
+        self.newest_decision = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        while True:
+            await asyncio.sleep(POLL_SECONDS)
+            try:
+                readings, decisions = await asyncio.to_thread(
+                    self._query, self._new_rows, self.newest_reading, self.newest_decision)
+            except Exception as e:
+                print(f"✗ Store read failed: {e}")
+                continue
+            for reading in readings:
+                self.broadcast('reading', reading._asdict())
+                self.newest_reading = reading.timestamp
+            for decision in decisions:
+                self.broadcast('decision', decision._asdict())
+                self.newest_decision = decision.timestamp
+
+    def broadcast(self, event, data):
+        message = f"event: {event}\ndata: {json.dumps(data, separators=(',', ':'))}\n\n".encode()
+        for queue in list(self.clients):
+            if queue.qsize() >= CLIENT_QUEUE_SIZE:
+                self.clients.discard(queue)
+                queue.put_nowait(None)  # The one spare slot: tells the stream to close
+            else:
+                queue.put_nowait(message)
+
+    async def events(self, reader, writer):
+        """Server-sent event stream until the browser goes away"""
+        queue = asyncio.Queue(CLIENT_QUEUE_SIZE + 1)
+        self.clients.add(queue)
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\n"
+                     b"Cache-Control: no-cache\r\nConnection: keep-alive\r\n\r\nretry: 5000\n\n")
+        # The browser never sends anything more: end of input means it has gone
+        gone = asyncio.get_running_loop().create_task(reader.read())
+        try:
+            while not gone.done():
+                receive = asyncio.get_running_loop().create_task(queue.get())
+                await asyncio.wait((receive, gone), timeout=HEARTBEAT_SECONDS,
+                                   return_when=asyncio.FIRST_COMPLETED)
+                if not receive.done():
+                    receive.cancel()
+                    message = b": ping\n\n"
+                else:
+                    message = receive.result()
+                if message is None:
+                    break
+                writer.write(message)
+                await writer.drain()
+        finally:
+            gone.cancel()
+            self.clients.discard(queue)
+
+    async def handle(self, reader, writer):
+        try:
+            request = await reader.readuntil(b"\r\n\r\n")
+            method, target = request.split(b" ", 2)[:2]
+            url = urlsplit(target.decode())
+            if method != b"GET":
+                self.respond(writer, 405, b"Method not allowed", 'text/plain')
+            elif url.path == '/':
+                self.respond(writer, 200, PAGE.encode(), 'text/html; charset=utf-8')
+            elif url.path == '/api/range':
+                query = parse_qs(url.query)
+                until = parse_time(query.get('until', [''])[0], datetime.now())
+                since = parse_time(query.get('since', [''])[0], until - timedelta(days=1))
+                self.respond(writer, 200, await self.range_json(since, until), 'application/json')
+            elif url.path == '/api/events':
+                await self.events(reader, writer)
+            else:
+                self.respond(writer, 404, b"Not found", 'text/plain')
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            pass
+        except ValueError as e:
+            self.respond(writer, 400, str(e).encode(), 'text/plain')
+        except Exception as e:
+            # e.g. sqlite errors from the store: answer, keep serving
+            print(f"✗ Request failed: {e}", file=sys.stderr)
+            self.respond(writer, 500, f"Internal error: {e}".encode(), 'text/plain')
+        finally:
+            writer.close()
+
+    @staticmethod
+    def respond(writer, status, body, content_type):
+        reason = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+                  500: 'Internal Server Error'}[status]
+        writer.write(f"HTTP/1.1 {status} {reason}\r\nContent-Type: {content_type}\r\n"
+                     f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+
+async def serve(host=DASHBOARD_HOST, port=DASHBOARD_PORT, db_path=HISTORY_DB):
+    """Run the dashboard until interrupted"""
+    dashboard = Dashboard(db_path)
+    server = await asyncio.start_server(dashboard.handle, host, port)
+    print(f"✓ Dashboard on http://{host}:{port}/")
+    async with server:
+        await asyncio.gather(server.serve_forever(), dashboard.tail())
+
+PAGE = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>FranklinWH Dashboard</title>
+<style>
+body{font-family:sans-serif;margin:1em;background:#fafafa}
+button{margin-right:.5em}#status{color:#666;margin-left:1em}
+canvas{width:100%;height:260px;background:#fff;border:1px solid #ddd;margin-top:.5em}
+</style></head><body>
+<h2>FranklinWH Battery</h2>
+<div><button data-days="1">Today</button><button data-days="7">Week</button>
+<button data-days="30">Month</button><button data-days="365">Year</button><span id="status"></span></div>
+<canvas id="soc"></canvas><canvas id="power"></canvas>
+<p id="decision"></p>
+<script>
+let data = null, days = 1;
+function draw(id, series, maxY, unit) {
+  const c = document.getElementById(id), g = c.getContext('2d');
+  c.width = c.clientWidth; c.height = c.clientHeight;
+  g.clearRect(0, 0, c.width, c.height);
+  const t = data.columns.bucket, n = t.length;
+  if (!n) return;
+  const top = maxY || Math.max(1, ...series.flatMap(s => data.columns[s[0]].filter(v => v != null)));
+  g.fillStyle = '#666'; g.fillText(top.toFixed(1) + unit, 4, 12); g.fillText(t[0], 4, c.height - 4);
+  g.fillText(t[n - 1], c.width - 110, c.height - 4);
+  for (const [field, color] of series) {
+    g.strokeStyle = color; g.beginPath();
+    data.columns[field].forEach((v, i) => {
+      const x = n > 1 ? i / (n - 1) * (c.width - 20) + 10 : 10, y = c.height - 16 - v / top * (c.height - 32);
+      i ? g.lineTo(x, y) : g.moveTo(x, y);
+    });
+    g.stroke();
+  }
+}
+function render() {
+  draw('soc', [['soc_avg', '#2a7'], ['soc_min', '#aaa'], ['soc_max', '#aaa']], 100, '%');
+  draw('power', [['solar_kw', '#e90'], ['home_load_kw', '#36c'], ['grid_kw', '#c33']], 0, ' kW');
+}
+async function load(d) {
+  days = d;
+  const until = new Date(), since = new Date(until - d * 86400000);
+  const iso = x => new Date(x - x.getTimezoneOffset() * 60000).toISOString().slice(0, 19);
+  data = await (await fetch(`/api/range?since=${iso(since)}&until=${iso(until)}`)).json();
+  document.getElementById('status').textContent = `${data.columns.bucket.length} points per ${data.level}`;
+  render();
+}
+document.querySelectorAll('button').forEach(b => b.onclick = () => load(+b.dataset.days));
+const events = new EventSource('/api/events');
+events.addEventListener('reading', e => {
+  const r = JSON.parse(e.data);
+  document.getElementById('status').textContent = `SOC ${r.soc_percent}% at ${r.timestamp}`;
+  if (data && data.level === '15min') {
+    // Fold the reading into its 15-minute bucket, as the server would have
+    const cols = data.columns, minute = +r.timestamp.slice(14, 16);
+    const bucket = r.timestamp.slice(0, 14) + String(minute - minute % 15).padStart(2, '0');
+    let i = cols.bucket.length - 1;
+    if (cols.bucket[i] !== bucket) {
+      cols.bucket.push(bucket); cols.readings.push(0);
+      for (const f of ['soc_avg', 'soc_min', 'soc_max', 'solar_kw', 'home_load_kw', 'grid_kw', 'battery_kw'])
+        cols[f].push(null);
+      i++;
+    }
+    const n = cols.readings[i]++;
+    const mean = (old, v) => v == null ? old : old == null ? v : (old * n + v) / (n + 1);
+    cols.soc_avg[i] = mean(cols.soc_avg[i], r.soc_percent);
+    cols.soc_min[i] = cols.soc_min[i] == null ? r.soc_percent : Math.min(cols.soc_min[i], r.soc_percent);
+    cols.soc_max[i] = cols.soc_max[i] == null ? r.soc_percent : Math.max(cols.soc_max[i], r.soc_percent);
+    for (const f of ['solar_kw', 'home_load_kw', 'grid_kw', 'battery_kw']) cols[f][i] = mean(cols[f][i], r[f]);
+    render();
+  } else if (data) {
+    load(days);
+  }
+});
+events.addEventListener('decision', e => {
+  const d = JSON.parse(e.data);
+  document.getElementById('decision').textContent = `${d.timestamp}: ${d.desired_mode} - ${d.reason}`;
+});
+load(1);
+</script></body></html>
+"""
+
+async def self_check(db_path):
+    """Serve a temporary store and check range caching and event delivery"""
+    dashboard = Dashboard(db_path)
+    server = await asyncio.start_server(dashboard.handle, '127.0.0.1', 0)
+    port = server.sockets[0].getsockname()[1]
+    tail = asyncio.get_running_loop().create_task(dashboard.tail())
+
+    async def get(path, read_all=True):
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(f"GET {path} HTTP/1.1\r\nHost: x\r\n\r\n".encode())
+        await writer.drain()
+        if read_all:
+            data = await reader.read()
+            writer.close()
+            return data.split(b"\r\n\r\n", 1)[1]
+        return reader, writer
+
+    body = json.loads(await get('/api/range?since=2026-01-01T00:00:00&until=2026-01-02T00:00:00'))
+    cached = len(dashboard.cache)
+    await get('/api/range?since=2026-01-01T00:00:00&until=2026-01-02T00:00:00')
+
+    reader, writer = await get('/api/events', read_all=False)
+    await reader.readuntil(b"retry: 5000\n\n")
+    conn = history_store.connect(db_path)
+    with conn:
+        history_store.record_reading(conn, Reading(datetime.now().strftime('%Y-%m-%d %H:%M:%S'), 80.0, 2.0,
+                                                   0.0, -1.0, 1.0, 'NORMAL', 0, 0, 0, 0, 3.0, 'TOU'))
+    conn.close()
+    event = await asyncio.wait_for(reader.readuntil(b"\n\n"), POLL_SECONDS * 3)
+    writer.close()
+    await asyncio.sleep(0.1)
+    tail.cancel()
+    server.close()
+
+    return (body['level'] == '15min' and len(body['columns']['bucket']) == 4 * 24 + 1 and cached == 1
+            and len(dashboard.cache) == 1 and event.startswith(b"event: reading"))
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ['--self-check']:
+        import tempfile
+        with tempfile.TemporaryDirectory() as tmp:
+            db_path = f"{tmp}/franklin_history.db"
+            conn = history_store.connect(db_path)
+            with conn:
+                start = datetime(2026, 1, 1)
+                for i in range(4 * 24 * 2):
+                    history_store.record_reading(conn, Reading(
+                        (start + timedelta(minutes=15 * i)).strftime('%Y-%m-%d %H:%M:%S'),
+                        50.0, 1.0, 0.0, 0.0, 1.0, 'NORMAL', 0, 0, 0, 0, 3.0, 'TOU'))
+            conn.close()
+            ok = asyncio.run(self_check(db_path))
+        print("✓ Dashboard self-check passed" if ok else "✗ Dashboard self-check failed")
+        sys.exit(0 if ok else 1)
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        sys.exit(0)
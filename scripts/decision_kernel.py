@@ -0,0 +1,159 @@
+#!/volume1/docker/franklin/venv311/bin/python3
+"""
+Batched Decision Kernel
+Array version of smart_decision.should_charge_from_grid() for evaluating
+many sites, time points or scenarios in one call
+
+Returns decisions and integer reason codes instead of formatted strings.
+Run directly to check exact parity with the scalar function on random and
+boundary inputs and to measure throughput.
+"""
+import sys
+import time
+
+import numpy as np
+
+from smart_decision import (DEFAULT_SITE, EMERGENCY_SOC, EMERGENCY_WINDOW_HOURS,
+                            LOW_SOLAR_BUFFER_HOURS, MONITOR_BUFFER_HOURS, SOLAR_EFFICIENCY,
+                            SOLAR_SOC_PER_KW_HOUR, should_charge_from_grid)
+
+# Reason codes, one per branch of should_charge_from_grid()
+IN_PEAK = 0
+AT_TARGET = 1
+EMERGENCY = 2
+PEAK_IMMINENT_OK = 3
+OUT_OF_TIME = 4
+LOW_SOLAR_NO_TIME = 5
+LOW_SOLAR_OK = 6
+SOLAR_SUFFICIENT = 7
+SOLAR_SHORT_MONITORING = 8
+SOLAR_SHORT_CHARGE = 9
+
+REASON_NAMES = (
+    'in_peak', 'at_target', 'emergency', 'peak_imminent_ok', 'out_of_time',
+    'low_solar_no_time', 'low_solar_ok', 'solar_sufficient',
+    'solar_short_monitoring', 'solar_short_charge')
+
+# Whether each reason code means "grid charge"
+CHARGES = np.array([False, False, True, False, True, True, False, False, False, True])
+
+# Leading text of each scalar reason string, used to map it to a code
+REASON_PREFIXES = (
+    ('IN PEAK PERIOD', IN_PEAK),
+    ('Already at target', AT_TARGET),
+    ('EMERGENCY:', EMERGENCY),
+    ('Peak imminent', PEAK_IMMINENT_OK),
+    ('Out of time!', OUT_OF_TIME),
+    ('Solar can provide', SOLAR_SUFFICIENT),
+    ('Solar may fall short', SOLAR_SHORT_MONITORING),
+    ('Solar unlikely', SOLAR_SHORT_CHARGE),
+)
+
+def site_arrays(sites):
+    """Per-row config arrays from a list of SiteConfig (one row per site)"""
+    return {
+        'target_soc': np.array([site.target_soc for site in sites], dtype=float),
+        'charge_rate_per_hour': np.array([site.charge_rate_per_hour for site in sites], dtype=float),
+        'safety_margin_hours': np.array([site.safety_margin_hours for site in sites], dtype=float),
+        'min_solar_for_wait': np.array([site.min_solar_for_wait for site in sites], dtype=float),
+    }
+
+def decide_batch(soc, solar_kw, hours_to_peak, in_peak,
+                 target_soc=DEFAULT_SITE.target_soc,
+                 charge_rate_per_hour=DEFAULT_SITE.charge_rate_per_hour,
+                 safety_margin_hours=DEFAULT_SITE.safety_margin_hours,
+                 min_solar_for_wait=DEFAULT_SITE.min_solar_for_wait):
+    """
+    Vectorized should_charge_from_grid(). Inputs are arrays (or scalars)
+    broadcast against each other, config included, so each row can carry
+    its own site settings.
+    Returns: (should_charge bool array, reason code int8 array)
+    """
+    soc = np.asarray(soc, dtype=float)
+    solar_kw = np.asarray(solar_kw, dtype=float)
+    hours_to_peak = np.asarray(hours_to_peak, dtype=float)
+    in_peak = np.asarray(in_peak, dtype=bool)
+
+    # Same arithmetic, in the same order, as the scalar version
+    soc_deficit = target_soc - soc
+    hours_needed_grid = (soc_deficit / charge_rate_per_hour) + safety_margin_hours
+    hours_until_must_start = hours_to_peak - hours_needed_grid
+    solar_charging_potential = solar_kw * SOLAR_EFFICIENCY * hours_to_peak * SOLAR_SOC_PER_KW_HOUR
+
+    imminent = hours_to_peak < EMERGENCY_WINDOW_HOURS
+    low_solar = solar_kw < min_solar_for_wait
+
+    # np.select picks the first true condition: the scalar if/return order
+    reasons = np.select(
+        [
+            in_peak,
+            soc >= target_soc,
+            imminent & (soc < EMERGENCY_SOC),
+            imminent,
+            hours_until_must_start <= 0,
+            low_solar & (hours_until_must_start < LOW_SOLAR_BUFFER_HOURS),
+            low_solar,
+            solar_charging_potential >= soc_deficit,
+            hours_until_must_start > MONITOR_BUFFER_HOURS,
+        ],
+        [
+            IN_PEAK, AT_TARGET, EMERGENCY, PEAK_IMMINENT_OK, OUT_OF_TIME,
+            LOW_SOLAR_NO_TIME, LOW_SOLAR_OK, SOLAR_SUFFICIENT, SOLAR_SHORT_MONITORING,
+        ],
+        default=SOLAR_SHORT_CHARGE,
+    ).astype(np.int8)
+    return CHARGES[reasons], reasons
+
+def reason_code(reason):
+    """Map a scalar reason string to its reason code"""
+    if reason.startswith('Low solar'):
+        return LOW_SOLAR_NO_TIME if 'running out of time' in reason else LOW_SOLAR_OK
+    for prefix, code in REASON_PREFIXES:
+        if reason.startswith(prefix):
+            return code
+    raise ValueError(f"Unrecognized reason: {reason}")
+
+def check_parity(rows=200000, seed=1):
+    """Compare decide_batch() with should_charge_from_grid() row by row"""
+    rng = np.random.default_rng(seed)
+    soc = rng.uniform(0, 100, rows)
+    solar_kw = rng.uniform(0, 10, rows)
+    hours_to_peak = rng.uniform(0, 24, rows)
+    in_peak = rng.random(rows) < 0.1
+
+    # Hit every threshold exactly as well
+    quarter = rows // 4
+    soc[:quarter] = rng.choice([DEFAULT_SITE.target_soc, EMERGENCY_SOC, 0.0, 100.0], quarter)
+    hours_to_peak[quarter:2 * quarter] = rng.choice([0.0, EMERGENCY_WINDOW_HOURS, 1.0, 2.0], quarter)
+    solar_kw[2 * quarter:3 * quarter] = rng.choice([0.0, DEFAULT_SITE.min_solar_for_wait], quarter)
+
+    charge, reasons = decide_batch(soc, solar_kw, hours_to_peak, in_peak)
+
+    mismatches = 0
+    for i in range(rows):
+        expected_charge, reason = should_charge_from_grid(
+            float(soc[i]), float(solar_kw[i]), float(hours_to_peak[i]), bool(in_peak[i]))
+        if expected_charge != charge[i] or reason_code(reason) != reasons[i]:
+            mismatches += 1
+            if mismatches <= 5:
+                print(f"✗ Row {i}: scalar={expected_charge} ({reason}), "
+                      f"batch={charge[i]} ({REASON_NAMES[reasons[i]]})")
+    return mismatches
+
+def measure_throughput(rows=5000000, seed=2):
+    """Rows per second for decide_batch()"""
+    rng = np.random.default_rng(seed)
+    inputs = (rng.uniform(0, 100, rows), rng.uniform(0, 10, rows),
+              rng.uniform(0, 24, rows), rng.random(rows) < 0.1)
+    started = time.perf_counter()
+    decide_batch(*inputs)
+    return rows / (time.perf_counter() - started)
+
+if __name__ == "__main__":
+    mismatches = check_parity()
+    if mismatches:
+        print(f"✗ Parity check failed: {mismatches} mismatches")
+        sys.exit(1)
+    print("✓ Parity check passed (decisions and reason codes match the scalar version)")
+    print(f"✓ Throughput: {measure_throughput() / 1e6:.1f}M decisions/second")
+    sys.exit(0)
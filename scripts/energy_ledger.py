@@ -0,0 +1,170 @@
+#!/volume1/docker/franklin/venv311/bin/python3
+"""
+Energy Ledger - Cost and Savings from the Cumulative Counters
+Turns the cumulative kWh counters in continuous_monitoring.csv into
+per-interval energy, prices it with the tariff calendar and sums it into
+a daily ledger in the history store
+
+Vectorized over one archived segment at a time, so memory stays bounded
+however long the history is. Each run continues from a watermark (last
+timestamp and counter values), so only new readings are processed; run
+with --rebuild to recompute everything.
+
+Savings are against a no-battery baseline: without the battery the grid
+would have supplied the home load solar didn't cover in each interval
+(from the home_load_kw readings; across gaps, from the counters as grid
+import + discharge - charge). Export credits are not modelled (there is
+no export counter).
+"""
+import json
+import sys
+
+import numpy as np
+
+import history_store
+from history_store import LedgerEntry
+from readings import iter_column_chunks
+from tariff_calendar import PEAK
+
+COUNTERS = ('grid_import_total', 'battery_charge_total', 'battery_discharge_total', 'solar_total')
+
+# Longer intervals are counted as gaps in the ledger (their energy is still booked)
+MAX_GAP_MINUTES = 60
+# A counter falling below this fraction of its previous value has reset to zero;
+# smaller drops are read glitches and count as no energy
+RESET_FRACTION = 0.5
+
+WATERMARK_KEY = 'ledger_watermark'
+
+def forward_fill(values):
+    """Replace NaN with the last valid value before it"""
+    index = np.where(np.isnan(values), 0, np.arange(len(values)))
+    np.maximum.accumulate(index, out=index)
+    return values[index]
+
+def counter_deltas(values, previous):
+    """
+    Energy per interval from a cumulative counter, given the value before
+    the first row. Returns: (deltas, last value to carry into the next chunk)
+    """
+    filled = forward_fill(np.concatenate(([previous], values)))
+    deltas = np.diff(filled)
+    reset = (deltas < 0) & (filled[1:] < filled[:-1] * RESET_FRACTION)
+    deltas = np.where(reset, filled[1:], np.clip(deltas, 0, None))
+    return np.nan_to_num(deltas, nan=0.0), filled[-1]
+
+def ledger_chunk(columns, watermark, calendar):
+    """
+    Daily ledger entries for the rows of one chunk newer than the watermark.
+    Returns: (entries, new watermark)
+    """
+    times = columns['timestamp']
+    order = np.argsort(times, kind='stable')
+    times, first = np.unique(times[order], return_index=True)
+    rows = order[first]
+    if watermark:
+        newer = times > np.datetime64(watermark['timestamp'])
+        times, rows = times[newer], rows[newer]
+    if len(times) == 0:
+        return [], watermark
+
+    if watermark:
+        previous_time = np.datetime64(watermark['timestamp'])
+        previous = {name: np.nan if value is None else value for name, value in watermark['counters'].items()}
+    else:
+        # The very first reading only sets the starting point
+        previous_time = times[0]
+        previous = {name: columns[name][rows[0]] for name in COUNTERS}
+        times, rows = times[1:], rows[1:]
+        if len(times) == 0:
+            return [], _watermark(previous_time, previous)
+
+    all_times = np.concatenate(([previous_time], times))
+    intervals = np.diff(all_times)
+    midpoints = all_times[:-1] + intervals // 2
+    minutes = intervals / np.timedelta64(1, 'm')
+
+    energy = {}
+    for name in COUNTERS:
+        energy[name], previous[name] = counter_deltas(columns[name][rows], previous[name])
+
+    prices = calendar.prices_for(midpoints)
+    in_peak = calendar.periods_for(midpoints) == PEAK
+    grid = energy['grid_import_total']
+    load_kwh = columns['home_load_kw'][rows] * minutes / 60
+    balance = grid + energy['battery_discharge_total'] - energy['battery_charge_total']
+    measured = ~np.isnan(load_kwh) & (minutes <= MAX_GAP_MINUTES)
+    baseline = np.clip(np.where(measured, load_kwh - energy['solar_total'], balance), 0, None)
+
+    days, day_index = np.unique(midpoints.astype('datetime64[D]'), return_inverse=True)
+
+    def daily(values):
+        return np.bincount(day_index, weights=values, minlength=len(days))
+
+    sums = (daily(grid), daily(np.where(in_peak, grid, 0.0)),
+            daily(energy['battery_charge_total']), daily(energy['battery_discharge_total']),
+            daily(energy['solar_total']), daily(grid * prices), daily(baseline * prices),
+            daily(np.where(minutes > MAX_GAP_MINUTES, minutes / 60, 0.0)))
+    entries = [LedgerEntry(str(day), *(float(column[i]) for column in sums)) for i, day in enumerate(days)]
+    return entries, _watermark(times[-1], previous)
+
+def _watermark(timestamp, counters):
+    return {
+        'timestamp': str(timestamp),
+        'counters': {name: None if np.isnan(value) else float(value) for name, value in counters.items()},
+    }
+
+def update_ledger(conn, live_path, calendar, rebuild=False):
+    """Book all readings newer than the watermark; returns the number of days touched"""
+    if rebuild:
+        with conn:
+            conn.execute("DELETE FROM energy_ledger")
+            history_store.set_state(conn, WATERMARK_KEY, '')
+
+    stored = history_store.get_state(conn, WATERMARK_KEY)
+    watermark = json.loads(stored) if stored else None
+    since = None
+    if watermark:
+        since = np.datetime64(watermark['timestamp']).astype(object)
+
+    days = set()
+    for columns in iter_column_chunks(live_path, since=since):
+        entries, watermark = ledger_chunk(columns, watermark, calendar)
+        # Entries and watermark commit together, so an interrupted run resumes cleanly
+        with conn:
+            history_store.add_ledger_days(conn, entries)
+            if watermark:
+                history_store.set_state(conn, WATERMARK_KEY, json.dumps(watermark))
+        days.update(entry.period for entry in entries)
+    return len(days)
+
+def format_ledger(entries, label):
+    """Text table of ledger entries"""
+    lines = [
+        f"{label:10} | Grid kWh | Peak kWh | Batt In | Batt Out | Solar kWh |    Cost | No-Battery | Savings",
+        "-----------|----------|----------|---------|----------|-----------|---------|------------|--------",
+    ]
+    for e in entries:
+        lines.append(
+            f"{e.period:10} | {e.grid_import_kwh:8.1f} | {e.peak_import_kwh:8.1f} | {e.battery_charge_kwh:7.1f} | "
+            f"{e.battery_discharge_kwh:8.1f} | {e.solar_kwh:9.1f} | {e.cost:7.2f} | {e.baseline_cost:10.2f} | "
+            f"{e.baseline_cost - e.cost:7.2f}")
+    return '\n'.join(lines)
+
+if __name__ == "__main__":
+    from smart_decision import HISTORY_DB, LOG_FILE, site_calendar
+
+    rebuild = '--rebuild' in sys.argv[1:]
+    conn = history_store.connect(HISTORY_DB)
+    try:
+        days = update_ledger(conn, LOG_FILE, site_calendar(), rebuild=rebuild)
+    except Exception as e:
+        print(f"✗ Error updating energy ledger: {e}")
+        sys.exit(1)
+    print(f"✓ Energy ledger updated ({days} days booked)")
+    print()
+    print(format_ledger(history_store.ledger_totals(conn, 'month'), 'Month'))
+    print()
+    print(format_ledger(history_store.ledger_totals(conn, 'year'), 'Year'))
+    conn.close()
+    sys.exit(0)
@@ -0,0 +1,251 @@
+#!/volume1/docker/franklin/venv311/bin/python3
+"""
+Feature Table - Time-Aligned Join of All Data Sources
+Resamples battery monitoring, weather and PVOutput data onto one
+15-minute grid and appends it to feature_table.csv
+
+Each grid row takes the latest observation of each source within that
+source's tolerance (merge_asof); rows without one are marked as gaps.
+Weather gaps of up to an hour between two observations are filled by
+linear interpolation and flagged; battery readings are never interpolated.
+
+The table is append-only. Every run extends it from the last grid row up
+to the point every source has delivered data for (per-source watermarks
+in feature_table.state.json); a source that has fallen too far behind
+stops holding the table back and is marked as gaps instead. The state
+records the table's size before each append, so rows of a run that died
+before saving its watermark are cut off and written again. Analyses read
+it with load_features() instead of re-joining the raw files.
+"""
+import json
+import os
+import sys
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+from log_archive import LOG_DIR, MONITORING_LOG, WEATHER_LOG, segment_paths
+from readings import load_columns
+
+GROUND_SOLAR_LOG = LOG_DIR / "pvoutput_ground_mount_daily.csv"
+HOUSE_SOLAR_LOG = LOG_DIR / "pvoutput_house_daily.csv"
+PVOUTPUT_FIELDS = ('date', 'energy_wh', 'efficiency', 'exported_wh', 'used_wh',
+                   'peak_power_w', 'peak_time', 'condition')
+
+FEATURE_TABLE = LOG_DIR / "feature_table.csv"
+FEATURE_STATE = LOG_DIR / "feature_table.state.json"
+
+GRID = pd.Timedelta(minutes=15)
+
+# How old the latest observation may be and still count for a grid row
+MONITORING_TOLERANCE = GRID
+WEATHER_TOLERANCE = pd.Timedelta(minutes=20)
+# Weather gaps up to this long between two observations are interpolated
+WEATHER_INTERPOLATE_LIMIT = pd.Timedelta(hours=1)
+
+# A source further behind than this no longer holds the table back
+MAX_SOURCE_LAG = {
+    'monitoring': timedelta(hours=3),
+    'weather': timedelta(hours=3),
+    'pvoutput': timedelta(days=2),   # Daily totals arrive the next morning
+}
+
+MONITORING_COLUMNS = ('soc_percent', 'solar_kw', 'grid_kw', 'battery_kw', 'home_load_kw',
+                      'grid_status', 'mode', 'battery_charge_total', 'battery_discharge_total',
+                      'grid_import_total', 'solar_total')
+WEATHER_COLUMNS = ('temp_f', 'humidity', 'dewpoint_f', 'pressure_inhg', 'wind_speed_mph',
+                   'precip_rate_in_hr', 'solar_radiation_wm2', 'uv_index')
+
+# ============================================================================
+# Source loaders (each returns a DataFrame sorted by 'timestamp')
+# ============================================================================
+
+def load_monitoring(since=None):
+    """Battery readings since a time"""
+    columns = load_columns(MONITORING_LOG, since)
+    frame = pd.DataFrame({'timestamp': columns['timestamp']})
+    for column in MONITORING_COLUMNS:
+        frame[column] = columns[column]
+    return frame.drop_duplicates('timestamp', keep='last').sort_values('timestamp', ignore_index=True)
+
+def load_weather(since=None):
+    """Weather observations since a time"""
+    parts = [pd.read_csv(path, usecols=lambda c: c == 'timestamp' or c in WEATHER_COLUMNS)
+             for path in segment_paths(WEATHER_LOG, since) if os.path.getsize(path)]
+    if not parts:
+        return pd.DataFrame(columns=('timestamp',) + WEATHER_COLUMNS)
+    frame = pd.concat(parts, ignore_index=True)
+    frame['timestamp'] = pd.to_datetime(frame['timestamp'], format='ISO8601', errors='coerce').dt.floor('s')
+    for column in WEATHER_COLUMNS:
+        frame[column] = pd.to_numeric(frame.get(column), errors='coerce')
+    frame = frame.dropna(subset=['timestamp'])
+    if since is not None:
+        frame = frame[frame['timestamp'] >= since]
+    return frame.drop_duplicates('timestamp', keep='last').sort_values('timestamp', ignore_index=True)
+
+def load_pvoutput(path):
+    """Daily PVOutput energy (Wh) by date; the collector writes these files without a header"""
+    if not path.exists():
+        return pd.Series(dtype=float)
+    frame = pd.read_csv(path, header=None, names=PVOUTPUT_FIELDS, usecols=[0, 1], dtype={'date': str})
+    frame['date'] = pd.to_datetime(frame['date'], format='%Y%m%d', errors='coerce')
+    frame = frame.dropna(subset=['date']).drop_duplicates('date', keep='last')
+    return frame.set_index('date')['energy_wh']
+
+# ============================================================================
+# Join
+# ============================================================================
+
+def load_state():
+    """Last grid row written, the per-source watermarks and the size of an unfinished append"""
+    if not FEATURE_STATE.exists():
+        return {'grid': None, 'sources': {}}
+    with open(FEATURE_STATE, 'r') as f:
+        return json.load(f)
+
+def save_state(state):
+    """Write the state file atomically"""
+    tmp_path = f"{FEATURE_STATE}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp_path, FEATURE_STATE)
+
+def drop_unfinished_append(state):
+    """Cut the table back to its size before an append whose state was never saved"""
+    size = state.pop('pending_size', None)
+    if size is None or not FEATURE_TABLE.exists():
+        return
+    if size == 0:
+        FEATURE_TABLE.unlink()
+        return
+    with open(FEATURE_TABLE, 'r+b') as f:
+        f.truncate(size)
+
+def grid_end(watermarks, now):
+    """Last grid time every source (that isn't too far behind) has data for"""
+    current = [stamp for name, stamp in watermarks.items()
+               if stamp is not None and now - stamp <= MAX_SOURCE_LAG[name]]
+    if not current:
+        return None
+    return pd.Timestamp(min(current)).floor(GRID)
+
+def interpolate_gaps(grid_times, observations, columns, gap):
+    """Linear interpolation of observation columns at gap rows lying between two close observations"""
+    targets = grid_times.to_numpy(dtype='datetime64[s]').astype(np.int64)
+    times = observations['timestamp'].to_numpy(dtype='datetime64[s]').astype(np.int64)
+    filled = {column: np.full(len(targets), np.nan) for column in columns}
+    if len(times) < 2:
+        return filled, np.zeros(len(targets), dtype=bool)
+
+    after = np.clip(np.searchsorted(times, targets, side='left'), 1, len(times) - 1)
+    usable = (gap & (times[after - 1] <= targets) & (targets <= times[after])
+              & (times[after] - times[after - 1] <= WEATHER_INTERPOLATE_LIMIT.total_seconds()))
+    for column in columns:
+        values = observations[column].to_numpy(dtype=float)
+        valid = ~np.isnan(values)
+        if valid.sum() >= 2:
+            filled[column] = np.where(usable, np.interp(targets, times[valid], values[valid]), np.nan)
+    return filled, usable
+
+def build_rows(start, end, monitoring, weather, ground, house):
+    """Feature rows for the grid times start..end (inclusive)"""
+    grid = pd.DataFrame({'timestamp': pd.date_range(start, end, freq=GRID)})
+    grid['timestamp'] = grid['timestamp'].astype('datetime64[s]')
+
+    monitoring = monitoring.rename(columns={'timestamp': 'monitoring_time'})
+    monitoring['monitoring_time'] = monitoring['monitoring_time'].astype('datetime64[s]')
+    rows = pd.merge_asof(grid, monitoring, left_on='timestamp', right_on='monitoring_time',
+                         direction='backward', tolerance=MONITORING_TOLERANCE)
+    rows['monitoring_gap'] = rows['monitoring_time'].isna()
+
+    observed = weather.rename(columns={'timestamp': 'weather_time'})
+    observed['weather_time'] = observed['weather_time'].astype('datetime64[s]')
+    rows = pd.merge_asof(rows, observed, left_on='timestamp', right_on='weather_time',
+                         direction='backward', tolerance=WEATHER_TOLERANCE)
+    gap = rows['weather_time'].isna().to_numpy()
+    filled, interpolated = interpolate_gaps(rows['timestamp'], weather, WEATHER_COLUMNS, gap)
+    for column in WEATHER_COLUMNS:
+        rows[column] = rows[column].where(~interpolated, filled[column])
+    rows['weather_interpolated'] = interpolated
+    rows['weather_gap'] = gap & ~interpolated
+
+    day = rows['timestamp'].dt.normalize()
+    rows['ground_solar_wh'] = day.map(ground)
+    rows['house_solar_wh'] = day.map(house)
+    rows['pvoutput_gap'] = rows['ground_solar_wh'].isna() & rows['house_solar_wh'].isna()
+
+    return rows.drop(columns=['monitoring_time', 'weather_time'])
+
+def extend_feature_table(now=None):
+    """Append grid rows up to the sources' common watermark; returns rows written"""
+    now = now or datetime.now()
+    state = load_state()
+    drop_unfinished_append(state)
+    last_row = pd.Timestamp(state['grid']) if state['grid'] else None
+    # Load a little before the last row so the first new rows have observations to join
+    since = (last_row - WEATHER_INTERPOLATE_LIMIT).to_pydatetime() if last_row is not None else None
+
+    monitoring = load_monitoring(since)
+    weather = load_weather(since)
+    ground = load_pvoutput(GROUND_SOLAR_LOG)
+    house = load_pvoutput(HOUSE_SOLAR_LOG)
+
+    watermarks = {
+        'monitoring': monitoring['timestamp'].max() if len(monitoring) else None,
+        'weather': weather['timestamp'].max() if len(weather) else None,
+        # A day of PVOutput totals covers the grid up to the end of that day
+        'pvoutput': max([s.index.max() for s in (ground, house) if len(s)], default=None),
+    }
+    if watermarks['pvoutput'] is not None:
+        watermarks['pvoutput'] += pd.Timedelta(days=1) - GRID
+    for name, stamp in watermarks.items():
+        if stamp is None or pd.isna(stamp):
+            # Nothing new from this source: keep its previous watermark
+            previous = state['sources'].get(name)
+            watermarks[name] = datetime.strptime(previous, '%Y-%m-%d %H:%M:%S') if previous else None
+        else:
+            watermarks[name] = pd.Timestamp(stamp).to_pydatetime()
+
+    end = grid_end(watermarks, now)
+    if last_row is not None:
+        start = last_row + GRID
+    elif len(monitoring):
+        start = monitoring['timestamp'].min().floor(GRID)
+    else:
+        return 0
+    if end is None or end < start:
+        return 0
+
+    rows = build_rows(start, end, monitoring, weather, ground, house)
+    # Record the size first: a crash before the new watermark is saved drops these rows next run
+    state['pending_size'] = FEATURE_TABLE.stat().st_size if FEATURE_TABLE.exists() else 0
+    save_state(state)
+    rows.to_csv(FEATURE_TABLE, mode='a', header=not state['pending_size'], index=False,
+                float_format='%.3f', date_format='%Y-%m-%d %H:%M:%S')
+
+    sources = {name: stamp.strftime('%Y-%m-%d %H:%M:%S')
+               for name, stamp in watermarks.items() if stamp is not None}
+    save_state({'grid': end.strftime('%Y-%m-%d %H:%M:%S'), 'sources': sources})
+    return len(rows)
+
+def load_features(since=None, until=None):
+    """Read the feature table (optionally only [since, until]) as a DataFrame"""
+    frame = pd.read_csv(FEATURE_TABLE, parse_dates=['timestamp'])
+    if since is not None:
+        frame = frame[frame['timestamp'] >= since]
+    if until is not None:
+        frame = frame[frame['timestamp'] <= until]
+    return frame.reset_index(drop=True)
+
+if __name__ == "__main__":
+    try:
+        written = extend_feature_table()
+    except Exception as e:
+        print(f"✗ Error extending feature table: {e}")
+        sys.exit(1)
+    state = load_state()
+    print(f"✓ Feature table extended by {written} rows (through {state['grid'] or 'n/a'})")
+    for name, stamp in sorted(state['sources'].items()):
+        print(f"  {name:10} data through {stamp}")
+    sys.exit(0)
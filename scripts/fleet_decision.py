@@ -0,0 +1,116 @@
+#!/volume1/docker/franklin/venv311/bin/python3
+"""
+Fleet Battery Decision - Single Run for Many Gateways
+Runs the smart decision (get stats -> decide -> set mode) for every site
+in fleet.json concurrently, with a concurrency limit and per-site deadline
+
+Designed to be run every 15 minutes via scheduler, replacing one
+smart_decision.py copy and cron entry per home. Each site keeps its own
+log/state directory, so the reports and archive tools work per site.
+"""
+import asyncio
+import json
+import os
+import sys
+import time
+import buffered_log
+import mqtt_publisher
+from smart_decision import (DEFAULT_SITE, SiteConfig, create_client, get_stats_with_retry, journaled_cycle,
+                            log_intelligence, poll_due, recover_journal, run_decision_cycle)
+
+FLEET_CONFIG = "/volume1/docker/franklin/fleet.json"
+
+# At most this many sites talk to the cloud at once
+MAX_CONCURRENT_SITES = 10
+# A site that hasn't finished its cycle by then is abandoned until the next run:
+# its running store/file phase completes, later phases (incl. applying) are skipped
+SITE_DEADLINE_SECONDS = 120
+
+def load_fleet(path=FLEET_CONFIG):
+    """
+    Load site configs. Each site entry overrides the fleet "defaults",
+    which in turn override the single-site defaults in smart_decision.py.
+    Peak hours set without a tariff_file mean that single window: the
+    tariff file of a lower level doesn't apply to them.
+    """
+    with open(path, 'r') as f:
+        config = json.load(f)
+
+    sites = []
+    for entry in config['sites']:
+        values = DEFAULT_SITE._asdict()
+        for level in (config.get('defaults', {}), entry):
+            values.update(level)
+            if ('peak_start_hour' in level or 'peak_end_hour' in level) and 'tariff_file' not in level:
+                values['tariff_file'] = None
+        unknown = set(values) - set(SiteConfig._fields)
+        if unknown:
+            raise ValueError(f"Unknown settings for site {values['name']}: {', '.join(sorted(unknown))}")
+        os.makedirs(values['log_dir'], exist_ok=True)
+        sites.append(SiteConfig(**values))
+
+    names = [site.name for site in sites]
+    if len(set(names)) != len(names):
+        raise ValueError("Site names in fleet config must be unique")
+    return sites
+
+async def site_cycle(site):
+    """One full decision cycle for one site (None when adaptive polling says it isn't due)"""
+    if not await asyncio.to_thread(poll_due, site):
+        return None
+    async with journaled_cycle(site):
+        client = create_client(site)
+        stats = await get_stats_with_retry(max_retries=3, delay=5, client=client, site=site)
+        return await run_decision_cycle(stats, client, site)
+
+async def run_site(site, semaphore):
+    """
+    Run a site's cycle under the concurrency limit and deadline. A timed-out
+    cycle stops at its next phase (see smart_decision.CyclePhases); a switch
+    made before the deadline is picked up from the gateway next run.
+    """
+    async with semaphore:
+        started = time.monotonic()
+        try:
+            result = await asyncio.wait_for(site_cycle(site), SITE_DEADLINE_SECONDS)
+            if result is None:
+                return site.name, True, "no decision due yet", time.monotonic() - started
+            desired_mode, reason = result
+            return site.name, True, f"{desired_mode} mode ({reason})", time.monotonic() - started
+        except asyncio.TimeoutError:
+            message = f"cycle exceeded {SITE_DEADLINE_SECONDS}s deadline"
+            log_intelligence(f"ERROR: {message}", site)
+        except Exception as e:
+            message = str(e)  # Logged with the cycle's journal record
+        return site.name, False, message, time.monotonic() - started
+
+async def run_fleet(sites):
+    """Run all sites concurrently; returns one result tuple per site"""
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_SITES)
+    return await asyncio.gather(*(run_site(site, semaphore) for site in sites))
+
+async def main():
+    """Main execution"""
+    try:
+        sites = load_fleet()
+    except Exception as e:
+        print(f"✗ Error loading fleet config: {e}")
+        return 1
+    recover_journal()
+
+    started = time.monotonic()
+    results = await run_fleet(sites)
+    await mqtt_publisher.close_publisher()
+    await buffered_log.flush_all()
+
+    failures = 0
+    for name, ok, message, elapsed in results:
+        print(f"{'✓' if ok else '✗'} {name}: {message} ({elapsed:.1f}s)")
+        failures += 0 if ok else 1
+
+    print(f"Fleet cycle: {len(sites) - failures}/{len(sites)} sites OK in {time.monotonic() - started:.1f}s")
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    exit_code = asyncio.run(main())
+    sys.exit(exit_code)
@@ -10,48 +10,47 @@ import pandas as pd
 import matplotlib.pyplot as plt
 import matplotlib.dates as mdates
 from datetime import datetime, timedelta
-import re
+import history_store
+from log_archive import TELEMETRY_LOG, segment_paths
+from smart_decision import site_calendar
 
 # File paths
-LOG_FILE = "/volume1/docker/franklin/logs/continuous_monitoring.csv"
-INTELLIGENCE_LOG = "/volume1/docker/franklin/logs/solar_intelligence.log"
 OUTPUT_DIR = "/volume1/docker/franklin/logs"
 
-# Peak period hours
-PEAK_START_HOUR = 17  # 5 PM
-PEAK_END_HOUR = 20    # 8 PM
-
-def parse_mode_switches():
-    """Extract mode switch events from intelligence log"""
-    switches = []
-    
-    with open(INTELLIGENCE_LOG, 'r') as f:
-        for line in f:
-            if 'Mode changed' in line:
-                # Parse: "2026-01-08 12:30:58 - Mode changed: TOU → BACKUP"
-                match = re.match(r'(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}) - Mode changed: (\w+) → (\w+)', line)
-                if match:
-                    timestamp_str, from_mode, to_mode = match.groups()
-                    timestamp = pd.to_datetime(timestamp_str)
-                    switches.append({
-                        'timestamp': timestamp,
-                        'from_mode': from_mode,
-                        'to_mode': to_mode
-                    })
-    
-    return pd.DataFrame(switches)
+def parse_mode_switches(days=7):
+    """Load mode switch events from the history store"""
+    cutoff = datetime.now() - timedelta(days=days)
+    conn = history_store.connect()
+    changes = history_store.mode_changes_between(conn, since=cutoff)
+    conn.close()
+    
+    switches = pd.DataFrame(changes, columns=history_store.ModeChange._fields)
+    switches['timestamp'] = pd.to_datetime(switches['timestamp'])
+    return switches
 
 def load_monitoring_data(days=7):
-    """Load last N days of monitoring data"""
-    df = pd.read_csv(LOG_FILE)
-    df['timestamp'] = pd.to_datetime(df['timestamp'])
-    
-    # Filter to last N days
+    """Load last N days of monitoring data from the history store"""
     cutoff = datetime.now() - timedelta(days=days)
-    df = df[df['timestamp'] >= cutoff]
+    conn = history_store.connect()
+    readings = history_store.readings_between(conn, since=cutoff)
+    conn.close()
+    
+    df = pd.DataFrame(readings, columns=history_store.Reading._fields)
+    df['timestamp'] = pd.to_datetime(df['timestamp'])
     
     return df
 
+def load_telemetry_data(hours=48):
+    """Load high-resolution aggregates from telemetry_sampler.py, if it is running"""
+    cutoff = datetime.now() - timedelta(hours=hours)
+    paths = segment_paths(TELEMETRY_LOG, since=cutoff)
+    if not paths:
+        return pd.DataFrame()
+    
+    df = pd.concat([pd.read_csv(path) for path in paths], ignore_index=True)
+    df['timestamp'] = pd.to_datetime(df['timestamp'])
+    return df[df['timestamp'] >= cutoff]
+
 def create_soc_timeline_chart(df, switches):
     """Chart 1: SOC over time with mode switches"""
     fig, ax = plt.subplots(figsize=(16, 7))
@@ -89,9 +88,13 @@ def create_soc_timeline_chart(df, switches):
                    color=color, markeredgecolor='black', markeredgewidth=1.5,
                    zorder=10)
     
-    # Shade peak period
-    ax.axvspan(PEAK_START_HOUR, PEAK_END_HOUR, alpha=0.2, color='red', 
-               label='Peak Period (5-8 PM)')
+    # Shade today's peak period(s) from the tariff calendar
+    today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    for i, (peak_start, peak_end) in enumerate(site_calendar().peak_windows(today, today + timedelta(days=1))):
+        start_hour = max((peak_start - today).total_seconds() / 3600, 0)
+        end_hour = min((peak_end - today).total_seconds() / 3600, 24)
+        ax.axvspan(start_hour, end_hour, alpha=0.2, color='red',
+                   label=f"Peak Period ({peak_start.strftime('%-I:%M')}-{peak_end.strftime('%-I:%M %p')})" if i == 0 else None)
     
     # Formatting
     ax.set_xlabel('Hour of Day', fontsize=12, fontweight='bold')
@@ -220,11 +223,8 @@ def create_power_flow_chart(df):
     
     # Shade peak periods (last 2 days)
     now = datetime.now()
-    for i in range(2):
-        day = now - timedelta(days=i)
-        peak_start = day.replace(hour=PEAK_START_HOUR, minute=0, second=0, microsecond=0)
-        peak_end = day.replace(hour=PEAK_END_HOUR, minute=0, second=0, microsecond=0)
-        ax1.axvspan(peak_start, peak_end, alpha=0.15, color='red')
+    for peak_start, peak_end in site_calendar().peak_windows(now - timedelta(days=2), now):
+        ax1.axvspan(peak_start, min(peak_end, now), alpha=0.15, color='red')
     
     # Chart 2: Battery SOC and activity
     ax2.plot(recent['timestamp'], recent['soc_percent'], 
@@ -265,7 +265,7 @@ def main():
     
     print("Loading data...")
     df = load_monitoring_data(days=7)
-    switches = parse_mode_switches()
+    switches = parse_mode_switches(days=7)
     
     print(f"Loaded {len(df)} monitoring records")
     print(f"Found {len(switches)} mode switches")
@@ -287,7 +287,10 @@ def main():
     print(f"  ✓ Saved: {filename2}")
     
     print("Generating Chart 3: Power Flow (48 hours)...")
-    fig3 = create_power_flow_chart(df)
+    telemetry = load_telemetry_data(hours=48)
+    if len(telemetry) > 0:
+        print(f"  Using {len(telemetry)} high-resolution telemetry intervals")
+    fig3 = create_power_flow_chart(telemetry if len(telemetry) > 0 else df)
     filename3 = f'{OUTPUT_DIR}/{date_prefix}_chart_power_flow.png'
     fig3.savefig(filename3, dpi=150, bbox_inches='tight')
     print(f"  ✓ Saved: {filename3}")
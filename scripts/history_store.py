@@ -0,0 +1,393 @@
+#!/volume1/docker/franklin/venv311/bin/python3
+"""
+History Store - SQLite State and History Database
+Single WAL-mode SQLite database holding readings, decisions, mode changes,
+peak transitions and current state, all indexed by timestamp
+
+The decision loop writes each cycle in one transaction; reports and charts
+query it through the functions below. Run directly to import the existing
+CSV, log and state files (safe to re-run, duplicates are ignored); pass
+each site's log directory in fleet mode. The import is a separate step so
+no decision cycle ever waits on it.
+"""
+import os
+import re
+import sqlite3
+import sys
+from collections import namedtuple
+from datetime import datetime
+from pathlib import Path
+
+from log_archive import INTELLIGENCE_LOG, LOG_DIR, MONITORING_LOG, read_log_lines
+from readings import Reading, iter_readings, load_columns
+
+DB_FILE = LOG_DIR / "franklin_history.db"
+STATE_FILE = LOG_DIR / "last_mode.txt"
+PEAK_STATE_FILE = LOG_DIR / "peak_state.txt"
+
+# Wait this long for another writer's lock before giving up (milliseconds)
+BUSY_TIMEOUT_MS = 30000
+
+# State key set in the same transaction as a completed flat-file import
+IMPORTED_KEY = 'flat_files_imported'
+
+Decision = namedtuple('Decision', (
+    'timestamp', 'soc_percent', 'solar_kw', 'hours_to_peak', 'in_peak',
+    'should_charge', 'desired_mode', 'reason'))
+ModeChange = namedtuple('ModeChange', ('timestamp', 'from_mode', 'to_mode'))
+PeakTransition = namedtuple('PeakTransition', ('timestamp', 'state'))
+LedgerEntry = namedtuple('LedgerEntry', (
+    'period', 'grid_import_kwh', 'peak_import_kwh', 'battery_charge_kwh', 'battery_discharge_kwh',
+    'solar_kwh', 'cost', 'baseline_cost', 'gap_hours'))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS readings (
+    timestamp TEXT PRIMARY KEY,
+    soc_percent REAL,
+    solar_kw REAL,
+    grid_kw REAL,
+    battery_kw REAL,
+    home_load_kw REAL,
+    grid_status TEXT,
+    battery_charge_total REAL,
+    battery_discharge_total REAL,
+    grid_import_total REAL,
+    solar_total REAL,
+    hours_to_peak REAL,
+    mode TEXT
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS decisions (
+    timestamp TEXT PRIMARY KEY,
+    soc_percent REAL,
+    solar_kw REAL,
+    hours_to_peak REAL,
+    in_peak INTEGER,
+    should_charge INTEGER,
+    desired_mode TEXT,
+    reason TEXT
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS mode_changes (
+    timestamp TEXT NOT NULL,
+    from_mode TEXT,
+    to_mode TEXT NOT NULL,
+    PRIMARY KEY (timestamp, to_mode)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS peak_transitions (
+    timestamp TEXT NOT NULL,
+    state TEXT NOT NULL,
+    PRIMARY KEY (timestamp, state)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS energy_ledger (
+    period TEXT PRIMARY KEY,
+    grid_import_kwh REAL,
+    peak_import_kwh REAL,
+    battery_charge_kwh REAL,
+    battery_discharge_kwh REAL,
+    solar_kwh REAL,
+    cost REAL,
+    baseline_cost REAL,
+    gap_hours REAL
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS notifications (
+    report_type TEXT NOT NULL,
+    period TEXT NOT NULL,
+    subject TEXT,
+    sent TEXT,
+    PRIMARY KEY (report_type, period)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS journal_records (
+    id INTEGER PRIMARY KEY,
+    applied TEXT,
+    written TEXT
+);
+
+CREATE TABLE IF NOT EXISTS state (
+    key TEXT PRIMARY KEY,
+    value TEXT,
+    updated TEXT
+) WITHOUT ROWID;
+"""
+
+def _ts(value):
+    """Store timestamps as sortable 'YYYY-MM-DD HH:MM:SS' text"""
+    if value is None:
+        return None
+    if isinstance(value, datetime):
+        return value.strftime('%Y-%m-%d %H:%M:%S')
+    return str(value).replace('T', ' ')[:19]
+
+def connect(db_path=DB_FILE):
+    """Open the store in WAL mode (readers never block the writer)"""
+    # A cycle hands its connection between worker threads (never two at once)
+    conn = sqlite3.connect(db_path, timeout=BUSY_TIMEOUT_MS / 1000, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+    conn.executescript(SCHEMA)
+    return conn
+
+# ============================================================================
+# Writers (callers wrap a cycle in `with conn:` so it commits atomically)
+# ============================================================================
+
+def record_reading(conn, reading, conflict='REPLACE'):
+    """Insert one monitoring reading (conflict='IGNORE' keeps an existing row)"""
+    placeholders = ', '.join('?' for _ in Reading._fields)
+    conn.execute(f"INSERT OR {conflict} INTO readings VALUES ({placeholders})",
+                 (_ts(reading.timestamp),) + tuple(reading[1:]))
+
+def record_decision(conn, decision):
+    """Insert (or replace) one decision"""
+    conn.execute("INSERT OR REPLACE INTO decisions VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                 (_ts(decision.timestamp), decision.soc_percent, decision.solar_kw,
+                  decision.hours_to_peak, int(bool(decision.in_peak)),
+                  int(bool(decision.should_charge)), decision.desired_mode, decision.reason))
+
+def record_mode_change(conn, timestamp, from_mode, to_mode):
+    """Record a mode switch"""
+    conn.execute("INSERT OR IGNORE INTO mode_changes VALUES (?, ?, ?)",
+                 (_ts(timestamp), from_mode, to_mode))
+
+def record_peak_transition(conn, timestamp, state):
+    """Record a peak state change ('Peak-YYYY-MM-DD' or 'OffPeak-YYYY-MM-DD')"""
+    conn.execute("INSERT OR IGNORE INTO peak_transitions VALUES (?, ?)",
+                 (_ts(timestamp), state))
+
+def add_ledger_days(conn, entries):
+    """Add daily ledger entries (period 'YYYY-MM-DD'), summing into days already present"""
+    columns = LedgerEntry._fields[1:]
+    updates = ', '.join(f"{c} = {c} + excluded.{c}" for c in columns)
+    conn.executemany(
+        f"INSERT INTO energy_ledger VALUES ({', '.join('?' for _ in LedgerEntry._fields)}) "
+        f"ON CONFLICT(period) DO UPDATE SET {updates}",
+        entries)
+
+def claim_notification(conn, report_type, period, subject):
+    """Mark a notice as sent; False if it already was (or another run has claimed it)"""
+    cursor = conn.execute("INSERT OR IGNORE INTO notifications VALUES (?, ?, ?, ?)",
+                          (report_type, period, subject, _ts(datetime.now())))
+    return cursor.rowcount == 1
+
+def notification_sent(conn, report_type, period):
+    """True if a notice has already been claimed (cheap check before building an expensive one)"""
+    return conn.execute("SELECT 1 FROM notifications WHERE report_type = ? AND period = ?",
+                        (report_type, period)).fetchone() is not None
+
+def release_notification(conn, report_type, period):
+    """Undo a claim after the notice failed to send"""
+    conn.execute("DELETE FROM notifications WHERE report_type = ? AND period = ?", (report_type, period))
+
+def mark_journal_record(conn, record_id, stage):
+    """Note that a journal record reached a stage ('applied' to the store, 'written' to the flat files)"""
+    conn.execute(f"INSERT INTO journal_records (id, {stage}) VALUES (?, ?) "
+                 f"ON CONFLICT(id) DO UPDATE SET {stage} = excluded.{stage}", (record_id, _ts(datetime.now())))
+
+def journal_record_done(conn, record_id, stage):
+    """True if a journal record already reached a stage"""
+    row = conn.execute(f"SELECT {stage} FROM journal_records WHERE id = ?", (record_id,)).fetchone()
+    return row is not None and row[0] is not None
+
+def forget_journal_records(conn, through_id):
+    """Drop the stages of journal records up to an id (once the journal no longer holds them)"""
+    conn.execute("DELETE FROM journal_records WHERE id <= ?", (through_id,))
+
+def get_state(conn, key):
+    """Read a state value (e.g. 'last_mode', 'peak_state')"""
+    row = conn.execute("SELECT value FROM state WHERE key = ?", (key,)).fetchone()
+    return row[0] if row else None
+
+def set_state(conn, key, value, mirror_file=None):
+    """
+    Write a state value. If mirror_file is given, the value is also written
+    there atomically so `cat peak_state.txt` keeps working for operators.
+    """
+    conn.execute("INSERT OR REPLACE INTO state VALUES (?, ?, ?)",
+                 (key, value, _ts(datetime.now())))
+    if mirror_file:
+        tmp_path = f"{mirror_file}.tmp"
+        with open(tmp_path, 'w') as f:
+            f.write(value)
+        os.replace(tmp_path, mirror_file)
+
+# ============================================================================
+# Queries (range scans on the timestamp primary keys)
+# ============================================================================
+
+def _between(conn, table, record_type, since, until):
+    sql = f"SELECT {', '.join(record_type._fields)} FROM {table} WHERE timestamp >= ?"
+    params = [_ts(since) or '']
+    if until is not None:
+        sql += " AND timestamp <= ?"
+        params.append(_ts(until))
+    sql += " ORDER BY timestamp"
+    return [record_type(*row) for row in conn.execute(sql, params)]
+
+def readings_between(conn, since=None, until=None):
+    """Readings in [since, until], oldest first"""
+    return _between(conn, 'readings', Reading, since, until)
+
+def decisions_between(conn, since=None, until=None):
+    """Decisions in [since, until], oldest first"""
+    return [d._replace(in_peak=bool(d.in_peak), should_charge=bool(d.should_charge))
+            for d in _between(conn, 'decisions', Decision, since, until)]
+
+def mode_changes_between(conn, since=None, until=None):
+    """Mode switches in [since, until], oldest first"""
+    return _between(conn, 'mode_changes', ModeChange, since, until)
+
+def peak_transitions_between(conn, since=None, until=None):
+    """Peak state transitions in [since, until], oldest first"""
+    return _between(conn, 'peak_transitions', PeakTransition, since, until)
+
+def ledger_totals(conn, level='day', since=None, until=None):
+    """Ledger summed per 'day', 'month' or 'year' (since/until are 'YYYY-MM-DD'), oldest first"""
+    width = {'day': 10, 'month': 7, 'year': 4}[level]
+    sums = ', '.join(f"SUM({c})" for c in LedgerEntry._fields[1:])
+    sql = f"SELECT substr(period, 1, {width}) AS p, {sums} FROM energy_ledger WHERE period >= ?"
+    params = [since or '']
+    if until is not None:
+        sql += " AND period <= ?"
+        params.append(until)
+    sql += " GROUP BY p ORDER BY p"
+    return [LedgerEntry(*row) for row in conn.execute(sql, params)]
+
+# Bucket key per aggregation level, computed from the 'YYYY-MM-DD HH:MM:SS' text
+BUCKET_KEYS = {
+    '15min': "substr(timestamp, 1, 14) || printf('%02d', CAST(substr(timestamp, 15, 2) AS INTEGER) / 15 * 15)",
+    'hour': "substr(timestamp, 1, 13)",
+    'day': "substr(timestamp, 1, 10)",
+}
+BUCKET_FIELDS = ('bucket', 'readings', 'soc_avg', 'soc_min', 'soc_max', 'solar_kw', 'home_load_kw',
+                 'grid_kw', 'battery_kw')
+
+def reading_buckets(conn, level, since=None, until=None):
+    """Readings in [since, until] averaged per '15min', 'hour' or 'day' bucket, as tuples of BUCKET_FIELDS"""
+    sql = (f"SELECT {BUCKET_KEYS[level]} AS b, COUNT(*), AVG(soc_percent), MIN(soc_percent), "
+           f"MAX(soc_percent), AVG(solar_kw), AVG(home_load_kw), AVG(grid_kw), AVG(battery_kw) "
+           f"FROM readings WHERE timestamp >= ?")
+    params = [_ts(since) or '']
+    if until is not None:
+        sql += " AND timestamp <= ?"
+        params.append(_ts(until))
+    return conn.execute(sql + " GROUP BY b ORDER BY b", params).fetchall()
+
+def latest_reading(conn, at_or_before=None):
+    """Most recent reading at or before a time (default: newest overall)"""
+    sql = f"SELECT {', '.join(Reading._fields)} FROM readings"
+    params = []
+    if at_or_before is not None:
+        sql += " WHERE timestamp <= ?"
+        params.append(_ts(at_or_before))
+    row = conn.execute(sql + " ORDER BY timestamp DESC LIMIT 1", params).fetchone()
+    return Reading(*row) if row else None
+
+# ============================================================================
+# Import of the existing flat files
+# ============================================================================
+
+LOG_LINE = re.compile(r'(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}) - (.*)')
+SOC_LINE = re.compile(r'SOC: ([\d.]+)%, Solar: ([-\d.]+)kW, Status: (.*)')
+
+def _float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+def import_readings(conn, log_dir=LOG_DIR):
+    """Import continuous_monitoring.csv (live and archived)"""
+    count = 0
+    for reading in iter_readings(load_columns(Path(log_dir) / MONITORING_LOG.name)):
+        record_reading(conn, reading, conflict='IGNORE')
+        count += 1
+    return count
+
+def import_intelligence_log(conn, log_dir=LOG_DIR):
+    """Import decisions, mode changes and peak transitions from solar_intelligence.log"""
+    counts = {'decisions': 0, 'mode_changes': 0, 'peak_transitions': 0}
+    soc = solar = hours_to_peak = None
+    in_peak = False
+    pending = None
+
+    for line in read_log_lines(log_path=Path(log_dir) / INTELLIGENCE_LOG.name):
+        match = LOG_LINE.match(line.rstrip('\n'))
+        if not match:
+            continue
+        timestamp, message = match.groups()
+
+        soc_match = SOC_LINE.match(message)
+        if soc_match:
+            soc, solar = float(soc_match.group(1)), float(soc_match.group(2))
+            status = soc_match.group(3)
+            in_peak = status == 'IN PEAK'
+            hours_to_peak = 0.0 if in_peak else _float(status.split('h')[0])
+        elif message.startswith('Decision: '):
+            pending = (timestamp, message[len('Decision: '):])
+        elif message.startswith('Action: ') and pending:
+            should_charge = message == 'Action: Grid charge'
+            conn.execute("INSERT OR IGNORE INTO decisions VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                         (pending[0], soc, solar, hours_to_peak, int(in_peak), int(should_charge),
+                          'BACKUP' if should_charge else 'TOU', pending[1]))
+            counts['decisions'] += 1
+            pending = None
+        elif message.startswith('Mode changed: '):
+            from_mode, _, to_mode = message[len('Mode changed: '):].partition(' → ')
+            record_mode_change(conn, timestamp, from_mode, to_mode)
+            counts['mode_changes'] += 1
+        elif message.startswith(('Peak period started: ', 'Peak period ended: ')):
+            record_peak_transition(conn, timestamp, message.split(': ', 1)[1])
+            counts['peak_transitions'] += 1
+    return counts
+
+def import_state_files(conn, log_dir=LOG_DIR):
+    """Seed current state from last_mode.txt and peak_state.txt"""
+    for key, name in (('last_mode', STATE_FILE.name), ('peak_state', PEAK_STATE_FILE.name)):
+        path = Path(log_dir) / name
+        try:
+            with open(path, 'r') as f:
+                value = f.read().strip()
+        except FileNotFoundError:
+            continue
+        if value and get_state(conn, key) is None:
+            set_state(conn, key, value)
+
+def import_existing_files(conn, log_dir=LOG_DIR):
+    """
+    Import all existing flat files of a log directory in one transaction,
+    marking it complete with IMPORTED_KEY (a failed import leaves no flag).
+    Returns: (readings, {decisions, mode_changes, peak_transitions})
+    """
+    with conn:
+        readings = import_readings(conn, log_dir)
+        counts = import_intelligence_log(conn, log_dir)
+        import_state_files(conn, log_dir)
+        set_state(conn, IMPORTED_KEY, _ts(datetime.now()))
+    return readings, counts
+
+def is_imported(conn):
+    """True once the flat files have been imported into this store"""
+    return get_state(conn, IMPORTED_KEY) is not None
+
+if __name__ == "__main__":
+    # Fleet mode: pass each site's log directory as an argument
+    log_dirs = [Path(arg) for arg in sys.argv[1:]] or [LOG_DIR]
+    result = True
+    for log_dir in log_dirs:
+        try:
+            conn = connect(log_dir / DB_FILE.name)
+            try:
+                readings, counts = import_existing_files(conn, log_dir)
+            finally:
+                conn.close()
+            print(f"✓ {log_dir}: imported {readings} readings, {counts['decisions']} decisions, "
+                  f"{counts['mode_changes']} mode changes, {counts['peak_transitions']} peak transitions")
+        except Exception as e:
+            print(f"✗ {log_dir}: import failed: {e}")
+            result = False
+    sys.exit(0 if result else 1)
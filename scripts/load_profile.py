@@ -0,0 +1,229 @@
+#!/volume1/docker/franklin/venv311/bin/python3
+"""
+Home Load Profile - Expected Peak-Window Consumption and Daily Target SOC
+Learns how much energy the battery has to supply during the peak window
+(home load not covered by solar) by weekday, season and temperature band,
+and turns it into a per-day target SOC
+
+Each completed day adds its peak-window energy (integrated from
+continuous_monitoring.csv, whose hourly aggregates count for their whole
+hour, so the first build learns from the full archive) and mean peak-window temperature (from
+weather_data.csv) to running mean/variance statistics at four levels:
+season/weekday/temperature band, season/weekday, season and overall.
+Run nightly (e.g. 12:30 AM, after log_archive.py): only days since the
+last run are read. The run then precomputes the target SOC for the next
+LOOKAHEAD_DAYS from the most specific level with MIN_DAYS samples:
+
+    END_OF_PEAK_RESERVE_SOC + (mean + LOAD_STD_MARGIN * std) as % of capacity
+    + TARGET_MARGIN_PERCENT, between MIN_TARGET_SOC and TARGET_SOC
+
+Temperature uses the latest day's band (tomorrow is usually like today).
+With DYNAMIC_TARGET_SOC in smart_decision.py the decision cycle looks its
+day up in the history store (one state read, one dict lookup); without a
+precomputed target it keeps TARGET_SOC.
+"""
+import json
+import math
+import sys
+from datetime import date, datetime, timedelta
+
+import numpy as np
+
+import history_store
+from charge_planner import BATTERY_CAPACITY_KWH
+from log_archive import WEATHER_LOG, read_rows, segment_paths, segment_tier
+from readings import read_columns
+
+SEASON_BY_MONTH = {12: 'winter', 1: 'winter', 2: 'winter', 3: 'spring', 4: 'spring', 5: 'spring',
+                   6: 'summer', 7: 'summer', 8: 'summer', 9: 'fall', 10: 'fall', 11: 'fall'}
+TEMPERATURE_BANDS_F = (50, 65, 80, 90)
+
+MIN_DAYS = 4                    # Samples a level needs before it's used
+LOAD_STD_MARGIN = 1.0           # Plan for mean + this many standard deviations
+TARGET_MARGIN_PERCENT = 10.0    # Extra SOC on top of the expected need
+END_OF_PEAK_RESERVE_SOC = 20.0  # SOC to still have when the peak ends
+MIN_TARGET_SOC = 50.0
+LOOKAHEAD_DAYS = 7
+FIRST_BUILD_DAYS = 400          # History read on the first run
+MIN_COVERAGE = 0.8              # Share of the peak window readings must cover
+MAX_SAMPLE_GAP_MINUTES = 30     # A reading stands for at most this long...
+# ...an archived aggregate for its interval (daily means can't resolve a peak window)
+TIER_SPAN_MINUTES = {'raw': MAX_SAMPLE_GAP_MINUTES, 'hourly': 60}
+
+PROFILE_KEY = 'load_profile'
+TARGETS_KEY = 'load_profile_targets'
+
+def temperature_band(temp_f):
+    return None if temp_f is None else int(np.searchsorted(TEMPERATURE_BANDS_F, temp_f, side='right'))
+
+def profile_keys(day, band):
+    """Statistics keys for a day, most specific first"""
+    season = SEASON_BY_MONTH[day.month]
+    keys = [f"{season}|{day.weekday()}", season, 'all']
+    if band is not None:
+        keys.insert(0, f"{season}|{day.weekday()}|{band}")
+    return keys
+
+def load_net_kw(live_path, since, until):
+    """
+    Home load not covered by solar from every tier in [since, until).
+    Returns: (times, net kW, minutes each reading stands for at most), sorted by time
+    """
+    parts = []
+    for path in segment_paths(live_path, since, until):
+        span = TIER_SPAN_MINUTES.get(segment_tier(live_path, path))
+        columns = read_columns(path) if span else None
+        if columns is None:
+            continue
+        times = columns['timestamp']
+        keep = (times >= np.datetime64(since)) & (times < np.datetime64(until))
+        net_kw = np.clip(np.nan_to_num(columns['home_load_kw']) - np.nan_to_num(columns['solar_kw']), 0, None)
+        parts.append((times[keep], net_kw[keep], np.full(int(keep.sum()), float(span))))
+    if not parts:
+        return np.array([], dtype='datetime64[s]'), np.array([]), np.array([])
+    times, net_kw, spans = (np.concatenate(arrays) for arrays in zip(*parts))
+    order = np.argsort(times, kind='stable')
+    return times[order], net_kw[order], spans[order]
+
+def window_energy(times, net_kw, spans, start, end):
+    """kWh supplied over [start, end) from readings, or None with too little coverage"""
+    lo, hi = np.searchsorted(times, np.datetime64(start)), np.searchsorted(times, np.datetime64(end))
+    if hi <= lo:
+        return None
+    stamps = times[lo:hi]
+    following = np.append(stamps[1:], np.datetime64(end))
+    hours = np.minimum((following - stamps).astype('timedelta64[s]').astype(float), spans[lo:hi] * 60) / 3600
+    if hours.sum() < MIN_COVERAGE * (end - start).total_seconds() / 3600:
+        return None
+    return float((net_kw[lo:hi] * hours).sum())
+
+def day_samples(live_path, calendar, first_day, last_day):
+    """
+    Peak-window energy and temperature of each day in [first_day, last_day].
+    Returns: [(day, kWh, mean temp_f or None)], days with gaps left out
+    """
+    since = datetime.combine(first_day, datetime.min.time())
+    until = datetime.combine(last_day + timedelta(days=1), datetime.min.time())
+    times, net_kw, spans = load_net_kw(live_path, since, until)
+
+    stamps, temps = [], []
+    for row in read_rows(WEATHER_LOG, since, until):
+        try:
+            temps.append(float(row['temp_f']))
+            stamps.append(row['timestamp'].replace('T', ' ')[:19])
+        except (KeyError, TypeError, ValueError):
+            continue
+    temp_times = np.array(stamps, dtype='datetime64[s]')
+    order = np.argsort(temp_times, kind='stable')
+    temp_times, temps = temp_times[order], np.array(temps, dtype=float)[order]
+
+    samples = []
+    day = first_day
+    while day <= last_day:
+        start_of_day = datetime.combine(day, datetime.min.time())
+        windows = calendar.peak_windows(start_of_day, start_of_day + timedelta(days=1))
+        energies = [window_energy(times, net_kw, spans, start, end) for start, end in windows]
+        if windows and None not in energies:
+            in_peak = np.concatenate([temps[np.searchsorted(temp_times, np.datetime64(start)):
+                                           np.searchsorted(temp_times, np.datetime64(end))]
+                                     for start, end in windows])
+            samples.append((day, sum(energies), float(in_peak.mean()) if len(in_peak) else None))
+        day += timedelta(days=1)
+    return samples
+
+class LoadProfile:
+    """Running peak-window energy statistics per key: [count, mean, M2]"""
+
+    def __init__(self, state=None):
+        state = state or {}
+        self.through = state.get('through')         # Last day included
+        self.last_temp_f = state.get('last_temp_f')
+        self.stats = state.get('stats', {})
+
+    def to_json(self):
+        return json.dumps({'through': self.through, 'last_temp_f': self.last_temp_f, 'stats': self.stats},
+                          separators=(',', ':'))
+
+    @classmethod
+    def from_json(cls, text):
+        return cls(json.loads(text) if text else None)
+
+    def add(self, day, kwh, temp_f):
+        for key in profile_keys(day, temperature_band(temp_f)):
+            stats = self.stats.setdefault(key, [0, 0.0, 0.0])
+            stats[0] += 1
+            delta = kwh - stats[1]
+            stats[1] += delta / stats[0]
+            stats[2] += delta * (kwh - stats[1])
+        self.through = day.isoformat()
+        if temp_f is not None:
+            self.last_temp_f = temp_f
+
+    def expected_kwh(self, day, temp_f=None):
+        """Planning energy for a day from its most specific trusted level: (kWh, key) or None"""
+        for key in profile_keys(day, temperature_band(temp_f)):
+            count, mean, m2 = self.stats.get(key, (0, 0.0, 0.0))
+            if count >= MIN_DAYS:
+                return mean + LOAD_STD_MARGIN * math.sqrt(m2 / (count - 1)), key
+        return None
+
+    def target_soc(self, day, max_target, temp_f=None):
+        """Target SOC for a day, or None without enough history"""
+        expected = self.expected_kwh(day, temp_f)
+        if expected is None:
+            return None
+        target = END_OF_PEAK_RESERVE_SOC + expected[0] / BATTERY_CAPACITY_KWH * 100 + TARGET_MARGIN_PERCENT
+        return round(min(max(target, MIN_TARGET_SOC), max_target), 1)
+
+def update(conn, live_path, calendar, max_target, today=None, rebuild=False):
+    """
+    Add the days since the last run and precompute the coming days' targets.
+    Returns: (profile, days added, {date: target})
+    """
+    today = today or date.today()
+    profile = LoadProfile() if rebuild else LoadProfile.from_json(history_store.get_state(conn, PROFILE_KEY))
+    first = (date.fromisoformat(profile.through) + timedelta(days=1) if profile.through
+             else today - timedelta(days=FIRST_BUILD_DAYS))
+    samples = day_samples(live_path, calendar, first, today - timedelta(days=1)) if first < today else []
+    for day, kwh, temp_f in samples:
+        profile.add(day, kwh, temp_f)
+    if not samples and first < today:
+        profile.through = (today - timedelta(days=1)).isoformat()
+
+    targets = {}
+    for offset in range(LOOKAHEAD_DAYS):
+        day = today + timedelta(days=offset)
+        target = profile.target_soc(day, max_target, profile.last_temp_f)
+        if target is not None:
+            targets[day.isoformat()] = target
+    with conn:
+        history_store.set_state(conn, PROFILE_KEY, profile.to_json())
+        history_store.set_state(conn, TARGETS_KEY, json.dumps(targets))
+    return profile, len(samples), targets
+
+def target_for(conn, day):
+    """Precomputed target SOC for a day, or None"""
+    stored = history_store.get_state(conn, TARGETS_KEY)
+    return json.loads(stored).get(day.isoformat()) if stored else None
+
+if __name__ == "__main__":
+    from smart_decision import HISTORY_DB, LOG_FILE, TARGET_SOC, site_calendar
+
+    conn = history_store.connect(HISTORY_DB)
+    try:
+        profile, added, targets = update(conn, LOG_FILE, site_calendar(), TARGET_SOC,
+                                         rebuild='--rebuild' in sys.argv)
+    except Exception as e:
+        print(f"✗ Load profile update failed: {e}")
+        sys.exit(1)
+    finally:
+        conn.close()
+
+    print(f"✓ Load profile: {added} day(s) added, through {profile.through} "
+          f"({profile.stats.get('all', [0])[0]} days total)")
+    if not targets:
+        print(f"  Not enough history yet (need {MIN_DAYS} days); decisions keep TARGET_SOC {TARGET_SOC:.0f}%")
+    for day, target in sorted(targets.items()):
+        kwh, key = profile.expected_kwh(date.fromisoformat(day), profile.last_temp_f)
+        print(f"  {day}: target {target:.0f}% (expect {kwh:.1f} kWh in peak, from '{key}')")
+    sys.exit(0)
@@ -0,0 +1,484 @@
+#!/volume1/docker/franklin/venv311/bin/python3
+"""
+Log Archive - Rotation, Retention and Readers
+Rotates the growing log files into compressed daily segments and
+downsamples old data into hourly and then daily aggregates
+
+Run daily shortly after midnight. The other scripts import the reader
+functions below so their queries span live and archived data transparently.
+"""
+import csv
+import gzip
+import os
+import re
+import shutil
+import sys
+from collections import deque
+from datetime import datetime, timedelta
+from pathlib import Path
+
+LOG_DIR = Path("/volume1/docker/franklin/logs")
+ARCHIVE_SUBDIR = "archive"  # Created next to each live file (one per site in fleet mode)
+MONITORING_LOG = LOG_DIR / "continuous_monitoring.csv"
+WEATHER_LOG = LOG_DIR / "weather_data.csv"
+TELEMETRY_LOG = LOG_DIR / "telemetry_aggregates.csv"
+INTELLIGENCE_LOG = LOG_DIR / "solar_intelligence.log"
+
+# Retention tiers
+RAW_RETENTION_DAYS = 30       # Full-resolution daily segments
+HOURLY_RETENTION_DAYS = 365   # Hourly aggregates; daily aggregates are kept forever
+LOG_RETENTION_DAYS = 90       # Full intelligence log; afterwards only key events are kept
+
+# Intelligence log lines preserved once a day falls out of LOG_RETENTION_DAYS
+LOG_EVENT_MARKERS = ('Mode changed', 'SWITCHING', 'Peak period', 'ERROR')
+
+DATE_PATTERN = re.compile(r'\d{4}-\d{2}-\d{2}$')
+
+# ============================================================================
+# Segment naming
+# ============================================================================
+
+def archive_dir(live_path):
+    """Directory holding the archived segments of a live file"""
+    return Path(live_path).parent / ARCHIVE_SUBDIR
+
+def segment_path(live_path, period, tier='raw'):
+    """Archive path for a segment: raw=YYYY-MM-DD, hourly=YYYY-MM, daily/events=YYYY"""
+    live_path = Path(live_path)
+    tier_part = '' if tier == 'raw' else f"{tier}."
+    return archive_dir(live_path) / f"{live_path.stem}.{tier_part}{period}{live_path.suffix}.gz"
+
+def list_segments(live_path, tier='raw'):
+    """Return [(period, path)] for one tier of archived segments, oldest first"""
+    live_path = Path(live_path)
+    prefix = f"{live_path.stem}." + ('' if tier == 'raw' else f"{tier}.")
+    suffix = f"{live_path.suffix}.gz"
+    segments = []
+    if not archive_dir(live_path).exists():
+        return segments
+    for path in archive_dir(live_path).glob(f"{prefix}*{suffix}"):
+        period = path.name[len(prefix):-len(suffix)]
+        if tier == 'raw' and not DATE_PATTERN.match(period):
+            continue
+        segments.append((period, path))
+    return sorted(segments)
+
+def segment_tier(live_path, path):
+    """Tier of a file segment_paths() listed: 'raw' (also the live file), 'hourly', 'daily' or 'events'"""
+    rest = Path(path).name[len(Path(live_path).stem) + 1:]
+    for tier in ('hourly', 'daily', 'events'):
+        if rest.startswith(f"{tier}."):
+            return tier
+    return 'raw'
+
+def _overlaps(period, since_str, until_str):
+    """True if a YYYY / YYYY-MM / YYYY-MM-DD period overlaps the window"""
+    if since_str and period < since_str[:len(period)]:
+        return False
+    if until_str and period > until_str[:len(period)]:
+        return False
+    return True
+
+def _timestamp_key(value):
+    """Normalize 'YYYY-MM-DD HH:MM:SS' and ISO 'YYYY-MM-DDTHH:MM:SS.ffffff' for comparison"""
+    return value.replace('T', ' ')[:19]
+
+# ============================================================================
+# Readers
+# ============================================================================
+
+def segment_paths(live_path, since=None, until=None):
+    """
+    List every file holding rows in [since, until], oldest first.
+    Daily, hourly and raw tiers never overlap in time, so concatenating
+    them in this order (followed by the live file) stays chronological.
+    """
+    since_str = since.strftime('%Y-%m-%d') if since else None
+    until_str = until.strftime('%Y-%m-%d') if until else None
+
+    paths = []
+    for tier in ('daily', 'hourly', 'raw'):
+        for period, path in list_segments(live_path, tier):
+            if _overlaps(period, since_str, until_str):
+                paths.append(path)
+    if Path(live_path).exists():
+        paths.append(Path(live_path))
+    return paths
+
+def open_segment(path):
+    """Open a live or archived (gzip) file for text reading"""
+    if str(path).endswith('.gz'):
+        return gzip.open(path, 'rt', newline='')
+    return open(path, 'r', newline='')
+
+def read_rows(live_path, since=None, until=None):
+    """Yield CSV rows as dicts from archived segments and the live file"""
+    since_key = since.strftime('%Y-%m-%d %H:%M:%S') if since else None
+    until_key = until.strftime('%Y-%m-%d %H:%M:%S') if until else None
+
+    for path in segment_paths(live_path, since, until):
+        with open_segment(path) as f:
+            for row in csv.DictReader(f):
+                key = _timestamp_key(row.get('timestamp') or '')
+                if since_key and key < since_key:
+                    continue
+                if until_key and key > until_key:
+                    continue
+                yield row
+
+def read_log_lines(since=None, log_path=INTELLIGENCE_LOG):
+    """Yield intelligence log lines on or after `since` from archive and live log"""
+    since_str = since.strftime('%Y-%m-%d') if since else None
+    since_key = since.strftime('%Y-%m-%d %H:%M:%S') if since else None
+
+    paths = [path for tier in ('events', 'raw')
+             for period, path in list_segments(log_path, tier)
+             if _overlaps(period, since_str, None)]
+    if Path(log_path).exists():
+        paths.append(Path(log_path))
+
+    for path in paths:
+        with open_segment(path) as f:
+            for line in f:
+                if since_key and line[:19] < since_key:
+                    continue
+                yield line
+
+def tail_log_lines(count, log_path=INTELLIGENCE_LOG):
+    """Return the last `count` log lines, reaching into archived segments if needed"""
+    lines = deque(maxlen=count)
+    if Path(log_path).exists():
+        with open(log_path, 'r') as f:
+            lines.extend(f)
+
+    for period, path in reversed(list_segments(log_path, 'raw')):
+        if len(lines) >= count:
+            break
+        with open_segment(path) as f:
+            older = deque(f, maxlen=count - len(lines))
+        lines.extendleft(reversed(older))
+    return list(lines)
+
+# ============================================================================
+# Rotation
+# ============================================================================
+
+def _append_rows(path, header, rows):
+    """Append rows to a gzip CSV segment (gzip members concatenate transparently)"""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    is_new = not path.exists()
+    with gzip.open(path, 'at', newline='') as f:
+        writer = csv.writer(f)
+        if is_new:
+            writer.writerow(header)
+        writer.writerows(rows)
+
+def _append_lines(path, lines):
+    """Append text lines to a gzip log segment"""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with gzip.open(path, 'at') as f:
+        f.writelines(lines)
+
+def merge_segment_rows(live_path, date_str, fields, rows):
+    """
+    Merge dict rows into a raw day segment, keeping it in timestamp order
+    (for backfilled history). The segment is rewritten atomically.
+    """
+    path = segment_path(live_path, date_str)
+    header, existing = list(fields), []
+    if path.exists():
+        with open_segment(path) as f:
+            reader = csv.DictReader(f)
+            header = reader.fieldnames or header
+            existing = list(reader)
+    merged = sorted(existing + list(rows), key=lambda row: _timestamp_key(row.get('timestamp') or ''))
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(path.name + '.tmp')
+    with gzip.open(tmp_path, 'wt', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=header, extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(merged)
+    os.replace(tmp_path, path)
+    return len(merged)
+
+def _claim_live_file(live_path):
+    """
+    Atomically move the live file aside so writers start a fresh one.
+    A leftover file from an interrupted run is processed before the live file.
+    """
+    rotating = live_path.with_name(live_path.name + '.rotating')
+    _finish_rotation(rotating)
+    if rotating.exists():
+        return rotating
+    if not live_path.exists():
+        return None
+    os.replace(live_path, rotating)
+    return rotating
+
+def _stage_segment(path):
+    """A temporary copy of a segment to append to (moved into place by _commit_rotation)"""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    staged = path.with_name(path.name + '.tmp')
+    if path.exists():
+        shutil.copyfile(path, staged)
+    elif staged.exists():
+        staged.unlink()
+    return staged
+
+def _stage_csv_segment(path, header):
+    """
+    Stage a CSV segment for rows written under `header`.
+    Returns: (staged path, header the rows must follow). A segment with
+    different columns is rewritten under the union of both headers, so a
+    segment never mixes rows of two layouts under one header line.
+    """
+    staged = _stage_segment(path)
+    if not staged.exists():
+        return staged, header
+    with open_segment(path) as f:
+        reader = csv.DictReader(f)
+        existing_header = reader.fieldnames or []
+        if existing_header == header:
+            return staged, header
+        merged_header = existing_header + [name for name in header if name not in existing_header]
+        if merged_header == existing_header:
+            return staged, existing_header
+        with gzip.open(staged, 'wt', newline='') as out:
+            writer = csv.DictWriter(out, fieldnames=merged_header, restval='')
+            writer.writeheader()
+            writer.writerows(reader)
+    return staged, merged_header
+
+def _append_csv_segment(path, header, rows):
+    """Stage a segment with rows appended (see _stage_csv_segment); returns the staged path"""
+    staged, out_header = _stage_csv_segment(path, header)
+    if out_header != header:
+        positions = [header.index(name) if name in header else None for name in out_header]
+        rows = [[row[i] if i is not None and i < len(row) else '' for i in positions] for row in rows]
+    _append_rows(staged, out_header, rows)
+    return staged
+
+def _finish_pending(live_path):
+    """Complete rotations and retention steps a crash left committed but unfinished"""
+    live_path = Path(live_path)
+    if not archive_dir(live_path).exists():
+        return
+    for manifest in archive_dir(live_path).glob(f"{live_path.stem}.*.done"):
+        _finish_rotation(manifest.with_name(manifest.name[:-len('.done')]))
+
+def _commit_rotation(rotating, staged):
+    """
+    Swap staged segments into place and drop the claimed file, so a crash
+    never appends a claimed file twice: once the manifest exists the claim
+    counts as done, and a later run finishes the renames from it.
+    """
+    manifest = rotating.with_name(rotating.name + '.done')
+    tmp_path = manifest.with_name(manifest.name + '.tmp')
+    with open(tmp_path, 'w') as f:
+        f.writelines(f"{path}\n" for path in staged)
+    os.replace(tmp_path, manifest)
+    _finish_rotation(rotating)
+
+def _finish_rotation(rotating):
+    """Drop the source of a committed rotation and move its staged segments into place"""
+    manifest = rotating.with_name(rotating.name + '.done')
+    if not manifest.exists():
+        return
+    if rotating.exists():
+        rotating.unlink()
+    with open(manifest, 'r') as f:
+        for line in f:
+            staged = Path(line.rstrip('\n'))
+            if staged.exists():
+                os.replace(staged, staged.with_name(staged.name[:-len('.tmp')]))
+    manifest.unlink()
+
+def rotate_csv(live_path):
+    """Move all rows of a live CSV into per-day compressed segments"""
+    rotating = _claim_live_file(Path(live_path))
+    if rotating is None:
+        return 0
+
+    by_date = {}
+    with open(rotating, 'r', newline='') as f:
+        reader = csv.reader(f)
+        header = next(reader, None)
+        if header:
+            ts_index = header.index('timestamp')
+            for row in reader:
+                if len(row) > ts_index and row[ts_index]:
+                    by_date.setdefault(row[ts_index][:10], []).append(row)
+
+    staged = [_append_csv_segment(segment_path(live_path, date_str), header, rows)
+              for date_str, rows in by_date.items()]
+    _commit_rotation(rotating, staged)
+    return sum(len(rows) for rows in by_date.values())
+
+def rotate_log(log_path=INTELLIGENCE_LOG):
+    """Move all lines of the intelligence log into per-day compressed segments"""
+    rotating = _claim_live_file(Path(log_path))
+    if rotating is None:
+        return 0
+
+    by_date = {}
+    current_date = None
+    with open(rotating, 'r') as f:
+        for line in f:
+            if DATE_PATTERN.match(line[:10]):
+                current_date = line[:10]
+            # Continuation lines (no timestamp) stay with the previous entry
+            by_date.setdefault(current_date or datetime.now().strftime('%Y-%m-%d'), []).append(line)
+
+    staged = []
+    for date_str, lines in by_date.items():
+        staged.append(_stage_segment(segment_path(log_path, date_str)))
+        _append_lines(staged[-1], lines)
+    _commit_rotation(rotating, staged)
+    return sum(len(lines) for lines in by_date.values())
+
+# ============================================================================
+# Tiered retention
+# ============================================================================
+
+def _read_segment(path):
+    """Read a gzip CSV segment into (header, rows)"""
+    with open_segment(path) as f:
+        reader = csv.reader(f)
+        header = next(reader, [])
+        return header, [row for row in reader if row]
+
+def aggregate_rows(header, rows, key_length):
+    """
+    Downsample rows by timestamp prefix (13 chars = hour, 10 chars = day).
+    Numeric columns are averaged (weighted by 'samples' for already-aggregated
+    input), '*_min' / '*_max' columns keep their extremes, and cumulative
+    '*_total' counters and text columns keep the last value.
+    """
+    ts_index = header.index('timestamp')
+    samples_index = header.index('samples') if 'samples' in header else None
+    out_header = header if samples_index is not None else header + ['samples']
+
+    groups = {}
+    for row in rows:
+        groups.setdefault(row[ts_index][:key_length], []).append(row)
+
+    out_rows = []
+    for key, group in groups.items():
+        weights = [int(row[samples_index]) if samples_index is not None else 1 for row in group]
+        stamp = group[0][ts_index]
+        separator = stamp[10] if len(stamp) > 10 else ' '
+        suffix = ':00:00' if key_length == 13 else f'{separator}00:00:00'
+
+        out = []
+        for col, name in enumerate(header):
+            if col == ts_index:
+                out.append(key + suffix)
+                continue
+            if col == samples_index:
+                out.append(str(sum(weights)))
+                continue
+            last = group[-1][col] if col < len(group[-1]) else ''
+            if '_total' in name:
+                out.append(last)
+                continue
+            if name.endswith(('_min', '_max')):
+                extremes = [float(row[col]) for row in group if col < len(row) and row[col]]
+                pick = min if name.endswith('_min') else max
+                out.append(f'{pick(extremes):.3f}' if extremes else last)
+                continue
+            total = weight_sum = 0
+            for row, weight in zip(group, weights):
+                try:
+                    total += float(row[col]) * weight
+                    weight_sum += weight
+                except (ValueError, IndexError):
+                    pass
+            out.append(f'{total / weight_sum:.3f}' if weight_sum else last)
+        if samples_index is None:
+            out.append(str(sum(weights)))
+        out_rows.append(out)
+    return out_header, out_rows
+
+def apply_csv_retention(live_path, today):
+    """
+    Roll raw segments into hourly, and hourly months into daily aggregates.
+    Each source segment is committed like a rotation (staged output, then
+    manifest), so a crash never aggregates a segment twice.
+    """
+    raw_cutoff = (today - timedelta(days=RAW_RETENTION_DAYS)).strftime('%Y-%m-%d')
+    hourly_cutoff = (today - timedelta(days=HOURLY_RETENTION_DAYS)).strftime('%Y-%m')
+    _finish_pending(live_path)
+    rolled = 0
+
+    for date_str, path in list_segments(live_path, 'raw'):
+        if date_str >= raw_cutoff:
+            break
+        header, rows = _read_segment(path)
+        staged = []
+        if rows:
+            out_header, out_rows = aggregate_rows(header, rows, key_length=13)
+            staged.append(_append_csv_segment(segment_path(live_path, date_str[:7], 'hourly'),
+                                              out_header, out_rows))
+        _commit_rotation(path, staged)
+        rolled += 1
+
+    # Only whole months are rolled so a month file is never half-converted
+    for month, path in list_segments(live_path, 'hourly'):
+        if month >= hourly_cutoff:
+            break
+        header, rows = _read_segment(path)
+        staged = []
+        if rows:
+            out_header, out_rows = aggregate_rows(header, rows, key_length=10)
+            staged.append(_append_csv_segment(segment_path(live_path, month[:4], 'daily'),
+                                              out_header, out_rows))
+        _commit_rotation(path, staged)
+        rolled += 1
+
+    return rolled
+
+def apply_log_retention(today, log_path=INTELLIGENCE_LOG):
+    """Reduce old intelligence log segments to their key events (committed like apply_csv_retention)"""
+    cutoff = (today - timedelta(days=LOG_RETENTION_DAYS)).strftime('%Y-%m-%d')
+    _finish_pending(log_path)
+    rolled = 0
+    for date_str, path in list_segments(log_path, 'raw'):
+        if date_str >= cutoff:
+            break
+        with open_segment(path) as f:
+            events = [line for line in f if any(marker in line for marker in LOG_EVENT_MARKERS)]
+        staged = []
+        if events:
+            staged.append(_stage_segment(segment_path(log_path, date_str[:4], 'events')))
+            _append_lines(staged[-1], events)
+        _commit_rotation(path, staged)
+        rolled += 1
+    return rolled
+
+def archive_logs(today=None, log_dir=LOG_DIR):
+    """Rotate all logs in a log directory and apply tiered retention"""
+    today = today or datetime.now()
+    log_dir = Path(log_dir)
+
+    for name in (MONITORING_LOG.name, WEATHER_LOG.name, TELEMETRY_LOG.name):
+        live_path = log_dir / name
+        rotated = rotate_csv(live_path)
+        rolled = apply_csv_retention(live_path, today)
+        print(f"✓ {live_path.name}: {rotated} rows archived, {rolled} segments downsampled")
+
+    log_path = log_dir / INTELLIGENCE_LOG.name
+    rotated = rotate_log(log_path)
+    rolled = apply_log_retention(today, log_path)
+    print(f"✓ {log_path.name}: {rotated} lines archived, {rolled} segments reduced to events")
+    return True
+
+if __name__ == "__main__":
+    try:
+        # Fleet mode: pass each site's log directory as an argument
+        log_dirs = sys.argv[1:] or [LOG_DIR]
+        result = all(archive_logs(log_dir=log_dir) for log_dir in log_dirs)
+        sys.exit(0 if result else 1)
+    except Exception as e:
+        print(f"Error: {e}")
+        sys.exit(1)
@@ -8,23 +8,17 @@ behavior at critical decision points throughout the day. Can be disabled
 once confident in system operation.
 """
 import asyncio
-import smtplib
 from datetime import datetime
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
 from franklinwh import Client, TokenFetcher
+from log_archive import tail_log_lines
+from notifier import Notice, Notifier
 
 # REPLACE WITH YOUR FRANKLIN WH CREDENTIALS
 USERNAME = "YOUR_EMAIL@example.com"
 PASSWORD = "YOUR_PASSWORD"
 GATEWAY_ID = "YOUR_GATEWAY_ID"
 
-# REPLACE WITH YOUR EMAIL CONFIGURATION
-SMTP_SERVER = "smtp.gmail.com"
-SMTP_PORT = 587
-SENDER_EMAIL = "YOUR_EMAIL@example.com"
-SENDER_PASSWORD = "YOUR_APP_SPECIFIC_PASSWORD"  # App-specific password for Gmail
-RECIPIENT_EMAIL = "YOUR_EMAIL@example.com"
+# Email settings (SMTP server, sender, recipient) are in notifier.py
 
 # Milestone times (hours of day to send status emails)
 # Adjust based on your peak period and testing needs
@@ -35,9 +29,7 @@ INTELLIGENCE_LOG = "/volume1/docker/franklin/logs/solar_intelligence.log"
 def get_recent_log_entries(lines=30):
     """Get recent entries from intelligence log"""
     try:
-        with open(INTELLIGENCE_LOG, 'r') as f:
-            all_lines = f.readlines()
-            return ''.join(all_lines[-lines:])
+        return ''.join(tail_log_lines(lines, log_path=INTELLIGENCE_LOG))
     except Exception as e:
         return f"Could not read log: {e}"
 
@@ -58,8 +50,12 @@ async def get_current_status():
     except Exception as e:
         return None
 
-def send_milestone_email(hour, status, log_excerpt):
-    """Send milestone status email"""
+def milestone_period(now, hour):
+    """Notice period: one milestone email per day and hour"""
+    return now.strftime(f'%Y-%m-%d {hour:02d}')
+
+def milestone_notice(hour, status, log_excerpt):
+    """Build the milestone status email"""
     now = datetime.now()
 
     subject = f"Solar Intelligence Milestone - {hour}:00 Status"
@@ -92,23 +88,7 @@ This is an automated milestone report for testing.
 Full logs: /volume1/docker/franklin/logs/
 """
 
-    try:
-        msg = MIMEMultipart()
-        msg['From'] = SENDER_EMAIL
-        msg['To'] = RECIPIENT_EMAIL
-        msg['Subject'] = subject
-        msg.attach(MIMEText(body, 'plain'))
-
-        with smtplib.SMTP(SMTP_SERVER, SMTP_PORT) as server:
-            server.starttls()
-            server.login(SENDER_EMAIL, SENDER_PASSWORD)
-            server.send_message(msg)
-
-        print(f"✓ Milestone email sent for {hour}:00")
-        return True
-    except Exception as e:
-        print(f"✗ Failed to send email: {e}")
-        return False
+    return Notice('milestone', milestone_period(now, hour), subject, body)
 
 async def check_and_send_milestone():
     """Check if we're at a milestone hour and send email"""
@@ -116,15 +96,23 @@ async def check_and_send_milestone():
     current_hour = now.hour
 
     if current_hour in MILESTONES:
-        # Check if we already sent for this hour (within last 10 minutes)
-        minutes = now.minute
-        if minutes < 10:  # Only send in first 10 minutes of the hour
-            print(f"Milestone hour {current_hour}:00 - sending email")
-            status = await get_current_status()
-            log_excerpt = get_recent_log_entries(30)
-            send_milestone_email(current_hour, status, log_excerpt)
-        else:
-            print(f"Milestone hour {current_hour}:00 but already past window")
+        # Sent at most once per milestone hour, however often this runs;
+        # the cloud is only asked for status when an email will go out
+        notifier = Notifier()
+        if notifier.already_sent('milestone', milestone_period(now, current_hour)):
+            print(f"Milestone email for {current_hour}:00 already sent")
+            return
+        print(f"Milestone hour {current_hour}:00 - sending email")
+        status = await get_current_status()
+        log_excerpt = get_recent_log_entries(30)
+        notifier.queue(milestone_notice(current_hour, status, log_excerpt))
+        try:
+            if await notifier.flush():
+                print(f"✓ Milestone email sent for {current_hour}:00")
+            else:
+                print(f"Milestone email for {current_hour}:00 already sent")
+        except Exception as e:
+            print(f"✗ Failed to send email: {e}")
     else:
         print(f"Not a milestone hour (current: {current_hour}:00)")
 
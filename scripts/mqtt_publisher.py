@@ -0,0 +1,366 @@
+#!/volume1/docker/franklin/venv311/bin/python3
+"""
+MQTT State Publisher
+Publishes each reading, the battery mode, peak state and decision reason
+to MQTT as retained messages, so home automation gets pushed updates
+instead of polling get_battery_status.py
+
+Only values that changed are published. publish() never waits: messages
+go into a bounded queue that a background task sends over one connection
+(reconnecting with backoff and re-sending the current state); when the
+queue is full the oldest message is dropped. Plain MQTT 3.1.1, QoS 0,
+no extra packages.
+
+Topics, per site: franklin/<site>/soc, solar_kw, battery_kw, grid_kw,
+home_load_kw, grid_status, mode, peak (on/off), decision (JSON with mode
+and reason), reading (JSON of the full reading).
+
+Run with --broker to start a local stand-in broker that prints what it
+receives (set MQTT_HOST = "127.0.0.1" and MQTT_PORT = BROKER_PORT to use
+it); run without arguments for a self-check against a temporary broker.
+"""
+import asyncio
+import json
+import struct
+import sys
+import time
+from datetime import datetime
+
+# ⚠️ REPLACE WITH YOUR BROKER
+MQTT_HOST = "homeassistant.local"
+MQTT_PORT = 1883
+MQTT_USERNAME = None
+MQTT_PASSWORD = None
+TOPIC_PREFIX = "franklin"
+CLIENT_ID = "franklin-automation"
+
+QUEUE_SIZE = 200
+KEEPALIVE_SECONDS = 60
+CONNECT_TIMEOUT_SECONDS = 5
+MAX_BACKOFF_SECONDS = 60
+CLOSE_TIMEOUT_SECONDS = 2       # How long a one-shot run waits to flush on exit
+BROKER_PORT = 1884
+
+READING_TOPICS = ('soc_percent', 'solar_kw', 'battery_kw', 'grid_kw', 'home_load_kw', 'grid_status')
+
+# ============================================================================
+# MQTT 3.1.1 packets
+# ============================================================================
+
+CONNECT, CONNACK, PUBLISH, SUBSCRIBE, SUBACK, PINGREQ, PINGRESP, DISCONNECT = (
+    0x10, 0x20, 0x30, 0x82, 0x90, 0xC0, 0xD0, 0xE0)
+
+def _length(n):
+    """Variable-length 'remaining length' encoding"""
+    out = bytearray()
+    while True:
+        n, digit = divmod(n, 128)
+        out.append(digit | (0x80 if n else 0))
+        if not n:
+            return bytes(out)
+
+def _string(value):
+    data = value.encode() if isinstance(value, str) else value
+    return struct.pack('!H', len(data)) + data
+
+def packet(kind, body=b''):
+    return bytes([kind]) + _length(len(body)) + body
+
+def connect_packet(client_id, username=None, password=None, keepalive=KEEPALIVE_SECONDS):
+    flags = 0x02  # Clean session
+    payload = _string(client_id)
+    if username:
+        flags |= 0x80
+        payload += _string(username)
+        if password:
+            flags |= 0x40
+            payload += _string(password)
+    return packet(CONNECT, _string('MQTT') + bytes([4, flags]) + struct.pack('!H', keepalive) + payload)
+
+def publish_packet(topic, payload, retain=True):
+    return packet(PUBLISH | (0x01 if retain else 0), _string(topic) + payload)
+
+async def read_packet(reader):
+    """(packet type byte, body) from a stream"""
+    header = (await reader.readexactly(1))[0]
+    length, shift = 0, 0
+    while True:
+        digit = (await reader.readexactly(1))[0]
+        length += (digit & 0x7F) << shift
+        shift += 7
+        if not digit & 0x80:
+            break
+    return header, await reader.readexactly(length)
+
+def parse_publish(header, body):
+    """(topic, payload, retain) of a PUBLISH body (QoS 0)"""
+    size = struct.unpack('!H', body[:2])[0]
+    return body[2:2 + size].decode(), body[2 + size:], bool(header & 0x01)
+
+# ============================================================================
+# Publisher
+# ============================================================================
+
+def encode(value):
+    """Payload bytes for a value: strings as-is, everything else as JSON"""
+    if isinstance(value, bytes):
+        return value
+    if isinstance(value, str):
+        return value.encode()
+    return json.dumps(value, separators=(',', ':')).encode()
+
+class MQTTPublisher:
+    """Change-only retained publishing through a bounded queue and one connection"""
+
+    def __init__(self, host=MQTT_HOST, port=MQTT_PORT, username=MQTT_USERNAME, password=MQTT_PASSWORD,
+                 client_id=CLIENT_ID, queue_size=QUEUE_SIZE):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.client_id = client_id
+        self.queue = asyncio.Queue(queue_size)
+        self.current = {}     # topic -> payload last queued
+        self.dropped = 0
+        self.sent = 0
+        self.connected = False
+        self.task = None
+
+    def publish(self, topic, value):
+        """Queue a retained message if the value changed; never blocks. Returns True if queued."""
+        payload = encode(value)
+        if self.current.get(topic) == payload:
+            return False
+        self.current[topic] = payload
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.queue.put_nowait((topic, payload))
+        if self.task is None:
+            self.task = asyncio.get_running_loop().create_task(self._run())
+        return True
+
+    async def _connect(self):
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port),
+                                                CONNECT_TIMEOUT_SECONDS)
+        writer.write(connect_packet(self.client_id, self.username, self.password))
+        await writer.drain()
+        kind, body = await asyncio.wait_for(read_packet(reader), CONNECT_TIMEOUT_SECONDS)
+        if kind != CONNACK or len(body) < 2 or body[1] != 0:
+            writer.close()
+            raise ConnectionError(f"Broker refused connection (code {body[1] if len(body) > 1 else '?'})")
+        return reader, writer
+
+    async def _drain_replies(self, reader):
+        """Read (and ignore) what the broker sends, to notice a dropped connection"""
+        while True:
+            await read_packet(reader)
+
+    async def _run(self):
+        """Send queued messages forever, reconnecting with backoff"""
+        backoff = 1
+        while True:
+            try:
+                reader, writer = await self._connect()
+            except (OSError, asyncio.TimeoutError, ConnectionError, asyncio.IncompleteReadError):
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, MAX_BACKOFF_SECONDS)
+                continue
+            backoff = 1
+            self.connected = True
+            replies = asyncio.get_running_loop().create_task(self._drain_replies(reader))
+            try:
+                # A new session starts from the current state, so nothing lost while away is missing
+                pending = {topic: payload for topic, payload in self._take_queued()}
+                for topic, payload in self.current.items():
+                    pending.setdefault(topic, payload)
+                for topic, payload in pending.items():
+                    writer.write(publish_packet(topic, payload))
+                    self.sent += 1
+                await writer.drain()
+
+                while not replies.done():
+                    try:
+                        topic, payload = await asyncio.wait_for(self.queue.get(), KEEPALIVE_SECONDS / 2)
+                    except asyncio.TimeoutError:
+                        writer.write(packet(PINGREQ))
+                    else:
+                        writer.write(publish_packet(topic, payload))
+                        self.sent += 1
+                    await writer.drain()
+            except (OSError, asyncio.IncompleteReadError):
+                pass
+            except asyncio.CancelledError:
+                writer.write(packet(DISCONNECT))
+                raise
+            finally:
+                self.connected = False
+                replies.cancel()
+                writer.close()
+
+    def _take_queued(self):
+        while not self.queue.empty():
+            yield self.queue.get_nowait()
+
+    async def close(self, timeout=CLOSE_TIMEOUT_SECONDS):
+        """Wait up to timeout for queued messages to go out, then disconnect"""
+        if self.task is None:
+            return
+        deadline = time.monotonic() + timeout
+        while (not self.queue.empty() or not self.connected) and time.monotonic() < deadline:
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0)
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        self.task = None
+
+# The publisher shared by every site in this process
+_publisher = None
+
+def get_publisher():
+    """The process-wide publisher"""
+    global _publisher
+    if _publisher is None:
+        _publisher = MQTTPublisher()
+    return _publisher
+
+async def close_publisher():
+    """Flush and close the process-wide publisher, if one was used"""
+    global _publisher
+    if _publisher is not None:
+        await _publisher.close()
+        _publisher = None
+
+def site_topic(site_name, name):
+    return f"{TOPIC_PREFIX}/{site_name}/{name}"
+
+def publish_reading(publisher, site_name, reading):
+    """Publish a reading's values (each on its own topic) and the full reading"""
+    for field in READING_TOPICS:
+        value = getattr(reading, field)
+        if value is not None:
+            publisher.publish(site_topic(site_name, field.replace('_percent', '')), value)
+    publisher.publish(site_topic(site_name, 'reading'), reading._asdict())
+
+def publish_cycle(publisher, site_name, reading, mode, in_peak, desired_mode, reason):
+    """Publish everything a decision cycle produced"""
+    publish_reading(publisher, site_name, reading)
+    if mode:
+        publisher.publish(site_topic(site_name, 'mode'), mode)
+    publisher.publish(site_topic(site_name, 'peak'), 'on' if in_peak else 'off')
+    publisher.publish(site_topic(site_name, 'decision'), {'mode': desired_mode, 'reason': reason})
+
+# ============================================================================
+# Local stand-in broker
+# ============================================================================
+
+class MQTTBroker:
+    """Minimal broker: keeps retained messages and forwards publishes to subscribers"""
+
+    def __init__(self, host='127.0.0.1', port=BROKER_PORT, echo=False):
+        self.host = host
+        self.port = port
+        self.echo = echo
+        self.retained = {}
+        self.received = []
+        self.subscribers = []   # (topic filter, writer)
+        self.server = None
+
+    async def start(self):
+        """Start listening (port 0 picks a free port)"""
+        self.server = await asyncio.start_server(self._session, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    @staticmethod
+    def matches(topic_filter, topic):
+        if topic_filter.endswith('#'):
+            return topic.startswith(topic_filter[:-1])
+        return topic_filter == topic
+
+    async def _session(self, reader, writer):
+        try:
+            while True:
+                kind, body = await read_packet(reader)
+                kind_type = kind & 0xF0
+                if kind_type == CONNECT:
+                    writer.write(packet(CONNACK, b'\x00\x00'))
+                elif kind_type == PUBLISH:
+                    topic, payload, retain = parse_publish(kind, body)
+                    self.received.append((topic, payload))
+                    if retain:
+                        self.retained[topic] = payload
+                    if self.echo:
+                        print(f"✓ {datetime.now().strftime('%H:%M:%S')} {topic} = {payload.decode(errors='replace')}")
+                    for topic_filter, subscriber in self.subscribers:
+                        if self.matches(topic_filter, topic):
+                            subscriber.write(publish_packet(topic, payload, retain=False))
+                elif kind_type == SUBSCRIBE & 0xF0:
+                    packet_id = body[:2]
+                    topic_filter = parse_publish(0, body[2:])[0]
+                    self.subscribers.append((topic_filter, writer))
+                    writer.write(packet(SUBACK, packet_id + b'\x00'))
+                    for topic, payload in self.retained.items():
+                        if self.matches(topic_filter, topic):
+                            writer.write(publish_packet(topic, payload))
+                elif kind_type == PINGREQ:
+                    writer.write(packet(PINGRESP))
+                elif kind_type == DISCONNECT:
+                    break
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        self.subscribers = [(f, w) for f, w in self.subscribers if w is not writer]
+        writer.close()
+
+async def run_broker(port=BROKER_PORT):
+    """Run a stand-in broker until interrupted"""
+    broker = MQTTBroker(port=port, echo=True)
+    await broker.start()
+    print(f"✓ MQTT stand-in broker listening on 127.0.0.1:{broker.port}")
+    await asyncio.Event().wait()
+
+async def self_check():
+    """Publish through a temporary broker and check change-only, retained delivery"""
+    from readings import Reading
+
+    broker = MQTTBroker(port=0)
+    await broker.start()
+    publisher = MQTTPublisher('127.0.0.1', broker.port)
+
+    reading = Reading('2026-01-01 12:00:00', 55.0, 4.2, -1.0, -3.0, 1.2, 'NORMAL',
+                      0, 0, 0, 0, 5.0, 'TOU')
+    started = time.perf_counter()
+    publish_cycle(publisher, 'home', reading, 'TOU', False, 'TOU', 'Solar is enough')
+    publish_seconds = time.perf_counter() - started
+    await asyncio.sleep(0.2)
+    first = len(broker.received)
+
+    # Same values again except the SOC and timestamp: only those topics go out
+    publish_cycle(publisher, 'home', reading._replace(timestamp='2026-01-01 12:15:00', soc_percent=57.0),
+                  'TOU', False, 'TOU', 'Solar is enough')
+    await publisher.close()
+    await asyncio.sleep(0.05)
+    second = len(broker.received) - first
+    await broker.stop()
+
+    return (first == 10 and second == 2 and broker.retained.get('franklin/home/soc') == b'57.0'
+            and publish_seconds < 0.01)
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ['--broker']:
+        try:
+            asyncio.run(run_broker(int(sys.argv[2]) if len(sys.argv) > 2 else BROKER_PORT))
+        except KeyboardInterrupt:
+            sys.exit(0)
+    if not asyncio.run(self_check()):
+        print("✗ MQTT publisher self-check failed")
+        sys.exit(1)
+    print("✓ MQTT publisher self-check passed (retained, change-only, non-blocking)")
+    sys.exit(0)
@@ -0,0 +1,254 @@
+#!/volume1/docker/franklin/venv311/bin/python3
+"""
+Notification Dispatcher
+Sends milestone, daily report and alert emails over one persistent SMTP
+connection, off the event loop, at most once per (report type, period)
+
+Notices are queued and sent on flush(); several pending notices go out as
+one digest email. Each notice is claimed in the history store before it
+is sent and released again if sending fails, so retried or overlapping
+runs can't send duplicates.
+
+Run with --sink to start a local stand-in SMTP server that prints what it
+receives (set SMTP_SERVER = "127.0.0.1", SMTP_PORT = SINK_PORT and
+SMTP_STARTTLS = False to use it); run without arguments for a self-check
+against a temporary sink.
+"""
+import asyncio
+import email
+import os
+import smtplib
+import sys
+import tempfile
+import threading
+from collections import namedtuple
+from datetime import datetime
+from email.mime.text import MIMEText
+
+import history_store
+
+# ⚠️ REPLACE WITH YOUR EMAIL CONFIGURATION
+SMTP_SERVER = "smtp.gmail.com"
+SMTP_PORT = 587
+SMTP_STARTTLS = True
+SENDER_EMAIL = "YOUR_EMAIL@example.com"
+SENDER_PASSWORD = "YOUR_APP_SPECIFIC_PASSWORD"  # App-specific password for Gmail
+RECIPIENT_EMAIL = "YOUR_EMAIL@example.com"
+
+SMTP_TIMEOUT_SECONDS = 30
+SINK_PORT = 8025
+
+Notice = namedtuple('Notice', ('report_type', 'period', 'subject', 'body'))
+
+class SMTPConnection:
+    """One persistent SMTP session, reopened when the server has dropped it"""
+
+    def __init__(self, host=SMTP_SERVER, port=SMTP_PORT, username=SENDER_EMAIL,
+                 password=SENDER_PASSWORD, starttls=SMTP_STARTTLS):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.starttls = starttls
+        self.server = None
+        self.lock = threading.Lock()  # Sends come from worker threads
+
+    def _connect(self):
+        server = smtplib.SMTP(self.host, self.port, timeout=SMTP_TIMEOUT_SECONDS)
+        if self.starttls:
+            server.starttls()
+            server.login(self.username, self.password)
+        self.server = server
+
+    def send(self, message):
+        """Send a message (blocking), reconnecting once if the session was closed"""
+        with self.lock:
+            for attempt in range(2):
+                if self.server is None:
+                    self._connect()
+                try:
+                    self.server.send_message(message)
+                    return
+                except smtplib.SMTPServerDisconnected:
+                    self.server = None
+                    if attempt:
+                        raise
+
+    def close(self):
+        """End the session"""
+        with self.lock:
+            if self.server is not None:
+                try:
+                    self.server.quit()
+                except smtplib.SMTPException:
+                    pass
+                self.server = None
+
+# Connections shared by every Notifier in this process, by server and account
+_connections = {}
+
+def get_connection(host=SMTP_SERVER, port=SMTP_PORT, username=SENDER_EMAIL,
+                   password=SENDER_PASSWORD, starttls=SMTP_STARTTLS):
+    """The process-wide connection for a server and account"""
+    key = (host, port, username, starttls)
+    if key not in _connections:
+        _connections[key] = SMTPConnection(host, port, username, password, starttls)
+    return _connections[key]
+
+class Notifier:
+    """Queue of notices, deduplicated against the history store and sent as email"""
+
+    def __init__(self, db_path=history_store.DB_FILE, connection=None,
+                 sender=SENDER_EMAIL, recipient=RECIPIENT_EMAIL):
+        self.db_path = db_path
+        self.connection = connection or get_connection()
+        self.sender = sender
+        self.recipient = recipient
+        self.pending = []
+
+    def queue(self, notice):
+        """Add a notice to send on the next flush()"""
+        self.pending.append(notice)
+
+    def already_sent(self, report_type, period):
+        """True if this notice went out before (flush() would skip it)"""
+        conn = history_store.connect(self.db_path)
+        try:
+            return history_store.notification_sent(conn, report_type, period)
+        finally:
+            conn.close()
+
+    def build_message(self, notices):
+        """One email for one notice, a digest for several"""
+        if len(notices) == 1:
+            subject, body = notices[0].subject, notices[0].body
+        else:
+            subject = f"Solar Intelligence Digest - {len(notices)} notices"
+            sections = [f"{n.subject}\n{'=' * len(n.subject)}\n{n.body.strip()}" for n in notices]
+            body = f"\n\n{'-' * 56}\n\n".join(sections) + "\n"
+        message = MIMEText(body, 'plain')
+        message['From'] = self.sender
+        message['To'] = self.recipient
+        message['Subject'] = subject
+        return message
+
+    async def flush(self):
+        """Send pending notices that weren't sent before; returns how many went out"""
+        notices, self.pending = self.pending, []
+        conn = history_store.connect(self.db_path)
+        try:
+            with conn:
+                claimed = [n for n in notices
+                           if history_store.claim_notification(conn, n.report_type, n.period, n.subject)]
+            if not claimed:
+                return 0
+            try:
+                await asyncio.to_thread(self.connection.send, self.build_message(claimed))
+            except Exception:
+                # Let a later run try again
+                with conn:
+                    for n in claimed:
+                        history_store.release_notification(conn, n.report_type, n.period)
+                raise
+            return len(claimed)
+        finally:
+            conn.close()
+
+class SMTPSink:
+    """Minimal local SMTP server that keeps the messages it receives"""
+
+    def __init__(self, host='127.0.0.1', port=SINK_PORT, echo=False):
+        self.host = host
+        self.port = port
+        self.echo = echo
+        self.messages = []
+        self.server = None
+
+    async def start(self):
+        """Start listening (port 0 picks a free port)"""
+        self.server = await asyncio.start_server(self._session, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        """Stop listening"""
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def _session(self, reader, writer):
+        def reply(text):
+            writer.write(f"{text}\r\n".encode())
+
+        reply("220 franklin-sink ready")
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            verb = line.decode(errors='replace').strip()[:4].upper()
+            if verb == 'DATA':
+                reply("354 End data with <CR><LF>.<CR><LF>")
+                await writer.drain()
+                data = []
+                while True:
+                    line = await reader.readline()
+                    if not line or line in (b".\r\n", b".\n"):
+                        break
+                    data.append(line[1:] if line.startswith(b"..") else line)
+                message = email.message_from_bytes(b"".join(data))
+                self.messages.append(message)
+                if self.echo:
+                    print(f"✓ {datetime.now().strftime('%H:%M:%S')} {message['To']}: {message['Subject']}")
+                reply("250 OK")
+            elif verb == 'QUIT':
+                reply("221 Bye")
+                await writer.drain()
+                break
+            elif verb in ('HELO', 'EHLO', 'MAIL', 'RCPT', 'RSET', 'NOOP'):
+                reply("250 OK")
+            else:
+                reply("502 Command not implemented")
+            await writer.drain()
+        writer.close()
+
+async def run_sink(port=SINK_PORT):
+    """Run a sink until interrupted"""
+    sink = SMTPSink(port=port, echo=True)
+    await sink.start()
+    print(f"✓ SMTP sink listening on 127.0.0.1:{sink.port}")
+    await asyncio.Event().wait()
+
+async def self_check():
+    """Send through a temporary sink and check digests and dedupe"""
+    sink = SMTPSink(port=0)
+    await sink.start()
+    connection = SMTPConnection('127.0.0.1', sink.port, starttls=False)
+    with tempfile.TemporaryDirectory() as tmp:
+        notifier = Notifier(os.path.join(tmp, 'franklin_history.db'), connection)
+
+        notifier.queue(Notice('milestone', '2026-01-01 08', 'Milestone 8:00', 'SOC 40%'))
+        notifier.queue(Notice('daily_report', '2026-01-01', 'Daily Report', 'All good'))
+        notifier.queue(Notice('milestone', '2026-01-01 08', 'Milestone 8:00', 'SOC 40%'))
+        digest_sent = await notifier.flush()
+
+        notifier.queue(Notice('milestone', '2026-01-01 08', 'Milestone 8:00', 'SOC 41%'))
+        repeat_sent = await notifier.flush()
+
+        notifier.queue(Notice('milestone', '2026-01-01 10', 'Milestone 10:00', 'SOC 60%'))
+        single_sent = await notifier.flush()
+    await asyncio.to_thread(connection.close)
+    await sink.stop()
+
+    subjects = [m['Subject'] for m in sink.messages]
+    return (digest_sent, repeat_sent, single_sent) == (2, 0, 1) and subjects == [
+        "Solar Intelligence Digest - 2 notices", "Milestone 10:00"]
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ['--sink']:
+        try:
+            asyncio.run(run_sink(int(sys.argv[2]) if len(sys.argv) > 2 else SINK_PORT))
+        except KeyboardInterrupt:
+            sys.exit(0)
+    if not asyncio.run(self_check()):
+        print("✗ Notifier self-check failed")
+        sys.exit(1)
+    print("✓ Notifier self-check passed (digest, dedupe and persistent connection)")
+    sys.exit(0)
@@ -0,0 +1,256 @@
+#!/volume1/docker/franklin/venv311/bin/python3
+"""
+Grid Outage Monitor - Fast Path While the Grid Is Down
+As soon as a reading's grid_status isn't NORMAL, polls the gateway every
+OUTAGE_POLL_SECONDS over the already-authenticated client until the grid
+is back
+
+While out, the battery runway is projected from the last
+RUNWAY_WINDOW_SECONDS of home load, solar and battery power: usable
+energy above RESERVE_SOC over the net drain (the larger of load minus
+solar and the battery's reported power). The outage start, each runway
+threshold crossed (RUNWAY_ALERT_HOURS) and the restore are logged right
+away, pushed to MQTT with the readings and, with OUTAGE_EMAIL, emailed
+through notifier.py.
+
+smart_decision.py hands over to watch() after its cycle; one run watches
+for at most MAX_WATCH_SECONDS and the next scheduled run picks up where it
+left off (outage state is kept in the history store). One process owns
+outages at a time through a lock file: overlapping runs don't poll
+twice, and while telemetry_sampler.py runs it holds the lock, feeds its
+own samples to the monitor and samples faster while out, so watch()
+stands aside. In steady state nothing here touches the cloud.
+"""
+import asyncio
+import fcntl
+import json
+import sys
+import time
+from collections import deque
+from datetime import datetime
+
+import history_store
+import mqtt_publisher
+import notifier
+from charge_planner import BATTERY_CAPACITY_KWH
+from readings import reading_from_stats
+from smart_decision import (DEFAULT_SITE, HISTORY_DB, MQTT_PUBLISH, OUTAGE_EMAIL, log_intelligence,
+                            site_path)
+
+OUTAGE_POLL_SECONDS = 5
+POLL_TIMEOUT_SECONDS = 15
+MAX_WATCH_SECONDS = 14 * 60          # Leave the next 15-minute run to take over
+RUNWAY_WINDOW_SECONDS = 300          # Load and battery power averaged over this
+RUNWAY_LOG_SECONDS = 300             # Runway logged this often while out
+RUNWAY_ALERT_HOURS = (4, 2, 1, 0.5)
+RESERVE_SOC = 5.0                    # SOC the gateway keeps back during an outage
+RESTORE_CONFIRM_SAMPLES = 3          # NORMAL readings in a row before the outage counts as over
+
+NORMAL_STATUS = "NORMAL"
+STATE_KEY = 'grid_outage'
+LOCK_FILE = "outage_watch.lock"
+
+def grid_normal(stats):
+    return stats.current.grid_status.name == NORMAL_STATUS
+
+def runway_hours(soc, home_load_kw, solar_kw, battery_kw):
+    """Hours until RESERVE_SOC at this drain, or None when solar covers the load"""
+    net_kw = home_load_kw - solar_kw
+    if net_kw <= 0:
+        return None
+    drain_kw = max(net_kw, abs(battery_kw))
+    return max(soc - RESERVE_SOC, 0.0) / 100 * BATTERY_CAPACITY_KWH / drain_kw
+
+def format_runway(hours):
+    if hours is None:
+        return "solar covers the load"
+    return f"~{hours:.1f}h runway" if hours >= 1 else f"~{hours * 60:.0f} min runway"
+
+class OutageMonitor:
+    """Follows grid status sample by sample and says what to announce"""
+
+    def __init__(self, state=None):
+        state = state or {}
+        self.started = state.get('started')       # 'YYYY-MM-DD HH:MM:SS' while out
+        self.status = state.get('status')
+        self.alerted = state.get('alerted', [])   # Runway thresholds already announced
+        self.window = deque()                     # (monotonic, soc, load, solar, battery)
+        self.normal_count = 0
+        self.last_logged = None
+        self.changed = False
+
+    def to_json(self):
+        return json.dumps({'started': self.started, 'status': self.status, 'alerted': self.alerted})
+
+    @property
+    def active(self):
+        return self.started is not None
+
+    def runway(self):
+        """Projected runway from the window's averages"""
+        count = len(self.window)
+        soc = self.window[-1][1]
+        load, solar, battery = (sum(sample[i] for sample in self.window) / count for i in (2, 3, 4))
+        return runway_hours(soc, load, solar, battery)
+
+    def update(self, now, stats):
+        """
+        Take one sample.
+        Returns: [(notice kind, notice period, subject, message)] to announce
+        """
+        current = stats.current
+        clock = time.monotonic()
+        self.window.append((clock, current.battery_soc, current.home_load or 0.0,
+                            current.solar_production or 0.0, current.battery_use or 0.0))
+        while self.window[0][0] < clock - RUNWAY_WINDOW_SECONDS:
+            self.window.popleft()
+        self.changed = False
+        events = []
+
+        if grid_normal(stats):
+            self.normal_count += 1
+            if self.active and self.normal_count >= RESTORE_CONFIRM_SAMPLES:
+                out_for = now - datetime.strptime(self.started, '%Y-%m-%d %H:%M:%S')
+                events.append(('grid_restored', self.started, "Grid Restored",
+                               f"✓ GRID RESTORED after {out_for.total_seconds() / 60:.0f} min "
+                               f"(SOC {current.battery_soc:.1f}%)"))
+                self.started, self.status, self.alerted = None, None, []
+                self.changed = True
+            return events
+
+        self.normal_count = 0
+        runway = self.runway()
+        if not self.active:
+            self.started = now.strftime('%Y-%m-%d %H:%M:%S')
+            self.status = current.grid_status.name
+            self.changed = True
+            events.append(('grid_outage', self.started, "Grid Outage",
+                           f"⚡ GRID OUTAGE: grid status {self.status}, SOC {current.battery_soc:.1f}%, "
+                           f"{current.home_load or 0.0:.2f}kW load, {format_runway(runway)}"))
+            self.last_logged = clock
+        for threshold in RUNWAY_ALERT_HOURS:
+            if runway is not None and runway < threshold and threshold not in self.alerted:
+                self.alerted.append(threshold)
+                self.changed = True
+                events.append(('outage_runway', f"{self.started} {threshold}h",
+                               f"Battery Runway Below {threshold}h",
+                               f"⚠ OUTAGE: battery runway below {threshold}h "
+                               f"(SOC {current.battery_soc:.1f}%, {format_runway(runway)})"))
+        if not events and clock - (self.last_logged or 0) >= RUNWAY_LOG_SECONDS:
+            events.append((None, None, None, f"Outage: SOC {current.battery_soc:.1f}%, "
+                                       f"{current.home_load or 0.0:.2f}kW load, {format_runway(runway)}"))
+            self.last_logged = clock
+        return events
+
+def load_monitor(site=DEFAULT_SITE):
+    conn = history_store.connect(site_path(site, HISTORY_DB))
+    try:
+        return OutageMonitor(json.loads(history_store.get_state(conn, STATE_KEY) or '{}'))
+    finally:
+        conn.close()
+
+def save_monitor(monitor, site=DEFAULT_SITE):
+    """Keep the outage state for the next run (cleared once the grid is back)"""
+    conn = history_store.connect(site_path(site, HISTORY_DB))
+    try:
+        with conn:
+            history_store.set_state(conn, STATE_KEY, monitor.to_json() if monitor.active else '')
+    finally:
+        conn.close()
+
+async def announce(monitor, events, stats, site=DEFAULT_SITE):
+    """Log, publish and (with OUTAGE_EMAIL) email a sample's events"""
+    if monitor.changed:
+        save_monitor(monitor, site)
+    if MQTT_PUBLISH:
+        mqtt_publisher.publish_reading(mqtt_publisher.get_publisher(), site.name,
+                                       reading_from_stats(stats, datetime.now(), None, None))
+    notices = []
+    for kind, period, subject, message in events:
+        log_intelligence(message, site)
+        if kind:
+            notices.append(notifier.Notice(kind, period, f"Franklin Battery - {subject}", f"{message}\n"))
+    if notices and OUTAGE_EMAIL:
+        sender = notifier.Notifier(site_path(site, HISTORY_DB))
+        for notice in notices:
+            sender.queue(notice)
+        try:
+            await sender.flush()
+        except Exception as e:
+            log_intelligence(f"✗ Outage alert email failed: {e}", site)
+
+def outage_pending(site=DEFAULT_SITE):
+    """True while an outage is recorded as ongoing"""
+    return load_monitor(site).active
+
+def acquire_watch_lock(site=DEFAULT_SITE):
+    """
+    The site's outage lock, held: whoever holds it is the only one polling
+    and announcing outages. Returns the open lock file, or None if another
+    process holds it.
+    """
+    lock = open(site_path(site, LOCK_FILE), 'a')
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock.close()
+        return None
+    return lock
+
+async def watch(client, stats, site=DEFAULT_SITE, max_seconds=MAX_WATCH_SECONDS):
+    """
+    Poll fast until the grid is back (or max_seconds pass).
+    Returns: True if the grid is normal when it stops
+    """
+    if grid_normal(stats) and not load_monitor(site).active:
+        return True
+
+    lock = acquire_watch_lock(site)
+    if lock is None:
+        return False  # Another run (or telemetry_sampler.py) is already watching
+    try:
+        monitor = load_monitor(site)  # As the previous owner left it
+        deadline = time.monotonic() + max_seconds
+        failures = 0
+        await announce(monitor, monitor.update(datetime.now(), stats), stats, site)
+        while monitor.active:
+            if time.monotonic() >= deadline:
+                log_intelligence("Outage continues, next scheduled run takes over", site)
+                return False
+            await asyncio.sleep(OUTAGE_POLL_SECONDS)
+            try:
+                stats = await asyncio.wait_for(client.get_stats(), POLL_TIMEOUT_SECONDS)
+            except Exception as e:
+                # No new sample: the runway window only takes fresh readings
+                failures += 1
+                if failures == 1:
+                    log_intelligence(f"✗ Outage poll failed: {e} (retrying every {OUTAGE_POLL_SECONDS}s)", site)
+                continue
+            failures = 0
+            await announce(monitor, monitor.update(datetime.now(), stats), stats, site)
+        return True
+    finally:
+        lock.close()
+
+if __name__ == "__main__":
+    from types import SimpleNamespace
+
+    # Self-check on synthetic samples: outage, runway alerts, restore after confirmation
+    def sample(status, soc, load):
+        return SimpleNamespace(current=SimpleNamespace(
+            grid_status=SimpleNamespace(name=status), battery_soc=soc, home_load=load,
+            solar_production=0.0, battery_use=load))
+
+    monitor = OutageMonitor()
+    kinds = []
+    now = datetime(2026, 1, 1, 18)
+    sequence = ([sample("NORMAL", 60, 1.0)] + [sample("DOWN", 60 - i, 6.0) for i in range(40)]
+                + [sample("NORMAL", 20, 1.0)] * RESTORE_CONFIRM_SAMPLES)
+    for stats in sequence:
+        kinds.extend(event[0] for event in monitor.update(now, stats) if event[0])
+    expected = ['grid_outage', 'outage_runway', 'outage_runway', 'outage_runway', 'grid_restored']
+    if kinds != expected or monitor.active:
+        print(f"✗ Outage monitor self-check failed: {kinds}")
+        sys.exit(1)
+    print(f"✓ Outage monitor self-check passed ({', '.join(expected)})")
+    sys.exit(0)
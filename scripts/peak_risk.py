@@ -0,0 +1,243 @@
+#!/volume1/docker/franklin/venv311/bin/python3
+"""
+Peak Shortfall Risk - Monte Carlo Simulation
+Estimates the probability of reaching the target SOC by the start of peak
+for "charge now", "wait one cycle" and "solar only"
+
+Solar and home-load trajectories for the rest of the day are drawn from
+recent days of the monitoring log: whole days are resampled, favouring
+days whose solar radiation (weather log) at this time of day was close to
+the current observation, scaled to today's production and jittered per
+slot. SOC is propagated for all trajectories at once as NumPy arrays, so
+a few thousand draws take milliseconds. The per-day history matrices are
+rebuilt once a day and cached in risk_history.npz.
+
+This replaces the fixed fudge factors of the rule (solar efficiency,
+safety margin, emergency SOC) with a risk the decision can be set on:
+grid charge unless waiting still reaches the target with at least
+REQUIRED_CONFIDENCE.
+"""
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from charge_planner import BATTERY_CAPACITY_KWH, SLOT_MINUTES, slot_of_day
+from log_archive import WEATHER_LOG, read_rows
+from readings import load_columns
+
+HISTORY_DAYS = 30
+MIN_HISTORY_DAYS = 5          # Fewer usable days: no estimate, the rule decides
+TRAJECTORIES = 5000
+BATCH_SIZE = 1000
+TIME_BUDGET_SECONDS = 0.25    # Stop drawing batches after this long
+SLOT_NOISE = 0.15             # Per-slot multiplicative jitter (lognormal sigma)
+MAX_SCALE = 1.5               # Limit on scaling a historical day to today's production
+RADIATION_BANDWIDTH = 150.0   # W/m2: how quickly weather-dissimilar days lose weight
+WAIT_MINUTES = 15             # "Wait" = solar-first until the next decision cycle
+
+# Probability of reaching the target that waiting must keep
+REQUIRED_CONFIDENCE = 0.95
+
+HISTORY_CACHE = "risk_history.npz"
+
+SLOTS_PER_DAY = 24 * 60 // SLOT_MINUTES
+
+def daily_matrix(timestamps, values, days):
+    """Mean value per (day, slot of day); NaN where there is no data"""
+    day_index = (timestamps.astype('datetime64[D]') - days[0]).astype(int)
+    minutes = (timestamps - timestamps.astype('datetime64[D]')).astype('timedelta64[m]').astype(int)
+    cell = day_index * SLOTS_PER_DAY + minutes // SLOT_MINUTES
+    valid = (day_index >= 0) & (day_index < len(days)) & ~np.isnan(values)
+    size = len(days) * SLOTS_PER_DAY
+    sums = np.bincount(cell[valid], weights=values[valid], minlength=size)
+    counts = np.bincount(cell[valid], minlength=size)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (sums / counts).reshape(len(days), SLOTS_PER_DAY)
+
+def fill_slots(matrix):
+    """Fill missing slots of each day from the other days' mean for that slot"""
+    with np.errstate(invalid='ignore'):
+        slot_mean = np.nanmean(matrix, axis=0)
+    return np.where(np.isnan(matrix), np.nan_to_num(slot_mean), matrix)
+
+def weather_matrix(since, days):
+    """Solar radiation (W/m2) per (day, slot) from the weather log"""
+    stamps, radiation = [], []
+    for row in read_rows(WEATHER_LOG, since=since):
+        try:
+            stamps.append(np.datetime64(datetime.fromisoformat(row['timestamp']), 's'))
+            radiation.append(float(row.get('solar_radiation_wm2') or 'nan'))
+        except ValueError:
+            continue
+    if not stamps:
+        return np.full((len(days), SLOTS_PER_DAY), np.nan)
+    return daily_matrix(np.array(stamps), np.array(radiation), days)
+
+def build_history(live_path, today, days=HISTORY_DAYS):
+    """Solar kW, home load kW and radiation per (day, slot) for the days before today"""
+    since = datetime.combine(today - timedelta(days=days), datetime.min.time())
+    day_list = np.datetime64(since, 'D') + np.arange(days)
+    columns = load_columns(live_path, since=since)
+    solar = daily_matrix(columns['timestamp'], columns['solar_kw'], day_list)
+    load = daily_matrix(columns['timestamp'], columns['home_load_kw'], day_list)
+    # Days with too little monitoring data would only add noise
+    usable = np.mean(np.isnan(solar), axis=1) < 0.5
+    return {
+        'day': str(today),
+        'solar': fill_slots(solar[usable]).clip(min=0),
+        'load': fill_slots(load[usable]).clip(min=0),
+        'radiation': weather_matrix(since, day_list)[usable],
+    }
+
+_history = {}
+
+def load_history(live_path, today):
+    """Today's history matrices: from memory, the cache file, or rebuilt"""
+    cache_path = os.path.join(os.path.dirname(live_path), HISTORY_CACHE)
+    cached = _history.get(cache_path)
+    if cached is None and os.path.exists(cache_path):
+        with np.load(cache_path) as data:
+            cached = {name: data[name] for name in data.files}
+            cached['day'] = str(cached['day'])
+    if cached is None or cached['day'] != str(today):
+        cached = build_history(live_path, today)
+        tmp_path = f"{cache_path}.tmp.npz"
+        np.savez_compressed(tmp_path, **cached)
+        os.replace(tmp_path, cache_path)
+    _history[cache_path] = cached
+    return cached
+
+def day_weights(radiation, slot, observed_radiation):
+    """Sampling weight per historical day by similarity of radiation at this slot"""
+    weights = np.ones(len(radiation))
+    if observed_radiation is not None and len(radiation):
+        past = radiation[:, slot]
+        known = ~np.isnan(past)
+        weights[known] = np.exp(-0.5 * ((past[known] - observed_radiation) / RADIATION_BANDWIDTH) ** 2)
+        weights = np.maximum(weights, 0.02)  # Every day stays possible
+    return weights / weights.sum()
+
+def draw_trajectories(history, first_slot, slots, solar_kw, home_load_kw, weights, count, rng):
+    """Sampled solar and load kW, shape (count, slots)"""
+    days = len(history['solar'])
+    slot_index = (first_slot + np.arange(slots)) % SLOTS_PER_DAY
+    solar_days = rng.choice(days, size=count, p=weights)
+    load_days = rng.choice(days, size=count)
+
+    solar = history['solar'][solar_days][:, slot_index]
+    load = history['load'][load_days][:, slot_index]
+    # Today's clouds tend to persist: scale each drawn day to what we see now
+    solar *= np.clip((solar_kw + 0.1) / (solar[:, :1] + 0.1), 0.0, MAX_SCALE)
+    if home_load_kw is not None:
+        load *= np.clip((home_load_kw + 0.1) / (load[:, :1] + 0.1), 0.0, MAX_SCALE)
+    solar *= rng.lognormal(0.0, SLOT_NOISE, size=solar.shape)
+    load *= rng.lognormal(0.0, SLOT_NOISE, size=load.shape)
+    return solar, load
+
+def final_soc(soc, solar, load, charge_rate_per_hour, wait_slots):
+    """
+    SOC at peak start per trajectory for: charge now, wait wait_slots then
+    charge, solar only. Solar-first charges from the surplus over home
+    load; grid charging adds at least charge_rate_per_hour.
+    """
+    slot_hours = SLOT_MINUTES / 60
+    solar_gain = (solar - load).clip(min=0) * slot_hours * 100 / BATTERY_CAPACITY_KWH
+    backup_gain = np.maximum(solar_gain, charge_rate_per_hour * slot_hours)
+    # Gains are never negative, so capping the sum at 100% is exact
+    solar_only = soc + solar_gain.sum(axis=1)
+    charge_now = soc + backup_gain.sum(axis=1)
+    wait = soc + solar_gain[:, :wait_slots].sum(axis=1) + backup_gain[:, wait_slots:].sum(axis=1)
+    return [np.minimum(values, 100.0) for values in (charge_now, wait, solar_only)]
+
+def latest_radiation(now):
+    """Most recent solar radiation observation within the last hour, or None"""
+    latest = None
+    for row in read_rows(WEATHER_LOG, since=now - timedelta(hours=1)):
+        try:
+            latest = float(row.get('solar_radiation_wm2') or 'nan')
+        except ValueError:
+            continue
+    return None if latest is None or np.isnan(latest) else latest
+
+def simulate(live_path, now, soc, solar_kw, home_load_kw, hours_to_peak, site,
+             observed_radiation=None, seed=None):
+    """
+    Probability of reaching site.target_soc by peak start for each policy.
+    Returns: {'charge_now', 'wait', 'solar_only': probability, 'shortfall_now',
+    'shortfall_wait': expected % missing at peak, 'trajectories', 'seconds'},
+    or None when there is no peak ahead or too little history.
+    """
+    started = time.perf_counter()
+    slots = int(hours_to_peak * 60 // SLOT_MINUTES)
+    if not np.isfinite(hours_to_peak) or slots < 1:
+        return None
+    history = load_history(live_path, now.date())
+    if len(history['solar']) < MIN_HISTORY_DAYS:
+        return None
+
+    first_slot = slot_of_day(now)
+    weights = day_weights(history['radiation'], first_slot, observed_radiation)
+    wait_slots = min(max(WAIT_MINUTES // SLOT_MINUTES, 1), slots)
+    rng = np.random.default_rng(seed)
+
+    reached = np.zeros(3)
+    shortfall = np.zeros(3)
+    drawn = 0
+    while drawn < TRAJECTORIES:
+        solar, load = draw_trajectories(history, first_slot, slots, solar_kw, home_load_kw,
+                                        weights, BATCH_SIZE, rng)
+        for i, final in enumerate(final_soc(soc, solar, load, site.charge_rate_per_hour, wait_slots)):
+            reached[i] += np.count_nonzero(final >= site.target_soc)
+            shortfall[i] += np.clip(site.target_soc - final, 0, None).sum()
+        drawn += BATCH_SIZE
+        if time.perf_counter() - started > TIME_BUDGET_SECONDS:
+            break
+
+    probabilities = reached / drawn
+    shortfall /= drawn
+    return {
+        'charge_now': float(probabilities[0]),
+        'wait': float(probabilities[1]),
+        'solar_only': float(probabilities[2]),
+        'shortfall_now': float(shortfall[0]),
+        'shortfall_wait': float(shortfall[1]),
+        'trajectories': drawn,
+        'seconds': time.perf_counter() - started,
+    }
+
+def risk_decision(risk, soc, required=REQUIRED_CONFIDENCE):
+    """Grid charge or not from simulated probabilities. Returns: (should_charge, reason)"""
+    summary = (f"P(target) charge now {risk['charge_now']:.0%}, wait {risk['wait']:.0%}, "
+               f"solar only {risk['solar_only']:.0%}")
+    if risk['wait'] >= required:
+        return False, f"Risk: waiting is safe at {soc:.1f}% ({summary})"
+    if risk['shortfall_now'] < risk['shortfall_wait']:
+        return True, (f"Risk: waiting may miss target, charging cuts expected shortfall "
+                      f"{risk['shortfall_wait']:.1f}% → {risk['shortfall_now']:.1f}% ({summary})")
+    return False, f"Risk: charging now doesn't improve the odds ({summary})"
+
+if __name__ == "__main__":
+    import history_store
+    from smart_decision import DEFAULT_SITE, HISTORY_DB, LOG_FILE, calculate_time_to_peak
+
+    conn = history_store.connect(HISTORY_DB)
+    latest = history_store.latest_reading(conn)
+    conn.close()
+    if latest is None:
+        print("✗ No readings in the history store")
+        sys.exit(1)
+
+    now = datetime.now()
+    risk = simulate(LOG_FILE, now, latest.soc_percent, latest.solar_kw or 0.0, latest.home_load_kw,
+                    calculate_time_to_peak(), DEFAULT_SITE, latest_radiation(now))
+    if risk is None:
+        print("✓ No estimate (no peak ahead or not enough history)")
+        sys.exit(0)
+    should_charge, reason = risk_decision(risk, latest.soc_percent)
+    print(f"✓ {risk['trajectories']} trajectories in {risk['seconds'] * 1000:.0f} ms")
+    print(f"  {reason}")
+    print(f"  Action: {'Grid charge' if should_charge else 'Solar-first (TOU mode)'}")
+    sys.exit(0)
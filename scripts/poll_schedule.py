@@ -0,0 +1,182 @@
+#!/volume1/docker/franklin/venv311/bin/python3
+"""
+Adaptive Poll Schedule
+Works out when the decision could next come out differently, and polls
+the cloud then instead of every 15 minutes
+
+From the current reading, SOC, solar and time to peak are pushed to their
+worst case (maximum discharge, grid charge rate or solar gain, fastest
+solar ramp, capped by what recent days produced at this time of day) for
+every minute ahead. The first minute at which any reachable state gets a
+different answer from the rule (decision_kernel, evaluated as one batch),
+the cached charge plan switches mode, or a peak period starts or ends is
+the earliest possible flip. The next poll is scheduled then: hours away
+at night or with a big buffer, a minute or two next to a threshold.
+
+The rule is evaluated with the grid charge rate the cycle itself used
+(learned by charge_rate.py when enabled), and with the risk simulator
+enabled polls are at most RISK_POLL_MINUTES apart, since its answer
+has no boundary to compute.
+
+The next poll time is kept in the history store. With ADAPTIVE_POLLING
+in smart_decision.py, schedule the decision every MIN_POLL_MINUTES; runs
+that aren't due exit without contacting the cloud.
+"""
+import json
+import sys
+from datetime import datetime, timedelta
+
+import numpy as np
+
+import history_store
+from charge_planner import FORECAST_DAYS, SLOT_MINUTES, find_slot, slot_of_day
+from decision_kernel import decide_batch
+from smart_decision import SOLAR_SOC_PER_KW_HOUR, site_calendar
+
+MIN_POLL_MINUTES = 2
+MAX_POLL_MINUTES = 120
+RISK_POLL_MINUTES = 30   # Longest wait while peak_risk.py decides
+
+# Worst-case rates
+MAX_DISCHARGE_PER_HOUR = 20.0     # SOC % per hour the battery can lose
+SOLAR_RAMP_KW_PER_HOUR = 12.0     # A passing cloud takes most of the output within minutes
+SOLAR_CEILING_MARGIN = 1.2        # Headroom over the best recent production for the slot
+
+# Points sampled across each reachable SOC and solar range
+CORNER_POINTS = 5
+
+NEXT_POLL_KEY = 'next_poll'
+
+def solar_ceiling(conn, now, days=FORECAST_DAYS):
+    """Highest solar kW seen in each slot of the day over recent days (None without history)"""
+    readings = history_store.readings_between(conn, now - timedelta(days=days), now)
+    slots_per_day = 24 * 60 // SLOT_MINUTES
+    ceiling = np.full(slots_per_day, -1.0)
+    for reading in readings:
+        if reading.solar_kw is not None:
+            slot = slot_of_day(datetime.strptime(reading.timestamp, '%Y-%m-%d %H:%M:%S'))
+            ceiling[slot] = max(ceiling[slot], reading.solar_kw)
+    if (ceiling < 0).all():
+        return None
+    return ceiling.clip(min=0) * SOLAR_CEILING_MARGIN
+
+def effective_charge_rate(soc, site, charge_hours=None):
+    """SOC %/hour that makes the rule's grid charge time match charge_hours (learned), else the constant"""
+    deficit = site.target_soc - soc
+    if charge_hours and deficit > 0:
+        return deficit / charge_hours
+    return site.charge_rate_per_hour
+
+def rule_flip_minutes(soc, solar_kw, hours_to_peak, site, max_solar_kw=None, charge_hours=None):
+    """
+    First minute (up to MAX_POLL_MINUTES) at which a reachable state changes the rule's answer, or None.
+    charge_hours: the learned grid charge time the cycle decided with (charge_rate.py)
+    """
+    minutes = np.arange(1, MAX_POLL_MINUTES + 1)
+    hours = minutes / 60
+    charge_rate_per_hour = effective_charge_rate(soc, site, charge_hours)
+    max_gain = max(site.charge_rate_per_hour, charge_rate_per_hour,
+                   (max_solar_kw or solar_kw) * SOLAR_SOC_PER_KW_HOUR)
+    solar_high = solar_kw + SOLAR_RAMP_KW_PER_HOUR * hours
+    if max_solar_kw is not None:
+        solar_high = np.minimum(solar_high, max(max_solar_kw, solar_kw))
+
+    spread = np.linspace(0.0, 1.0, CORNER_POINTS)
+    soc_low = soc - MAX_DISCHARGE_PER_HOUR * hours
+    soc_high = np.minimum(soc + max_gain * hours, 100.0)
+    solar_low = np.maximum(solar_kw - SOLAR_RAMP_KW_PER_HOUR * hours, 0.0)
+    # (minute, soc point, solar point)
+    socs = soc_low[:, None, None] + (soc_high - soc_low)[:, None, None] * spread[None, :, None]
+    solars = solar_low[:, None, None] + (solar_high - solar_low)[:, None, None] * spread[None, None, :]
+    socs, solars = np.broadcast_arrays(socs, solars)
+    remaining = np.broadcast_to((hours_to_peak - hours)[:, None, None], socs.shape)
+
+    now_charge, _ = decide_batch(soc, solar_kw, hours_to_peak, False, site.target_soc,
+                                 charge_rate_per_hour, site.safety_margin_hours, site.min_solar_for_wait)
+    later_charge, _ = decide_batch(socs, solars, remaining, False, site.target_soc,
+                                   charge_rate_per_hour, site.safety_margin_hours, site.min_solar_for_wait)
+    flipped = (later_charge != now_charge).any(axis=(1, 2))
+    return int(minutes[flipped.argmax()]) if flipped.any() else None
+
+def plan_change_minutes(conn, now):
+    """Minutes until the cached charge plan switches mode, or None"""
+    stored = history_store.get_state(conn, 'charge_plan')
+    if not stored:
+        return None
+    plan = json.loads(stored)
+    slot = find_slot(plan, now)
+    if slot is None:
+        return None
+    for start, mode, *_ in plan['slots']:
+        if start > slot[0] and mode != slot[1]:
+            change = datetime.strptime(start, '%Y-%m-%d %H:%M')
+            return (change - now).total_seconds() / 60
+    return None
+
+def next_poll(conn, now, soc, solar_kw, hours_to_peak, in_peak, site, charge_hours=None, risk_simulated=False):
+    """
+    When to poll next, for a cycle that decided with charge_hours (learned
+    grid charge time) and, if risk_simulated, the risk simulator.
+    Returns: (time of next poll, reason)
+    """
+    candidates = []
+    calendar = site_calendar(site)
+    window = calendar.next_peak_window(now)
+    if in_peak and window:
+        candidates.append(((window[1] - now).total_seconds() / 60, "peak ends"))
+    elif window:
+        candidates.append((hours_to_peak * 60, "peak starts"))
+
+    if not in_peak:
+        ceiling = solar_ceiling(conn, now)
+        max_solar_kw = None
+        if ceiling is not None:
+            ahead = [slot_of_day(now + timedelta(minutes=m))
+                     for m in range(0, MAX_POLL_MINUTES + SLOT_MINUTES, SLOT_MINUTES)]
+            max_solar_kw = float(ceiling[ahead].max())
+        flip = rule_flip_minutes(soc, solar_kw, hours_to_peak, site, max_solar_kw, charge_hours)
+        if flip is not None:
+            candidates.append((flip, "decision boundary"))
+        change = plan_change_minutes(conn, now)
+        if change is not None:
+            candidates.append((change, "plan switches mode"))
+        if risk_simulated:
+            candidates.append((RISK_POLL_MINUTES, "risk re-check"))
+
+    minutes, reason = min(candidates, default=(MAX_POLL_MINUTES, "nothing can change"))
+    if minutes > MAX_POLL_MINUTES:
+        minutes, reason = MAX_POLL_MINUTES, "nothing can change"
+    minutes = max(minutes, MIN_POLL_MINUTES)
+    return now + timedelta(minutes=minutes), reason
+
+def save_next_poll(conn, when):
+    """Record the next poll time"""
+    history_store.set_state(conn, NEXT_POLL_KEY, when.strftime('%Y-%m-%d %H:%M:%S'))
+
+def get_next_poll(conn):
+    """The recorded next poll time, or None"""
+    stored = history_store.get_state(conn, NEXT_POLL_KEY)
+    return datetime.strptime(stored, '%Y-%m-%d %H:%M:%S') if stored else None
+
+def poll_due(conn, now, slack_seconds=30):
+    """True when a poll is due (scheduler runs may start a little early)"""
+    when = get_next_poll(conn)
+    return when is None or when <= now + timedelta(seconds=slack_seconds)
+
+if __name__ == "__main__":
+    from smart_decision import DEFAULT_SITE, HISTORY_DB
+
+    conn = history_store.connect(HISTORY_DB)
+    latest = history_store.latest_reading(conn)
+    if latest is None:
+        print("✗ No readings in the history store")
+        sys.exit(1)
+    now = datetime.now()
+    calendar = site_calendar()
+    when, reason = next_poll(conn, now, latest.soc_percent, latest.solar_kw or 0.0,
+                             calendar.hours_to_peak(now), calendar.is_peak(now), DEFAULT_SITE)
+    recorded = get_next_poll(conn)
+    conn.close()
+    print(f"✓ Next poll would be at {when.strftime('%H:%M')} ({reason})")
+    print(f"  Recorded next poll: {recorded or 'none'}")
+    sys.exit(0)
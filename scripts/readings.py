@@ -0,0 +1,155 @@
+#!/volume1/docker/franklin/venv311/bin/python3
+"""
+Monitoring Readings - Shared Record Type and Parser
+One definition of the continuous_monitoring.csv schema, used by every
+script that writes or reads monitoring data
+
+Writers format rows through format_row()/append_readings(); readers get
+NumPy column arrays from parse_columns()/load_columns(), located by header
+name so a reordered or added column can no longer shift values silently.
+"""
+import csv
+import gzip
+import io
+import os
+from collections import namedtuple
+
+import numpy as np
+
+from log_archive import segment_paths
+
+MONITORING_FIELDS = (
+    'timestamp', 'soc_percent', 'solar_kw', 'grid_kw', 'battery_kw', 'home_load_kw',
+    'grid_status', 'battery_charge_total', 'battery_discharge_total',
+    'grid_import_total', 'solar_total', 'hours_to_peak', 'mode')
+TEXT_FIELDS = ('timestamp', 'grid_status', 'mode')
+NUMERIC_FIELDS = tuple(f for f in MONITORING_FIELDS if f not in TEXT_FIELDS)
+
+# CSV precision per column (everything else is written with 3 decimals)
+FIELD_FORMATS = {'soc_percent': '.2f', 'hours_to_peak': '.2f'}
+
+# A namedtuple is a tuple subclass with empty __slots__: no per-row __dict__
+Reading = namedtuple('Reading', MONITORING_FIELDS)
+
+def reading_from_stats(stats, timestamp, hours_to_peak, mode):
+    """Build a Reading from a franklinwh stats object"""
+    return Reading(
+        timestamp.strftime('%Y-%m-%d %H:%M:%S'),
+        stats.current.battery_soc,
+        stats.current.solar_production,
+        stats.current.grid_use,
+        stats.current.battery_use,
+        stats.current.home_load,
+        stats.current.grid_status.name,
+        stats.totals.battery_charge,
+        stats.totals.battery_discharge,
+        stats.totals.grid_import,
+        stats.totals.solar,
+        hours_to_peak,
+        mode)
+
+def format_row(reading):
+    """CSV field strings for a reading, in MONITORING_FIELDS order"""
+    row = []
+    for field, value in zip(MONITORING_FIELDS, reading):
+        if field in TEXT_FIELDS or value is None:
+            row.append('' if value is None else str(value))
+        else:
+            row.append(format(value, FIELD_FORMATS.get(field, '.3f')))
+    return row
+
+def append_readings(path, readings):
+    """Append readings to a monitoring CSV, writing the header for a new file"""
+    file_exists = os.path.exists(path)
+    with open(path, 'a', newline='') as f:
+        writer = csv.writer(f)
+        if not file_exists:
+            writer.writerow(MONITORING_FIELDS)
+        writer.writerows(format_row(reading) for reading in readings)
+
+def _empty_columns():
+    columns = {field: np.array([], dtype=float) for field in NUMERIC_FIELDS}
+    columns['timestamp'] = np.array([], dtype='datetime64[s]')
+    columns['grid_status'] = np.array([], dtype=object)
+    columns['mode'] = np.array([], dtype=object)
+    return columns
+
+def parse_columns(data):
+    """
+    Parse monitoring CSV bytes into {field: NumPy array}.
+    Timestamps become datetime64[s], numeric columns float64 (NaN where a
+    value is missing or malformed), text columns object arrays. Columns a
+    legacy file predates are filled with NaN / empty strings.
+    Raises ValueError if the file has no timestamp column.
+    """
+    import pandas as pd  # C parser; only loaded by readers, not the decision loop
+
+    header = data[:data.find(b'\n')].decode().strip().split(',')
+    if 'timestamp' not in header:
+        raise ValueError("Monitoring data has no timestamp column")
+    present = [field for field in MONITORING_FIELDS if field in header]
+
+    frame = pd.read_csv(io.BytesIO(data), usecols=present,
+                        dtype=str, keep_default_na=False, on_bad_lines='skip')
+    timestamps = pd.to_datetime(frame['timestamp'], format='%Y-%m-%d %H:%M:%S', errors='coerce')
+    valid = timestamps.notna().to_numpy()
+    count = int(valid.sum())
+
+    columns = {'timestamp': timestamps.to_numpy()[valid].astype('datetime64[s]')}
+    for field in NUMERIC_FIELDS:
+        if field not in frame:
+            columns[field] = np.full(count, np.nan)
+            continue
+        columns[field] = pd.to_numeric(frame[field], errors='coerce').to_numpy(dtype=float)[valid]
+    for field in ('grid_status', 'mode'):
+        if field not in frame:
+            columns[field] = np.full(count, '', dtype=object)
+            continue
+        columns[field] = frame[field].to_numpy(dtype=object)[valid]
+    return columns
+
+def iter_column_chunks(live_path, since=None, until=None):
+    """
+    Column arrays one file at a time (each archived segment, then the live
+    file), so long histories can be processed in bounded memory.
+    Rows are not filtered to [since, until]; only whole files are skipped.
+    """
+    for path in segment_paths(live_path, since, until):
+        columns = read_columns(path)
+        if columns is not None:
+            yield columns
+
+def read_columns(path):
+    """Column arrays of one live or archived (gzip) monitoring file, or None if it is empty"""
+    with open(path, 'rb') as f:
+        data = f.read()
+    if str(path).endswith('.gz'):
+        data = gzip.decompress(data)
+    return parse_columns(data) if data.strip() else None
+
+def load_columns(live_path, since=None, until=None):
+    """Column arrays for [since, until] across archived segments and the live file"""
+    parts = list(iter_column_chunks(live_path, since, until))
+    if not parts:
+        return _empty_columns()
+
+    columns = {field: np.concatenate([part[field] for part in parts]) for field in MONITORING_FIELDS}
+    mask = np.ones(len(columns['timestamp']), dtype=bool)
+    if since is not None:
+        mask &= columns['timestamp'] >= np.datetime64(since.replace(microsecond=0))
+    if until is not None:
+        mask &= columns['timestamp'] <= np.datetime64(until.replace(microsecond=0))
+    return {field: values[mask] for field, values in columns.items()}
+
+def iter_readings(columns):
+    """Yield Reading records from column arrays (NaN becomes None)"""
+    if len(columns['timestamp']) == 0:
+        return iter(())
+    stamps = np.char.replace(np.datetime_as_string(columns['timestamp'], unit='s'), 'T', ' ')
+    values = [stamps.tolist()]
+    for field in MONITORING_FIELDS[1:]:
+        column = columns[field]
+        if field in NUMERIC_FIELDS:
+            column = np.where(np.isnan(column), None, column)
+        values.append(column.tolist())
+    return (Reading(*row) for row in zip(*values))
@@ -5,83 +5,179 @@ Makes one intelligent decision about charging vs. waiting for solar
 Designed to be run every 15 minutes via scheduler
 """
 import asyncio
-import csv
-import subprocess
-from datetime import datetime, timedelta
-from franklinwh import Client, TokenFetcher
+import contextlib
+import os
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime
+from franklinwh import Client, TokenFetcher, Mode
+import anomaly_detector
+import charge_planner
+import charge_rate
+import buffered_log
+import history_store
+import journal
+import load_profile
+import mqtt_publisher
+import notifier
+import peak_risk
+import tariff_calendar
+from history_store import Decision
+from readings import append_readings, reading_from_stats
 
 USERNAME = "YOUR_EMAIL@example.com"
 PASSWORD = "YOUR_PASSWORD"
 GATEWAY_ID = "YOUR_GATEWAY_ID"
 
-LOG_FILE = "/volume1/docker/franklin/logs/continuous_monitoring.csv"
-INTELLIGENCE_LOG = "/volume1/docker/franklin/logs/solar_intelligence.log"
-STATE_FILE = "/volume1/docker/franklin/logs/last_mode.txt"
-PEAK_STATE_FILE = "/volume1/docker/franklin/logs/peak_state.txt"
+LOG_DIR = "/volume1/docker/franklin/logs"
+LOG_FILE = f"{LOG_DIR}/continuous_monitoring.csv"
+INTELLIGENCE_LOG = f"{LOG_DIR}/solar_intelligence.log"
+STATE_FILE = f"{LOG_DIR}/last_mode.txt"
+PEAK_STATE_FILE = f"{LOG_DIR}/peak_state.txt"
+HISTORY_DB = f"{LOG_DIR}/franklin_history.db"
+JOURNAL_FILE = f"{LOG_DIR}/cycle_journal.jsonl"  # Shared by all sites in fleet mode
 
 # Configuration
 TARGET_SOC = 95.0
 PEAK_START_HOUR = 17  # 5 PM
 PEAK_END_HOUR = 20    # 8 PM
+# Seasonal/weekend/holiday schedules: put them in tariff.json (see
+# tariff.example.json); the single window above is used without it
+TARIFF_FILE = tariff_calendar.TARIFF_FILE
 CHARGE_RATE_PER_HOUR = 32.0
 SAFETY_MARGIN_HOURS = 0.5
 MIN_SOLAR_FOR_WAIT = 0.5
-
-def log_intelligence(message):
+USE_CHARGE_PLANNER = False  # Follow charge_planner.py's schedule instead of the per-cycle rule
+USE_RISK_SIMULATOR = False  # Without a plan, decide on peak_risk.py's simulated shortfall risk
+# Poll when the decision could change (poll_schedule.py) instead of every cycle;
+# schedule this script every poll_schedule.MIN_POLL_MINUTES when enabled
+ADAPTIVE_POLLING = False
+# Commit each cycle as one write-ahead journal record (journal.py) that then feeds
+# the history store, CSV and log; failed cycles are journaled too
+USE_JOURNAL = True
+MQTT_PUBLISH = False  # Push readings, mode, peak state and decisions to MQTT (mqtt_publisher.py)
+# Learn grid-charge speed per SOC band from BACKUP readings (charge_rate.py) and use it for
+# the planner's charge slots and hours_needed_grid; CHARGE_RATE_PER_HOUR is the fallback
+# for unlearned bands
+LEARN_CHARGE_RATE = True
+# Poll every few seconds while grid_status isn't NORMAL (outage_monitor.py)
+WATCH_OUTAGES = True
+OUTAGE_EMAIL = False     # ...and email outage, runway and restore alerts through notifier.py
+DETECT_ANOMALIES = True  # Check each reading for trouble (anomaly_detector.py) and log alerts
+ANOMALY_EMAIL = False    # ...and email new alerts through notifier.py (once per type per day)
+# Aim each day's charge at its expected peak-window load (load_profile.py, run nightly)
+# instead of always TARGET_SOC; TARGET_SOC stays the ceiling and the fallback
+DYNAMIC_TARGET_SOC = False
+
+# Decision heuristics (decision_kernel.py evaluates the same rules on arrays)
+EMERGENCY_WINDOW_HOURS = 0.5         # Within this of peak, only an emergency charge
+EMERGENCY_SOC = 75                   # ...and only if SOC is below this
+SOLAR_EFFICIENCY = 0.7
+SOLAR_SOC_PER_KW_HOUR = 30.0 / 10.0  # SOC % gained per kW of solar per hour
+LOW_SOLAR_BUFFER_HOURS = 1.0
+MONITOR_BUFFER_HOURS = 2.0
+
+# A mode read taken with the stats fetch is reused by the decision for this long
+MODE_CACHE_SECONDS = 120
+
+# Everything that differs between homes. The constants above form the
+# default site; fleet_decision.py builds one SiteConfig per gateway.
+SiteConfig = namedtuple('SiteConfig', (
+    'name', 'username', 'password', 'gateway_id', 'log_dir',
+    'target_soc', 'peak_start_hour', 'peak_end_hour',
+    'charge_rate_per_hour', 'safety_margin_hours', 'min_solar_for_wait', 'tariff_file'))
+
+DEFAULT_SITE = SiteConfig(
+    'default', USERNAME, PASSWORD, GATEWAY_ID, LOG_DIR,
+    TARGET_SOC, PEAK_START_HOUR, PEAK_END_HOUR,
+    CHARGE_RATE_PER_HOUR, SAFETY_MARGIN_HOURS, MIN_SOLAR_FOR_WAIT, TARIFF_FILE)
+
+def site_path(site, path):
+    """Relocate one of the default log/state file paths into a site's log directory"""
+    return os.path.join(site.log_dir, os.path.basename(path))
+
+def site_calendar(site=DEFAULT_SITE):
+    """The site's compiled tariff calendar"""
+    return tariff_calendar.load_calendar(site.tariff_file, site.peak_start_hour, site.peak_end_hour)
+
+def log_intelligence(message, site=DEFAULT_SITE):
     """Write to intelligence log with timestamp"""
     timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    with open(INTELLIGENCE_LOG, 'a') as f:
-        f.write(f"{timestamp} - {message}\n")
+    line = f"{timestamp} - {message}\n"
+    # Inside a journaled cycle, lines go out with the cycle's record
+    if journal.buffer_log_line(site_path(site, INTELLIGENCE_LOG), line):
+        return
+    buffered_log.get_log(site_path(site, INTELLIGENCE_LOG)).write(line)
 
-def get_last_mode():
-    """Read last mode from state file"""
-    try:
-        with open(STATE_FILE, 'r') as f:
-            return f.read().strip()
-    except:
-        return None
+def get_last_mode(conn):
+    """Read last mode from the history store"""
+    return history_store.get_state(conn, 'last_mode')
 
-def save_mode(mode):
-    """Save current mode to state file"""
-    with open(STATE_FILE, 'w') as f:
-        f.write(mode)
+def save_mode(conn, mode, site=DEFAULT_SITE):
+    """Save current mode to the history store (mirrored to state file)"""
+    history_store.set_state(conn, 'last_mode', mode, mirror_file=site_path(site, STATE_FILE))
 
-def switch_to_backup():
+async def switch_to_backup(client, site=DEFAULT_SITE):
     """Switch to Emergency Backup mode"""
     try:
-        log_intelligence("SWITCHING TO EMERGENCY BACKUP MODE (grid charging)")
-        subprocess.run(['/volume1/docker/franklin/switch_to_backup_v2.py'],
-                      capture_output=True, text=True, timeout=60)
+        log_intelligence("SWITCHING TO EMERGENCY BACKUP MODE (grid charging)", site)
+        await client.set_mode(Mode.emergency_backup())
         return True
     except Exception as e:
-        log_intelligence(f"ERROR switching to backup: {e}")
+        log_intelligence(f"ERROR switching to backup: {e}", site)
         return False
 
-def switch_to_tou():
+async def switch_to_tou(client, site=DEFAULT_SITE):
     """Switch to TOU mode"""
     try:
-        log_intelligence("SWITCHING TO TOU MODE (solar-first)")
-        subprocess.run(['/volume1/docker/franklin/switch_to_tou_v2.py'],
-                      capture_output=True, text=True, timeout=60)
+        log_intelligence("SWITCHING TO TOU MODE (solar-first)", site)
+        await client.set_mode(Mode.time_of_use())
         return True
     except Exception as e:
-        log_intelligence(f"ERROR switching to TOU: {e}")
+        log_intelligence(f"ERROR switching to TOU: {e}", site)
         return False
 
-def get_peak_state():
-    """Get current peak state from file: 'Peak-YYYY-MM-DD' or 'OffPeak-YYYY-MM-DD'"""
+# Operating mode last read from each gateway: {gateway_id: (monotonic time, mode)}
+_mode_cache = {}
+# Attempts the last successful stats fetch took, per gateway
+_fetch_attempts = {}
+
+async def read_operating_mode(client):
+    """Read the gateway's actual operating mode: 'TOU', 'BACKUP', 'SELF', or None if unreadable"""
     try:
-        with open(PEAK_STATE_FILE, 'r') as f:
-            return f.read().strip()
-    except FileNotFoundError:
+        mode = await client.get_mode()
+    except Exception:
         return None
-
-def save_peak_state(state):
-    """Save peak state to file"""
-    with open(PEAK_STATE_FILE, 'w') as f:
-        f.write(state)
-
-def update_peak_state():
+    if isinstance(mode, tuple):
+        mode = mode[0]
+    name = str(getattr(mode, 'name', mode)).lower()
+    if 'backup' in name or 'emergency' in name:
+        return "BACKUP"
+    if 'time' in name or 'tou' in name:
+        return "TOU"
+    if 'self' in name:
+        return "SELF"
+    return None
+
+async def get_operating_mode(client, site=DEFAULT_SITE):
+    """Actual operating mode, reusing the read taken with the stats fetch when still fresh"""
+    cached = _mode_cache.get(site.gateway_id)
+    if cached and time.monotonic() - cached[0] < MODE_CACHE_SECONDS:
+        return cached[1]
+    mode = await read_operating_mode(client)
+    _mode_cache[site.gateway_id] = (time.monotonic(), mode)
+    return mode
+
+def get_peak_state(conn):
+    """Get current peak state: 'Peak-YYYY-MM-DD' or 'OffPeak-YYYY-MM-DD'"""
+    return history_store.get_state(conn, 'peak_state')
+
+def save_peak_state(conn, state, site=DEFAULT_SITE):
+    """Save peak state to the history store (mirrored to state file)"""
+    history_store.set_state(conn, 'peak_state', state, mirror_file=site_path(site, PEAK_STATE_FILE))
+
+def update_peak_state(conn, site=DEFAULT_SITE):
     """
     Update peak state based on current time.
     Returns: True if in peak period, False otherwise
@@ -90,78 +186,68 @@ def update_peak_state():
     today_date = now.strftime('%Y-%m-%d')
     current_hour = now.hour
 
-    current_state = get_peak_state()
+    current_state = get_peak_state(conn)
 
-    # Determine if we're in peak period (5 PM - 8 PM)
-    in_peak_window = (PEAK_START_HOUR <= current_hour < PEAK_END_HOUR)
+    # Determine if we're in a peak period of the tariff calendar
+    in_peak_window = site_calendar(site).is_peak(now)
 
     if in_peak_window:
-        # We're in the peak time window (5-8 PM)
+        # We're in a peak time window
         new_state = f"Peak-{today_date}"
         if current_state != new_state:
-            save_peak_state(new_state)
-            log_intelligence(f"Peak period started: {new_state}")
+            save_peak_state(conn, new_state, site)
+            history_store.record_peak_transition(conn, now, new_state)
+            log_intelligence(f"Peak period started: {new_state}", site)
         return True
     else:
         # We're outside peak window
         new_state = f"OffPeak-{today_date}"
         if current_state and current_state.startswith("Peak-"):
             # We just exited peak period
-            save_peak_state(new_state)
-            log_intelligence(f"Peak period ended: {new_state}")
+            save_peak_state(conn, new_state, site)
+            history_store.record_peak_transition(conn, now, new_state)
+            log_intelligence(f"Peak period ended: {new_state}", site)
         elif current_state != new_state:
             # Normal update (midnight rollover, etc)
-            save_peak_state(new_state)
+            save_peak_state(conn, new_state, site)
         return False
 
-def calculate_time_to_peak():
-    """Calculate hours until next peak period (5 PM)"""
-    now = datetime.now()
-    peak_today = now.replace(hour=PEAK_START_HOUR, minute=0, second=0, microsecond=0)
+def calculate_time_to_peak(site=DEFAULT_SITE):
+    """Calculate hours until the next peak period starts (0 while in peak)"""
+    return site_calendar(site).hours_to_peak(datetime.now())
 
-    # If we're past today's peak END time (8 PM), calculate to tomorrow's peak
-    peak_end_today = now.replace(hour=PEAK_END_HOUR, minute=0, second=0, microsecond=0)
-    if now >= peak_end_today:
-        # Peak is tomorrow
-        peak_tomorrow = peak_today + timedelta(days=1)
-        return (peak_tomorrow - now).total_seconds() / 3600
-
-    # If we're before today's peak start, use today's peak
-    if now < peak_today:
-        return (peak_today - now).total_seconds() / 3600
-
-    # We're currently IN the peak period, return 0
-    return 0
-
-def should_charge_from_grid(soc, solar_kw, hours_to_peak, in_peak):
+def should_charge_from_grid(soc, solar_kw, hours_to_peak, in_peak, site=DEFAULT_SITE, charge_hours=None):
     """
     Decide: grid charge or wait for solar?
+    charge_hours (from charge_rate.py) replaces the constant-rate grid charge time when given.
     Returns: (should_charge, reason)
     """
-    # NEVER change modes during peak period (5-8 PM)
+    # NEVER change modes during a peak period
     if in_peak:
         return False, f"IN PEAK PERIOD - no charging decisions (SOC: {soc:.1f}%)"
 
-    if soc >= TARGET_SOC:
-        return False, f"Already at target ({soc:.1f}% >= {TARGET_SOC}%)"
+    if soc >= site.target_soc:
+        return False, f"Already at target ({soc:.1f}% >= {site.target_soc}%)"
 
-    if hours_to_peak < 0.5:
-        if soc < 75:
+    if hours_to_peak < EMERGENCY_WINDOW_HOURS:
+        if soc < EMERGENCY_SOC:
             return True, f"EMERGENCY: Peak in {hours_to_peak*60:.0f} min, SOC only {soc:.1f}%"
         else:
             return False, f"Peak imminent, but SOC acceptable ({soc:.1f}%)"
 
-    soc_deficit = TARGET_SOC - soc
-    hours_needed_grid = (soc_deficit / CHARGE_RATE_PER_HOUR) + SAFETY_MARGIN_HOURS
+    soc_deficit = site.target_soc - soc
+    if charge_hours is None:
+        charge_hours = soc_deficit / site.charge_rate_per_hour
+    hours_needed_grid = charge_hours + site.safety_margin_hours
     hours_until_must_start = hours_to_peak - hours_needed_grid
 
-    solar_charging_potential = solar_kw * 0.7 * hours_to_peak * (30.0 / 10.0)
+    solar_charging_potential = solar_kw * SOLAR_EFFICIENCY * hours_to_peak * SOLAR_SOC_PER_KW_HOUR
 
     if hours_until_must_start <= 0:
         return True, f"Out of time! Must start now (need {hours_needed_grid:.1f}h, have {hours_to_peak:.1f}h)"
 
-    if solar_kw < MIN_SOLAR_FOR_WAIT:
-        if hours_until_must_start < 1.0:
+    if solar_kw < site.min_solar_for_wait:
+        if hours_until_must_start < LOW_SOLAR_BUFFER_HOURS:
             return True, f"Low solar ({solar_kw:.2f}kW) and running out of time ({hours_until_must_start:.1f}h buffer left)"
         else:
             return False, f"Low solar ({solar_kw:.2f}kW) but time buffer OK ({hours_until_must_start:.1f}h left)"
@@ -169,112 +255,401 @@ def should_charge_from_grid(soc, solar_kw, hours_to_peak, in_peak):
     if solar_charging_potential >= soc_deficit:
         return False, f"Solar can provide ~{solar_charging_potential:.1f}% (need {soc_deficit:.1f}%), {solar_kw:.2f}kW looks promising"
     else:
-        if hours_until_must_start > 2.0:
+        if hours_until_must_start > MONITOR_BUFFER_HOURS:
             return False, f"Solar may fall short, but monitoring - {hours_until_must_start:.1f}h buffer remaining"
         else:
             return True, f"Solar unlikely to provide enough ({solar_charging_potential:.1f}% < {soc_deficit:.1f}%), starting grid charge"
 
-async def get_stats_with_retry(max_retries=5, delay=10):
+def create_client(site=DEFAULT_SITE):
+    """Create an authenticated Franklin cloud client"""
+    fetcher = TokenFetcher(site.username, site.password)
+    return Client(fetcher, site.gateway_id)
+
+async def get_stats_with_retry(max_retries=5, delay=10, client=None, site=DEFAULT_SITE):
     """Get stats with retry logic for cloud API timeouts"""
-    log_intelligence(f"Attempting to get battery stats (max {max_retries} attempts)...")
-    fetcher = TokenFetcher(USERNAME, PASSWORD)
-    client = Client(fetcher, GATEWAY_ID)
+    log_intelligence(f"Attempting to get battery stats (max {max_retries} attempts)...", site)
+    if client is None:
+        client = create_client(site)
 
     for attempt in range(max_retries):
         try:
-            log_intelligence(f"Attempt {attempt + 1} starting...")
-            stats = await client.get_stats()
+            log_intelligence(f"Attempt {attempt + 1} starting...", site)
+            stats, mode = await asyncio.gather(client.get_stats(), read_operating_mode(client))
+            _mode_cache[site.gateway_id] = (time.monotonic(), mode)
+            _fetch_attempts[site.gateway_id] = attempt + 1
             if attempt > 0:
-                log_intelligence(f"✓ Success on attempt {attempt + 1}")
+                log_intelligence(f"✓ Success on attempt {attempt + 1}", site)
             else:
-                log_intelligence(f"✓ Success on first attempt")
+                log_intelligence(f"✓ Success on first attempt", site)
             return stats
         except Exception as e:
             if attempt < max_retries - 1:
-                log_intelligence(f"✗ Attempt {attempt + 1} failed: {e}, retrying in {delay}s...")
+                log_intelligence(f"✗ Attempt {attempt + 1} failed: {e}, retrying in {delay}s...", site)
                 await asyncio.sleep(delay)
             else:
-                log_intelligence(f"✗ All {max_retries} attempts failed - final error: {e}")
+                log_intelligence(f"✗ All {max_retries} attempts failed - final error: {e}", site)
                 raise
 
-async def main():
-    """Main execution"""
+class CyclePhases:
+    """
+    Runs one cycle's blocking phases in worker threads and owns its store
+    connection. Cancelling the cycle (the fleet deadline) only stops the
+    coroutine: the running worker finishes its phase, no later phase starts,
+    and that worker closes the connection. Each phase writes in one
+    transaction, and the apply phase writes only what the journal already
+    holds, so an abandoned cycle leaves no half-applied state.
+    """
+
+    def __init__(self):
+        self.conn = None
+        self.finished = threading.Event()
+        self._busy = threading.Lock()
+
+    def connect(self, db_path):
+        self.conn = history_store.connect(db_path)
+        return self.conn
+
+    def _close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def _run(self, func, args):
+        with self._busy:
+            try:
+                if self.finished.is_set():
+                    raise RuntimeError("cycle abandoned")
+                return func(*args)
+            finally:
+                if self.finished.is_set():
+                    self._close()
+
+    async def run(self, func, *args):
+        """Run one phase, func(*args), in a worker thread"""
+        return await asyncio.to_thread(self._run, func, args)
+
+    def finish(self):
+        """Start no further phase; close the connection now or when the running phase returns"""
+        self.finished.set()
+        if self._busy.acquire(blocking=False):
+            try:
+                self._close()
+            finally:
+                self._busy.release()
+
+def _begin_cycle(conn, site):
+    """
+    Update the peak state and read the stored mode (blocking).
+    Returns: (site with today's target, dynamic target, in_peak, last_mode, requested_mode)
+    """
+    # Update peak state (returns True if in peak period)
+    with conn:
+        in_peak = update_peak_state(conn, site)
+
+    # Charge for the coming peak's expected load (never above the configured target)
+    dynamic_target = None
+    if DYNAMIC_TARGET_SOC:
+        window = site_calendar(site).next_peak_window(datetime.now())
+        dynamic_target = load_profile.target_for(conn, window[0].date()) if window else None
+        if dynamic_target is not None and dynamic_target < site.target_soc:
+            site = site._replace(target_soc=dynamic_target)
+
+    return (site, dynamic_target, in_peak, get_last_mode(conn),
+            history_store.get_state(conn, 'requested_mode'))
+
+def _decide(conn, stats, site, in_peak, current_mode, last_mode, decision_solar_kw):
+    """
+    The charge decision: planner, then risk simulator, then the rule (blocking).
+    last_mode is the mode the previous cycle left the gateway in.
+    Returns: (should_charge, reason, hours_to_peak, charge_hours, rate_model)
+    """
+    soc = stats.current.battery_soc
+
+    # Learn from the interval since the last cycle, then estimate the grid charge time
+    rate_model = None
+    charge_hours = None
+    temp_f = None
+    if LEARN_CHARGE_RATE:
+        sampled = datetime.now()
+        rate_model = charge_rate.ChargeRateModel.from_json(history_store.get_state(conn, charge_rate.STATE_KEY))
+        temp_f = charge_rate.latest_temperature(sampled) if charge_rate.TEMPERATURE_BANDS_F else None
+        rate_model.observe(sampled, soc, current_mode, stats.current.solar_production, temp_f,
+                           interval_mode=last_mode)
+        charge_hours = rate_model.hours_to_target(soc, site.target_soc, site.charge_rate_per_hour, temp_f)
+
+    # Calculate decision (only if NOT in peak); the rule covers what the planner can't
+    hours_to_peak = calculate_time_to_peak(site)
+    planned = None
+    if USE_CHARGE_PLANNER and not in_peak:
+        grid_soc = charge_planner.grid_soc_after(site, rate_model, temp_f)
+        planned = charge_planner.plan_decision(conn, soc, decision_solar_kw, hours_to_peak, site,
+                                               site_calendar(site), SOLAR_EFFICIENCY * SOLAR_SOC_PER_KW_HOUR,
+                                               current_mode, grid_soc)
+    if not planned and USE_RISK_SIMULATOR and not in_peak:
+        now = datetime.now()
+        risk = peak_risk.simulate(site_path(site, LOG_FILE), now, soc, decision_solar_kw,
+                                  stats.current.home_load, hours_to_peak, site, peak_risk.latest_radiation(now))
+        if risk:
+            planned = peak_risk.risk_decision(risk, soc)
+    if planned:
+        should_charge, reason = planned
+    else:
+        should_charge, reason = should_charge_from_grid(soc, decision_solar_kw, hours_to_peak, in_peak, site,
+                                                        charge_hours)
+    return should_charge, reason, hours_to_peak, charge_hours, rate_model
+
+def _observe(conn, reading, now, site, in_peak, actual_mode, hours_to_peak, decision_solar_kw, charge_hours):
+    """
+    Next poll time and anomaly check for the cycle's reading (blocking).
+    Returns: ({state key: value} to store with the cycle, new alerts)
+    """
+    soc, solar_kw = reading.soc_percent, reading.solar_kw
+    state = {}
+    if ADAPTIVE_POLLING:
+        import poll_schedule  # Imports this module, so only loaded when enabled
+        next_poll, poll_reason = poll_schedule.next_poll(conn, now, soc, decision_solar_kw, hours_to_peak,
+                                                         in_peak, site, charge_hours, USE_RISK_SIMULATOR)
+        log_intelligence(f"Next poll at {next_poll.strftime('%H:%M')} ({poll_reason})", site)
+        state[poll_schedule.NEXT_POLL_KEY] = next_poll.strftime('%Y-%m-%d %H:%M:%S')
+    alerts = []
+    if DETECT_ANOMALIES:
+        detector = anomaly_detector.AnomalyDetector.from_json(
+            history_store.get_state(conn, anomaly_detector.STATE_KEY))
+        radiation = peak_risk.latest_radiation(now) if anomaly_detector.needs_radiation(now, solar_kw) else None
+        alerts, cleared = detector.observe(reading, now, actual_mode, _fetch_attempts.get(site.gateway_id),
+                                           radiation)
+        for alert in alerts:
+            log_intelligence(f"⚠ ANOMALY [{alert.kind}]: {alert.message}", site)
+        for kind in cleared:
+            log_intelligence(f"✓ ANOMALY cleared [{kind}]", site)
+        state[anomaly_detector.STATE_KEY] = detector.to_json()
+    return state, alerts
+
+def _apply_cycle(conn, record, site, now, reading, decision, new_mode, mode_change, state):
+    """Record the whole cycle in one transaction, then the CSV row and log lines (blocking)"""
+    with conn:
+        if new_mode:
+            save_mode(conn, new_mode, site)
+        if mode_change:
+            history_store.record_mode_change(conn, now, *mode_change)
+        history_store.record_decision(conn, decision)
+        history_store.record_reading(conn, reading)
+        for key, value in state.items():
+            history_store.set_state(conn, key, value)
+        if record is not None:
+            history_store.mark_journal_record(conn, record['id'], journal.APPLIED)
+
+    # Log lines and CSV row (one write each when journaled)
+    if record is not None:
+        journal.write_outputs(record)
+        with conn:
+            history_store.mark_journal_record(conn, record['id'], journal.WRITTEN)
+    else:
+        append_readings(site_path(site, LOG_FILE), [reading])
+
+async def run_decision_cycle(stats, client, site=DEFAULT_SITE, smoothed_solar_kw=None):
+    """
+    Decide, switch modes if needed and record one cycle from a stats sample.
+    smoothed_solar_kw (e.g. from telemetry_sampler's ring buffer) replaces
+    the noisy instantaneous solar reading in the decision when given.
+    Store, file and planner work runs in worker threads, so the cycles of a
+    fleet overlap instead of taking turns on the event loop. A cancelled
+    cycle stops after its running phase (see CyclePhases).
+    Returns: (desired_mode, reason)
+    """
+    phases = CyclePhases()
     try:
-        # Get current stats with retry logic
-        stats = await get_stats_with_retry(max_retries=5, delay=10)
-
-        soc = stats.current.battery_soc
-        solar_kw = stats.current.solar_production
-        grid_kw = stats.current.grid_use
-        battery_kw = stats.current.battery_use
-        home_load_kw = stats.current.home_load
-
-        # Update peak state (returns True if in peak period)
-        in_peak = update_peak_state()
-
-        # Calculate decision (only if NOT in peak)
-        hours_to_peak = calculate_time_to_peak()
-        should_charge, reason = should_charge_from_grid(soc, solar_kw, hours_to_peak, in_peak)
-        desired_mode = "BACKUP" if should_charge else "TOU"
-        last_mode = get_last_mode()
-
-        # Log decision
-        log_intelligence("="*70)
-        peak_status = "IN PEAK" if in_peak else f"{hours_to_peak:.1f}h to peak"
-        log_intelligence(f"SOC: {soc:.1f}%, Solar: {solar_kw:.3f}kW, Status: {peak_status}")
-        log_intelligence(f"Decision: {reason}")
-        log_intelligence(f"Action: {'Grid charge' if should_charge else 'Solar-first (TOU mode)'}")
-
-        # Switch modes if needed (only if NOT in peak)
-        if not in_peak and desired_mode != last_mode:
-            if desired_mode == "BACKUP":
-                switch_to_backup()
-            else:
-                switch_to_tou()
-            log_intelligence(f"Mode changed: {last_mode} → {desired_mode}")
-            save_mode(desired_mode)
+        return await _run_cycle(phases, stats, client, site, smoothed_solar_kw)
+    finally:
+        phases.finish()
+
+async def _run_cycle(phases, stats, client, site, smoothed_solar_kw):
+    """The phases of run_decision_cycle"""
+    soc = stats.current.battery_soc
+    solar_kw = stats.current.solar_production
+    decision_solar_kw = solar_kw if smoothed_solar_kw is None else smoothed_solar_kw
+
+    conn = await phases.run(phases.connect, site_path(site, HISTORY_DB))
+    site, dynamic_target, in_peak, last_mode, requested_mode = await phases.run(_begin_cycle, conn, site)
+
+    # The gateway's own answer wins over the stored mode, which can be stale
+    # (lost state file, failed switch, change made in the Franklin app)
+    actual_mode = await get_operating_mode(client, site)
+    current_mode = actual_mode or last_mode
+
+    should_charge, reason, hours_to_peak, charge_hours, rate_model = await phases.run(
+        _decide, conn, stats, site, in_peak, current_mode, last_mode, decision_solar_kw)
+    desired_mode = "BACKUP" if should_charge else "TOU"
+
+    # Log decision
+    log_intelligence("="*70, site)
+    peak_status = "IN PEAK" if in_peak else f"{hours_to_peak:.1f}h to peak"
+    log_intelligence(f"SOC: {soc:.1f}%, Solar: {solar_kw:.3f}kW, Status: {peak_status}", site)
+    if smoothed_solar_kw is not None:
+        log_intelligence(f"Smoothed solar: {smoothed_solar_kw:.3f}kW (used for decision)", site)
+    if dynamic_target is not None and not in_peak:
+        log_intelligence(f"Target SOC: {site.target_soc:.0f}% (expected peak load)", site)
+    if charge_hours and not in_peak:
+        log_intelligence(f"Grid charge time to {site.target_soc:.0f}%: {charge_hours:.1f}h", site)
+    log_intelligence(f"Decision: {reason}", site)
+    log_intelligence(f"Action: {'Grid charge' if should_charge else 'Solar-first (TOU mode)'}", site)
+
+    # Confirm the previous cycle's switch (or notice drift) from this read
+    if actual_mode is None:
+        log_intelligence(f"Gateway mode unavailable, assuming stored mode: {last_mode}", site)
+    elif requested_mode and actual_mode == requested_mode:
+        log_intelligence(f"✓ Mode switch confirmed: gateway reports {actual_mode}", site)
+    elif requested_mode:
+        log_intelligence(f"✗ Mode switch to {requested_mode} not confirmed: gateway reports {actual_mode}", site)
+    elif last_mode and actual_mode != last_mode:
+        log_intelligence(f"Mode drift: stored {last_mode}, gateway reports {actual_mode}", site)
+
+    # Switch modes only if the gateway is really in another mode (and NOT in peak)
+    mode_changed = False
+    if not in_peak and desired_mode != current_mode:
+        if desired_mode == "BACKUP":
+            mode_changed = await switch_to_backup(client, site)
+        else:
+            mode_changed = await switch_to_tou(client, site)
+        # The next cycle has to read the gateway again to confirm
+        _mode_cache.pop(site.gateway_id, None)
+        if mode_changed:
+            log_intelligence(f"Mode changed: {current_mode} → {desired_mode}", site)
         else:
-            log_intelligence(f"Mode unchanged: {desired_mode}")
-            save_mode(desired_mode)
+            log_intelligence(f"Mode unchanged: {current_mode} (switch failed, will retry)", site)
+    else:
+        log_intelligence(f"Mode unchanged: {current_mode or desired_mode}", site)
+    new_mode = desired_mode if mode_changed else current_mode
 
-        # Log to CSV
-        now = datetime.now()
-        data = {
-            'timestamp': now.strftime('%Y-%m-%d %H:%M:%S'),
-            'soc_percent': f'{soc:.2f}',
-            'solar_kw': f'{solar_kw:.3f}',
-            'grid_kw': f'{grid_kw:.3f}',
-            'battery_kw': f'{battery_kw:.3f}',
-            'home_load_kw': f'{home_load_kw:.3f}',
-            'grid_status': stats.current.grid_status.name,
-            'battery_charge_total': f'{stats.totals.battery_charge:.3f}',
-            'battery_discharge_total': f'{stats.totals.battery_discharge:.3f}',
-            'grid_import_total': f'{stats.totals.grid_import:.3f}',
-            'solar_total': f'{stats.totals.solar:.3f}',
-            'hours_to_peak': f'{hours_to_peak:.2f}',
-            'mode': desired_mode
-        }
-
-        file_exists = False
+    now = datetime.now()
+    reading = reading_from_stats(stats, now, hours_to_peak, desired_mode)
+    state, alerts = await phases.run(
+        _observe, conn, reading, now, site, in_peak, actual_mode, hours_to_peak, decision_solar_kw,
+        charge_hours)
+    state['requested_mode'] = desired_mode if mode_changed else ''
+    if rate_model:
+        state[charge_rate.STATE_KEY] = rate_model.to_json()
+
+    # Write-ahead: the cycle's record is on disk before anything is applied
+    record = journal.current()
+    if record is not None:
+        record.update(status='ok', reading=list(reading), mode=new_mode, state=state,
+                      decision=[now.strftime('%Y-%m-%d %H:%M:%S'), soc, decision_solar_kw, hours_to_peak,
+                                in_peak, should_charge, desired_mode, reason],
+                      mode_change=[current_mode, desired_mode] if mode_changed else None)
+        await journal.get_journal(JOURNAL_FILE).commit(record)
+    await phases.run(
+        _apply_cycle, conn, record, site, now, reading,
+        Decision(now, soc, decision_solar_kw, hours_to_peak, in_peak, should_charge, desired_mode, reason),
+        new_mode, (current_mode, desired_mode) if mode_changed else None, state)
+
+    if MQTT_PUBLISH:
+        mqtt_publisher.publish_cycle(mqtt_publisher.get_publisher(), site.name, reading, new_mode,
+                                     in_peak, desired_mode, reason)
+    if alerts and ANOMALY_EMAIL:
+        await send_anomaly_alerts(alerts, now, site)
+
+    return desired_mode, reason
+
+async def send_anomaly_alerts(alerts, now, site=DEFAULT_SITE):
+    """Email new anomaly alerts; a failed send is logged, not raised"""
+    sender = notifier.Notifier(site_path(site, HISTORY_DB))
+    for alert in alerts:
+        sender.queue(notifier.Notice(f"anomaly_{alert.kind}", now.strftime('%Y-%m-%d'),
+                                     f"Battery Alert - {anomaly_detector.ALERT_TYPES[alert.kind]}",
+                                     f"{now.strftime('%Y-%m-%d %H:%M')} ({site.name})\n\n{alert.message}\n"))
+    try:
+        await sender.flush()
+    except Exception as e:
+        log_intelligence(f"✗ Anomaly alert email failed: {e}", site)
+
+@contextlib.asynccontextmanager
+async def journaled_cycle(site=DEFAULT_SITE):
+    """
+    Collect one cycle's log lines and outputs into a journal record.
+    Errors are logged here; a failed cycle is journaled with its error.
+    """
+    if not USE_JOURNAL:
         try:
-            with open(LOG_FILE, 'r') as f:
-                file_exists = True
-        except FileNotFoundError:
-            pass
-
-        with open(LOG_FILE, 'a', newline='') as csvfile:
-            fieldnames = list(data.keys())
-            writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-            if not file_exists:
-                writer.writeheader()
-            writer.writerow(data)
+            yield
+        except Exception as e:
+            log_intelligence(f"ERROR: {e}", site)
+            raise
+        finally:
+            await buffered_log.flush_all()
+        return
+
+    record = journal.new_record(site.name, site_path(site, HISTORY_DB), site_path(site, LOG_FILE),
+                                site_path(site, INTELLIGENCE_LOG), site_path(site, STATE_FILE))
+    token = journal.activate(record)
+    try:
+        yield
+    except asyncio.CancelledError:
+        record.update(status='failed', error="cancelled")
+        raise
+    except Exception as e:
+        log_intelligence(f"ERROR: {e}", site)
+        record.update(status='failed', error=str(e))
+        raise
+    finally:
+        journal.deactivate(token)
+        # Not committed by run_decision_cycle: the cycle failed before recording
+        if record['id'] is None and record['log']:
+            try:
+                await journal.get_journal(JOURNAL_FILE).commit(record)
+            except Exception as e:
+                record['log'].append(f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')} - "
+                                     f"✗ Journal commit failed: {e}\n")
+            journal.write_outputs(record)
+        await buffered_log.flush_all()
+
+def recover_journal():
+    """Apply cycles a crash or restart left unapplied; returns how many"""
+    if not USE_JOURNAL:
+        return 0
+    replayed = journal.recover(JOURNAL_FILE)
+    if replayed:
+        print(f"✓ Recovered {replayed} journaled cycle(s)")
+    return replayed
+
+def poll_due(site=DEFAULT_SITE):
+    """True unless adaptive polling has scheduled the next poll later"""
+    if not ADAPTIVE_POLLING:
+        return True
+    import poll_schedule
+    conn = history_store.connect(site_path(site, HISTORY_DB))
+    try:
+        # An ongoing outage keeps every run due (outage_monitor.py)
+        return poll_schedule.poll_due(conn, datetime.now()) or bool(history_store.get_state(conn, 'grid_outage'))
+    finally:
+        conn.close()
+
+async def main():
+    """Main execution"""
+    recover_journal()
+    if not poll_due():
+        print("✓ No decision due yet (adaptive polling)")
+        return 0
+    try:
+        async with journaled_cycle():
+            # Get current stats with retry logic
+            client = create_client()
+            stats = await get_stats_with_retry(max_retries=5, delay=10, client=client)
+            desired_mode, reason = await run_decision_cycle(stats, client)
 
         print(f"✓ Decision made: {desired_mode} mode ({reason})")
 
+        if WATCH_OUTAGES:
+            import outage_monitor  # Imports this module, so only loaded here
+            if not await outage_monitor.watch(client, stats):
+                print("⚡ Grid outage ongoing (watching continues next run)")
+
     except Exception as e:
-        log_intelligence(f"ERROR: {e}")
         print(f"✗ Error: {e}")
         return 1
+    finally:
+        await mqtt_publisher.close_publisher()
+        await buffered_log.flush_all()
 
     return 0
 
@@ -0,0 +1,222 @@
+#!/volume1/docker/franklin/venv311/bin/python3
+"""
+TOU Tariff Calendar
+Compiles a declarative rate schedule (seasons, weekday/weekend windows,
+holidays, partial-peak periods) into a precomputed interval index
+
+Answers "current period", "price at t" and "time to next peak" with one
+binary search over the compiled intervals, and keeps the next peak for
+every interval precomputed. Used by the decision loop, the charge planner,
+the reports and the charts so they all agree on when peak is.
+
+Without a tariff file the calendar is a single daily peak window built
+from the PEAK_START_HOUR/PEAK_END_HOUR settings in smart_decision.py.
+Run directly to print the periods of the coming days.
+"""
+import json
+import os
+import sys
+from bisect import bisect_right
+from datetime import date, datetime, timedelta
+
+import numpy as np
+
+TARIFF_FILE = "/volume1/docker/franklin/tariff.json"
+
+PEAK = "peak"
+PARTIAL_PEAK = "partial_peak"
+OFF_PEAK = "off_peak"
+
+# Prices for the single-window fallback schedule ($/kWh)
+DEFAULT_PEAK_PRICE = 0.60
+DEFAULT_OFF_PEAK_PRICE = 0.30
+
+# The index covers this many days; queries outside it use a one-off index around them
+COMPILE_DAYS = 400
+LOOKAHEAD_DAYS = 7  # Room a query needs after t to find the next peak
+
+def single_window_schedule(peak_start_hour, peak_end_hour,
+                           peak_price=DEFAULT_PEAK_PRICE, off_peak_price=DEFAULT_OFF_PEAK_PRICE):
+    """Schedule with the same peak window every day of the year"""
+    windows = [["00:00", OFF_PEAK], [f"{peak_start_hour:02d}:00", PEAK], [f"{peak_end_hour:02d}:00", OFF_PEAK]]
+    return {
+        'seasons': [{
+            'name': 'all-year',
+            'months': list(range(1, 13)),
+            'prices': {PEAK: peak_price, OFF_PEAK: off_peak_price},
+            'weekday': windows,
+            'weekend': windows,
+        }],
+        'holidays': [],
+    }
+
+def _minutes(hhmm):
+    hours, minutes = hhmm.split(':')
+    return int(hours) * 60 + int(minutes)
+
+def validate_schedule(schedule):
+    """Raise ValueError if a schedule can't be compiled"""
+    months = sorted(m for season in schedule['seasons'] for m in season['months'])
+    if months != list(range(1, 13)):
+        raise ValueError("Tariff seasons must cover each month exactly once")
+    for season in schedule['seasons']:
+        for day_type in ('weekday', 'weekend'):
+            windows = season[day_type]
+            starts = [_minutes(start) for start, _ in windows]
+            if not windows or starts[0] != 0 or starts != sorted(set(starts)) or starts[-1] >= 24 * 60:
+                raise ValueError(f"{season['name']} {day_type} windows must start at 00:00 and be in order")
+            for _, period in windows:
+                if period not in season['prices']:
+                    raise ValueError(f"{season['name']} has no price for period '{period}'")
+
+class TariffCalendar:
+    """
+    Interval index over a compiled rate schedule. The index never changes
+    once built, so one cached calendar can be shared by worker threads.
+    """
+
+    def __init__(self, schedule, start=None, days=COMPILE_DAYS):
+        validate_schedule(schedule)
+        self.schedule = schedule
+        self.days = days
+        self.holidays = {date.fromisoformat(day) for day in schedule.get('holidays', [])}
+        self.season_by_month = {m: season for season in schedule['seasons'] for m in season['months']}
+        self.compile(start or date.today() - timedelta(days=1))
+
+    def compile(self, first_day):
+        """Build the interval arrays for `days` days from first_day"""
+        starts, periods, prices = [], [], []
+        for offset in range(self.days):
+            day = first_day + timedelta(days=offset)
+            season = self.season_by_month[day.month]
+            day_type = 'weekend' if day.weekday() >= 5 or day in self.holidays else 'weekday'
+            midnight = datetime(day.year, day.month, day.day)
+            for start, period in season[day_type]:
+                price = season['prices'][period]
+                # Merge with the previous interval when nothing changes
+                if periods and periods[-1] == period and prices[-1] == price:
+                    continue
+                starts.append(midnight + timedelta(minutes=_minutes(start)))
+                periods.append(period)
+                prices.append(price)
+
+        self.begin = datetime(first_day.year, first_day.month, first_day.day)
+        self.end = self.begin + timedelta(days=self.days)
+        self.starts = starts
+        self.periods = periods
+        self.prices = prices
+        self.starts64 = np.array(starts, dtype='datetime64[s]')
+        self.prices64 = np.array(prices, dtype=float)
+        self.period_names = np.array(periods, dtype=object)
+
+        # Index of the first peak interval at or after each interval (-1: none)
+        self.next_peak = [-1] * len(starts)
+        following = -1
+        for i in range(len(starts) - 1, -1, -1):
+            if periods[i] == PEAK:
+                following = i
+            self.next_peak[i] = following
+
+    def _covering(self, since, until=None):
+        """This calendar if its index covers [since, until], else a one-off calendar that does"""
+        until = until or since
+        if self.begin <= since and until < self.end - timedelta(days=LOOKAHEAD_DAYS):
+            return self
+        first = since.date() - timedelta(days=1)
+        return TariffCalendar(self.schedule, first, (until.date() - first).days + LOOKAHEAD_DAYS + 2)
+
+    def _index(self, t):
+        """Interval containing t (t must be inside the index)"""
+        return bisect_right(self.starts, t) - 1
+
+    def _interval_end(self, i):
+        return self.starts[i + 1] if i + 1 < len(self.starts) else self.end
+
+    def period_at(self, t):
+        """Tariff period name at time t"""
+        calendar = self._covering(t)
+        return calendar.periods[calendar._index(t)]
+
+    def price_at(self, t):
+        """Price ($/kWh) at time t"""
+        calendar = self._covering(t)
+        return calendar.prices[calendar._index(t)]
+
+    def is_peak(self, t):
+        """True if t falls in a peak period"""
+        return self.period_at(t) == PEAK
+
+    def next_peak_window(self, t):
+        """(start, end) of the peak period containing t or the next one, or None"""
+        calendar = self._covering(t)
+        i = calendar.next_peak[calendar._index(t)]
+        if i < 0:
+            return None
+        return calendar.starts[i], calendar._interval_end(i)
+
+    def hours_to_peak(self, t):
+        """Hours until the next peak period starts (0 while in peak)"""
+        window = self.next_peak_window(t)
+        if window is None:
+            return float('inf')
+        return max((window[0] - t).total_seconds() / 3600, 0.0)
+
+    def peak_windows(self, since, until):
+        """All (start, end) peak periods overlapping [since, until)"""
+        calendar = self._covering(since, until)
+        windows = []
+        i = calendar._index(since)
+        while i < len(calendar.starts) and calendar.starts[i] < until:
+            if calendar.periods[i] == PEAK:
+                windows.append((calendar.starts[i], calendar._interval_end(i)))
+            i += 1
+        return windows
+
+    def _indices(self, times):
+        """(calendar, interval index of each time) for an array of times"""
+        times = np.asarray(times, dtype='datetime64[s]')
+        calendar = self
+        if len(times) and (times.min() < np.datetime64(self.begin) or times.max() >= np.datetime64(self.end)):
+            # History outside the index: compile a one-off calendar spanning it
+            first = times.min().astype(datetime).date() - timedelta(days=1)
+            days = int((times.max() - times.min()) // np.timedelta64(1, 'D')) + 3
+            calendar = TariffCalendar(self.schedule, first, days)
+        return calendar, np.searchsorted(calendar.starts64, times, side='right') - 1
+
+    def prices_for(self, times):
+        """Vectorized price lookup for an array of datetime64 values or datetimes"""
+        calendar, indices = self._indices(times)
+        return calendar.prices64[indices]
+
+    def periods_for(self, times):
+        """Vectorized period lookup for an array of datetime64 values or datetimes"""
+        calendar, indices = self._indices(times)
+        return calendar.period_names[indices]
+
+# Compiled calendars by (file, fallback window)
+_calendars = {}
+
+def load_calendar(path=TARIFF_FILE, peak_start_hour=17, peak_end_hour=20):
+    """Calendar for a tariff file, or the single-window fallback if the file doesn't exist"""
+    key = (path, peak_start_hour, peak_end_hour)
+    if key not in _calendars:
+        if path and os.path.exists(path):
+            with open(path, 'r') as f:
+                schedule = json.load(f)
+        else:
+            schedule = single_window_schedule(peak_start_hour, peak_end_hour)
+        _calendars[key] = TariffCalendar(schedule)
+    return _calendars[key]
+
+if __name__ == "__main__":
+    path = sys.argv[1] if len(sys.argv) > 1 else TARIFF_FILE
+    calendar = load_calendar(path)
+    now = datetime.now()
+    print(f"Now: {calendar.period_at(now)} at ${calendar.price_at(now):.2f}/kWh, "
+          f"{calendar.hours_to_peak(now):.1f}h to peak")
+    start = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    i = calendar._index(start)
+    while calendar.starts[i] < start + timedelta(days=7):
+        print(f"  {calendar.starts[i].strftime('%a %Y-%m-%d %H:%M')}  {calendar.periods[i]:13} ${calendar.prices[i]:.2f}")
+        i += 1
+    sys.exit(0)
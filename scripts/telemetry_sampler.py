@@ -0,0 +1,191 @@
+#!/volume1/docker/franklin/venv311/bin/python3
+"""
+High-Frequency Telemetry Sampler
+Polls battery stats every 30 seconds over one persistent client into a
+fixed-size in-memory ring buffer, and runs the 15-minute decision from it
+
+Run continuously (instead of scheduling smart_decision.py every 15 minutes).
+Every AGGREGATE_INTERVAL_SECONDS the buffer is persisted as mean/min/max
+rows to telemetry_aggregates.csv; each decision uses a smoothed solar value
+instead of a single noisy instantaneous reading.
+"""
+import asyncio
+import csv
+import sys
+import time
+from array import array
+from datetime import datetime
+from pathlib import Path
+
+import history_store
+import mqtt_publisher
+import outage_monitor
+import poll_schedule
+import smart_decision
+from readings import reading_from_stats
+from smart_decision import log_intelligence
+
+LOG_DIR = Path("/volume1/docker/franklin/logs")
+TELEMETRY_LOG = LOG_DIR / "telemetry_aggregates.csv"
+
+# Cadence
+SAMPLE_INTERVAL_SECONDS = 30
+AGGREGATE_INTERVAL_SECONDS = 300      # Persist one mean/min/max row per 5 minutes
+DECISION_INTERVAL_SECONDS = 900       # Decision cadence (15 minutes) unless ADAPTIVE_POLLING
+SMOOTHING_WINDOW_SECONDS = 600        # Solar averaged over the last 10 minutes for decisions
+
+# Ring buffer holds the last 6 hours of samples (720 x 30s)
+BUFFER_SECONDS = 6 * 3600
+
+SAMPLE_FIELDS = ('soc_percent', 'solar_kw', 'grid_kw', 'battery_kw', 'home_load_kw')
+
+class RingBuffer:
+    """Fixed-size, array-backed buffer of timestamped samples (one array per field)"""
+
+    def __init__(self, capacity, fields=SAMPLE_FIELDS):
+        self.capacity = capacity
+        self.fields = fields
+        self.timestamps = array('d', bytes(8 * capacity))
+        self.columns = {field: array('d', bytes(8 * capacity)) for field in fields}
+        self.head = 0    # Next write position
+        self.count = 0
+
+    def append(self, timestamp, sample):
+        """Store one sample, overwriting the oldest when full"""
+        i = self.head
+        self.timestamps[i] = timestamp
+        for field in self.fields:
+            self.columns[field][i] = sample[field]
+        self.head = (i + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    def values_since(self, field, since, until=None):
+        """Values of a field with since <= timestamp < until, oldest first"""
+        column = self.columns[field]
+        values = []
+        # Walk newest to oldest and stop at the first sample before `since`
+        for offset in range(1, self.count + 1):
+            i = (self.head - offset) % self.capacity
+            ts = self.timestamps[i]
+            if ts < since:
+                break
+            if until is None or ts < until:
+                values.append(column[i])
+        values.reverse()
+        return values
+
+    def window_stats(self, field, since, until=None):
+        """(mean, min, max, count) over a time window, or None if empty"""
+        values = self.values_since(field, since, until)
+        if not values:
+            return None
+        return sum(values) / len(values), min(values), max(values), len(values)
+
+def sample_from_stats(stats):
+    """Extract the sampled fields from a franklinwh stats object"""
+    return {
+        'soc_percent': stats.current.battery_soc,
+        'solar_kw': stats.current.solar_production,
+        'grid_kw': stats.current.grid_use,
+        'battery_kw': stats.current.battery_use,
+        'home_load_kw': stats.current.home_load,
+    }
+
+def write_aggregate(buffer, start, end):
+    """Append one mean/min/max row for [start, end) to the telemetry CSV"""
+    row = {'timestamp': datetime.fromtimestamp(start).strftime('%Y-%m-%d %H:%M:%S')}
+    for field in buffer.fields:
+        stats = buffer.window_stats(field, start, end)
+        if stats is None:
+            return False
+        mean, low, high, count = stats
+        row['samples'] = count
+        row[field] = f'{mean:.3f}'
+        row[f'{field}_min'] = f'{low:.3f}'
+        row[f'{field}_max'] = f'{high:.3f}'
+
+    fieldnames = ['timestamp', 'samples'] + [
+        name for field in buffer.fields for name in (field, f'{field}_min', f'{field}_max')]
+    file_exists = TELEMETRY_LOG.exists()
+    with open(TELEMETRY_LOG, 'a', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=fieldnames)
+        if not file_exists:
+            writer.writeheader()
+        writer.writerow(row)
+    return True
+
+def decision_due_at(now):
+    """Epoch time of the next decision scheduled by adaptive polling"""
+    conn = history_store.connect(smart_decision.HISTORY_DB)
+    try:
+        when = poll_schedule.get_next_poll(conn)
+    finally:
+        conn.close()
+    return when.timestamp() if when else now + DECISION_INTERVAL_SECONDS
+
+def smoothed_solar(buffer, now):
+    """Mean solar production over the smoothing window, or None if no samples"""
+    stats = buffer.window_stats('solar_kw', now - SMOOTHING_WINDOW_SECONDS)
+    return stats[0] if stats else None
+
+async def run_sampler():
+    """Sample forever; persist aggregates and run decisions on their own cadences"""
+    smart_decision.recover_journal()
+    client = smart_decision.create_client()
+    buffer = RingBuffer(BUFFER_SECONDS // SAMPLE_INTERVAL_SECONDS)
+    # Own outage handling for as long as this runs (smart_decision's watch() stands aside)
+    outage_lock = None
+    outages = None
+
+    now = time.time()
+    aggregate_start = now - (now % AGGREGATE_INTERVAL_SECONDS)
+    next_decision = now  # Decide as soon as the first sample arrives
+    print(f"✓ Sampling every {SAMPLE_INTERVAL_SECONDS}s, deciding every {DECISION_INTERVAL_SECONDS // 60} min")
+
+    while True:
+        started = time.time()
+        stats = None
+        try:
+            stats = await client.get_stats()
+            buffer.append(started, sample_from_stats(stats))
+            if smart_decision.MQTT_PUBLISH:
+                mqtt_publisher.publish_reading(mqtt_publisher.get_publisher(), smart_decision.DEFAULT_SITE.name,
+                                               reading_from_stats(stats, datetime.now(), None, None))
+        except Exception as e:
+            # A missed sample only thins the buffer; keep the cadence
+            log_intelligence(f"✗ Telemetry sample failed: {e}")
+
+        if smart_decision.WATCH_OUTAGES and outage_lock is None:
+            outage_lock = outage_monitor.acquire_watch_lock()
+            if outage_lock is not None:
+                outages = outage_monitor.load_monitor()
+        if stats is not None and outages is not None and (
+                outages.active or not outage_monitor.grid_normal(stats)):
+            await outage_monitor.announce(outages, outages.update(datetime.now(), stats), stats)
+
+        if started >= aggregate_start + AGGREGATE_INTERVAL_SECONDS:
+            write_aggregate(buffer, aggregate_start, aggregate_start + AGGREGATE_INTERVAL_SECONDS)
+            aggregate_start += AGGREGATE_INTERVAL_SECONDS * int(
+                (started - aggregate_start) // AGGREGATE_INTERVAL_SECONDS)
+
+        if stats is not None and started >= next_decision:
+            try:
+                async with smart_decision.journaled_cycle():
+                    desired_mode, reason = await smart_decision.run_decision_cycle(
+                        stats, client, smoothed_solar_kw=smoothed_solar(buffer, started))
+                print(f"✓ Decision made: {desired_mode} mode ({reason})")
+            except Exception as e:
+                print(f"✗ Error: {e}")
+            next_decision = started + DECISION_INTERVAL_SECONDS
+            if smart_decision.ADAPTIVE_POLLING:
+                next_decision = decision_due_at(started)
+
+        # Sample every few seconds while the grid is down
+        interval = outage_monitor.OUTAGE_POLL_SECONDS if outages and outages.active else SAMPLE_INTERVAL_SECONDS
+        await asyncio.sleep(max(0, interval - (time.time() - started)))
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(run_sampler())
+    except KeyboardInterrupt:
+        sys.exit(0)
@@ -0,0 +1,178 @@
+#!/volume1/docker/franklin/venv311/bin/python3
+"""
+PVOutput Battery Telemetry Uploader
+Uploads home load, battery power, SOC and grid power from the monitoring
+history to PVOutput, many intervals per request (addbatchstatus)
+
+Readings are averaged per STATUS_INTERVAL_MINUTES and sent in batches of
+BATCH_SIZE from a watermark kept in the history store, so each run only
+sends what's new and a backlog after an outage goes out in a handful of
+requests. PVOutput's rate-limit headers are read after every request; the
+uploader stops while RESERVED_REQUESTS remain for collect_pvoutput.py
+and picks up where it left off next run.
+
+A batch rejected as a whole is split in halves to isolate the bad status,
+which is then skipped; statuses PVOutput answers with "not added" are
+logged and skipped. Run every 15-60 minutes.
+"""
+import sys
+import time
+from datetime import datetime, timedelta
+
+import requests
+
+import history_store
+from collect_pvoutput import API_KEY
+
+# ⚠️ REPLACE WITH THE PVOUTPUT SYSTEM THAT SHOULD RECEIVE BATTERY DATA
+BATTERY_SID = "YOUR_BATTERY_SYSTEM_ID"
+
+UPLOAD_URL = "https://pvoutput.org/service/r2/addbatchstatus.jsp"
+
+STATUS_INTERVAL_MINUTES = 15   # Must match the system's status interval on PVOutput
+# Donation accounts: 100 statuses per batch, 90 days back, extended values v7-v12
+DONATION_ACCOUNT = False
+BATCH_SIZE = 100 if DONATION_ACCOUNT else 30
+MAX_BACKLOG_DAYS = 90 if DONATION_ACCOUNT else 14
+RESERVED_REQUESTS = 5          # Left for collect_pvoutput.py and manual use
+MAX_REQUESTS_PER_RUN = 20
+REQUEST_TIMEOUT_SECONDS = 30
+
+WATERMARK_KEY = 'pvoutput_upload_watermark'
+
+def _mean(readings, field, scale=1000.0):
+    """Mean of a reading field as a PVOutput value string ('' when unknown)"""
+    values = [getattr(r, field) for r in readings if getattr(r, field) is not None]
+    return '' if not values else f"{sum(values) / len(values) * scale:.0f}"
+
+def build_statuses(readings, until):
+    """
+    One status per complete interval before `until`, averaging its readings.
+    Returns: [(interval start, status string)], oldest first
+    """
+    buckets = {}
+    for reading in readings:
+        stamp = datetime.strptime(reading.timestamp, '%Y-%m-%d %H:%M:%S')
+        start = stamp.replace(minute=stamp.minute - stamp.minute % STATUS_INTERVAL_MINUTES, second=0)
+        if start + timedelta(minutes=STATUS_INTERVAL_MINUTES) <= until:
+            buckets.setdefault(start, []).append(reading)
+
+    statuses = []
+    for start, bucket in sorted(buckets.items()):
+        # d,t,v1 energy,v2 power,v3 consumption energy,v4 consumption power,v5 temp,v6 voltage
+        fields = [start.strftime('%Y%m%d'), start.strftime('%H:%M'), '', '', '',
+                  _mean(bucket, 'home_load_kw'), '', '']
+        if DONATION_ACCOUNT:
+            # Extended values: v7 battery power (W), v8 SOC %, v9 grid power (W), as the gateway reports them
+            fields += [_mean(bucket, 'battery_kw'), _mean(bucket, 'soc_percent', 1.0), _mean(bucket, 'grid_kw')]
+        statuses.append((start, ','.join(fields)))
+    return statuses
+
+class QuotaExhausted(Exception):
+    """Stop uploading until the hourly request quota resets"""
+
+class Uploader:
+    """Sends batches over one session and tracks the request quota"""
+
+    def __init__(self, session=None, api_key=API_KEY, system_id=BATTERY_SID):
+        self.session = session or requests.Session()
+        self.session.headers.update({
+            'X-Pvoutput-Apikey': api_key,
+            'X-Pvoutput-SystemId': system_id,
+            'X-Rate-Limit': '1',   # Ask for the quota headers
+        })
+        self.requests_made = 0
+        self.remaining = None
+        self.reset = None
+
+    def post(self, statuses):
+        """
+        Send one batch.
+        Returns: list of accepted flags, one per status; None if PVOutput rejected the batch as a whole
+        """
+        if self.requests_made >= MAX_REQUESTS_PER_RUN:
+            raise QuotaExhausted(f"{MAX_REQUESTS_PER_RUN} requests made this run")
+        if self.remaining is not None and self.remaining <= RESERVED_REQUESTS:
+            raise QuotaExhausted(f"{self.remaining} requests left this hour")
+
+        response = self.session.post(UPLOAD_URL, data={'data': ';'.join(s for _, s in statuses)},
+                                     timeout=REQUEST_TIMEOUT_SECONDS)
+        self.requests_made += 1
+        if 'X-Rate-Limit-Remaining' in response.headers:
+            self.remaining = int(response.headers['X-Rate-Limit-Remaining'])
+            self.reset = int(response.headers.get('X-Rate-Limit-Reset', 0)) or None
+        if response.status_code == 403 and 'rate limit' in response.text.lower():
+            self.remaining = 0
+            raise QuotaExhausted(response.text.strip())
+        if response.status_code == 400:
+            return None
+        if response.status_code != 200:
+            raise RuntimeError(f"HTTP {response.status_code}: {response.text.strip()[:200]}")
+
+        # "20260101,10:00,1;20260101,10:15,0;..." - 1 = added
+        flags = [part.rsplit(',', 1)[-1] == '1' for part in response.text.strip().split(';') if part]
+        return flags if len(flags) == len(statuses) else [True] * len(statuses)
+
+    def send(self, statuses, rejected):
+        """Send a batch, splitting it to isolate statuses PVOutput refuses"""
+        flags = self.post(statuses)
+        if flags is None:
+            if len(statuses) == 1:
+                rejected.append(statuses[0])
+                return
+            middle = len(statuses) // 2
+            self.send(statuses[:middle], rejected)
+            self.send(statuses[middle:], rejected)
+            return
+        rejected.extend(status for status, added in zip(statuses, flags) if not added)
+
+def upload(conn, uploader, now=None):
+    """
+    Upload all complete intervals after the watermark.
+    Returns: (statuses sent, rejected statuses, stop reason or None)
+    """
+    now = now or datetime.now()
+    stored = history_store.get_state(conn, WATERMARK_KEY)
+    oldest = now - timedelta(days=MAX_BACKLOG_DAYS) + timedelta(hours=1)
+    since = oldest
+    if stored:
+        since = max(datetime.strptime(stored, '%Y-%m-%d %H:%M') + timedelta(minutes=STATUS_INTERVAL_MINUTES),
+                    oldest)
+
+    statuses = build_statuses(history_store.readings_between(conn, since, now), now)
+    sent, rejected = 0, []
+    stop = None
+    for i in range(0, len(statuses), BATCH_SIZE):
+        batch = statuses[i:i + BATCH_SIZE]
+        try:
+            uploader.send(batch, rejected)
+        except QuotaExhausted as e:
+            stop = str(e)
+            break
+        sent += len(batch)
+        # Advance after every batch, so a later failure doesn't resend it
+        with conn:
+            history_store.set_state(conn, WATERMARK_KEY, batch[-1][0].strftime('%Y-%m-%d %H:%M'))
+    return sent, rejected, stop
+
+if __name__ == "__main__":
+    from smart_decision import HISTORY_DB
+
+    conn = history_store.connect(HISTORY_DB)
+    uploader = Uploader()
+    started = time.monotonic()
+    try:
+        sent, rejected, stop = upload(conn, uploader)
+    except Exception as e:
+        print(f"✗ Upload failed: {e}")
+        sys.exit(1)
+    finally:
+        conn.close()
+
+    print(f"✓ Uploaded {sent} statuses in {uploader.requests_made} requests ({time.monotonic() - started:.1f}s)")
+    for _, status in rejected:
+        print(f"  ⚠ Not added: {status}")
+    if stop:
+        reset = datetime.fromtimestamp(uploader.reset).strftime('%H:%M') if uploader.reset else "the next hour"
+        print(f"  Paused until {reset}: {stop}")
+    sys.exit(0)